@@ -3,41 +3,73 @@ import stripe
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 
+from idempotency import IdempotencyCache, IdempotencyConflict, IDEMPOTENCY_HEADER
+
 load_dotenv()
 
 app = Flask(__name__)
 
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# Replays of a charge request with the same Idempotency-Key get the stored outcome
+# (successes only: errors, retryable 409/429/503 ones included, are never stored)
+CHARGE_REQUESTS = IdempotencyCache(ttl=float(os.getenv("CHARGE_IDEMPOTENCY_TTL", "86400")))
+
 @app.route('/charge_and_transfer', methods=['POST'])
 def charge_and_transfer():
     data = request.json
     sender_customer_id = data.get("sender_customer_id")
     recipient_account_id = data.get("recipient_account_id")
     amount_cents = data.get("amount_cents")
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER) or data.get("idempotency_key")
+
+    def charge():
+        try:
+            # Create a PaymentIntent with transfer_data for destination charge
+            payment_intent = stripe.PaymentIntent.create(
+                amount=amount_cents,
+                currency='gbp',
+                customer=sender_customer_id,
+                payment_method_types=["card"],
+                payment_method="pm_card_visa",  # For testing, in prod get real pm
+                off_session=True,
+                confirm=True,
+                transfer_data={"destination": recipient_account_id},
+                idempotency_key=idempotency_key,
+            )
+            return {
+                "status": "success",
+                "charge_id": payment_intent.id,
+                "message": "Charge successful"
+            }, 200
+        except stripe.RateLimitError as e:
+            return {"status": "error", "error": str(e)}, 429
+        except stripe.IdempotencyError as e:
+            # The same key is still being processed by Stripe: the caller retries
+            return {"status": "error", "error": str(e)}, 409
+        except (stripe.APIConnectionError, stripe.APIError) as e:
+            # The charge may or may not have gone through; a retry with the same
+            # key tells, so this must not read as a final answer
+            return {"status": "error", "error": str(e)}, 503
+        except stripe.StripeError as e:
+            status = 503 if (e.http_status or 0) >= 500 else 400
+            return {"status": "error", "error": str(e)}, status
+        except Exception as e:
+            return {
+                "status": "error",
+                "error": str(e)
+            }, 400
+
+    if not idempotency_key:
+        body, status = charge()
+        return jsonify(body), status
 
+    fingerprint = (sender_customer_id, recipient_account_id, amount_cents)
     try:
-        # Create a PaymentIntent with transfer_data for destination charge
-        payment_intent = stripe.PaymentIntent.create(
-            amount=amount_cents,
-            currency='gbp',
-            customer=sender_customer_id,
-            payment_method_types=["card"],
-            payment_method="pm_card_visa",  # For testing, in prod get real pm
-            off_session=True,
-            confirm=True,
-            transfer_data={"destination": recipient_account_id},
-        )
-        return jsonify({
-            "status": "success",
-            "charge_id": payment_intent.id,
-            "message": "Charge successful"
-        })
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "error": str(e)
-        }), 400
+        body, status = CHARGE_REQUESTS.run(idempotency_key, fingerprint, charge)
+    except IdempotencyConflict as e:
+        return jsonify({"status": "error", "error": str(e)}), 422
+    return jsonify(body), status
 
 if __name__ == '__main__':
     app.run(port=5000)
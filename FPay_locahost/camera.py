@@ -0,0 +1,89 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+
+class Camera:
+    """
+    Reads the camera on its own thread and prepares the kiosk preview there.
+
+    Every captured frame goes to on_frame (the recognizer keeps the newest one).
+    At most preview_fps times a second the frame is also shrunk to the preview
+    size and converted to RGB, into one of two preallocated buffers; the Tk
+    side reads the finished one with preview(). Nothing is allocated per frame
+    on the preview path.
+    """
+
+    def __init__(self, capture, preview_width=480, preview_fps=30, on_frame=None):
+        self.capture = capture
+        self.preview_width = preview_width
+        self.preview_fps = preview_fps
+        self.on_frame = on_frame
+        self.preview_size = None
+        self.capture_fps = 0.0
+        self._lock = threading.Lock()
+        self._small = None
+        self._front = None
+        self._back = None
+        self._seq = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="camera", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def set_preview_fps(self, fps):
+        self.preview_fps = fps
+
+    @contextmanager
+    def preview(self):
+        """Yields (seq, rgb array) of the newest preview frame; hold it only while copying out."""
+        with self._lock:
+            yield self._seq, self._front
+
+    def _allocate(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.preview_width, max(1, round(height * self.preview_width / width)))
+        self._small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self._front = np.zeros_like(self._small)
+        self._back = np.zeros_like(self._small)
+        self.preview_size = size
+
+    def _run(self):
+        next_preview = 0.0
+        frames, window_start = 0, time.monotonic()
+        while self._running:
+            ok, frame = self.capture.read()
+            if not ok:
+                time.sleep(0.05)
+                continue
+            now = time.monotonic()
+            frames += 1
+            if now - window_start >= 1.0:
+                self.capture_fps = frames / (now - window_start)
+                frames, window_start = 0, now
+
+            if self.on_frame is not None:
+                self.on_frame(frame)
+
+            if now < next_preview:
+                continue
+            next_preview = now + 1.0 / max(self.preview_fps, 1)
+            if self._small is None:
+                self._allocate(frame)
+            # INTER_AREA shrinks once to display size; both steps write into existing buffers
+            cv2.resize(frame, self.preview_size, dst=self._small, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(self._small, cv2.COLOR_BGR2RGB, dst=self._back)
+            with self._lock:
+                self._front, self._back = self._back, self._front
+                self._seq += 1
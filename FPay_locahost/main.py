@@ -3,19 +3,50 @@ from tkinter import ttk, messagebox
 from PIL import Image, ImageTk
 import cv2
 import os
+import time
 import numpy as np
 
 from dotenv import load_dotenv
 
-from face_utils import get_face_embedding, match_face
-from user_store import load_users, register_user
+from face_utils import get_face_embedding, match_face, load_gallery
+from user_store import register_user
 import backend_api
+from gallery_sync import GallerySync
+from recognizer import Recognizer
+from camera import Camera
 
 load_dotenv()
 
-USERS = load_users()
+# Recognize every camera frame on the payment tab, so the payer is verified before pressing a button
+CONTINUOUS_RECOGNITION = os.getenv("KIOSK_CONTINUOUS_RECOGNITION", "false").lower() == "true"
+RECOGNITION_INTERVAL = float(os.getenv("KIOSK_RECOGNITION_INTERVAL", "0.5"))
+# How long a continuous match stays valid once the face is no longer recognized
+VERIFY_HOLD_SECONDS = float(os.getenv("KIOSK_VERIFY_HOLD_SECONDS", "3"))
+
+# Camera preview: width on screen, and frame rate normally / while a face is being recognized
+PREVIEW_WIDTH = int(os.getenv("KIOSK_PREVIEW_WIDTH", "480"))
+PREVIEW_FPS = float(os.getenv("KIOSK_PREVIEW_FPS", "30"))
+PREVIEW_BUSY_FPS = float(os.getenv("KIOSK_PREVIEW_BUSY_FPS", "8"))
+# Show preview/camera FPS and process CPU under the tabs (for tuning on kiosk hardware)
+SHOW_STATS = os.getenv("KIOSK_SHOW_STATS", "false").lower() == "true"
+
+# Vectorized in-memory gallery (see face_gallery.py)
+USERS = load_gallery()
 CAP = cv2.VideoCapture(0)
 
+# === Keep USERS in step with registrations made elsewhere (see gallery_sync.py) ===
+def resync_users():
+    global USERS
+    USERS = load_gallery()
+
+USERS_SYNC = GallerySync(
+    on_upsert=lambda *user: USERS.add(*user),
+    on_delete=lambda user_id: USERS.remove(user_id),
+    on_resync=resync_users,
+    local_checksum=lambda: USERS.checksum(),
+)
+USERS_SYNC.start()
+
 KNOWN_FACES_DIR = "known_faces"
 os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
 
@@ -31,13 +62,37 @@ class FacePayApp:
         self.face_embedding = None
         self.face_verified = False
         self.sender_id = None
+        self.verified_at = 0.0
         self.captured_frame = None
 
+        self.recognizer = Recognizer(
+            root,
+            embed=get_face_embedding,
+            match=lambda embedding: match_face(embedding, USERS),
+            on_result=self.on_continuous_result,
+            interval=RECOGNITION_INTERVAL,
+        )
+
+        self.camera = Camera(CAP, preview_width=PREVIEW_WIDTH, preview_fps=PREVIEW_FPS,
+                             on_frame=self.recognizer.submit_frame)
+        self.preview_image = None
+        self.preview_seq = 0
+        self.stats = {"rendered": 0, "wall": time.monotonic(), "cpu": time.process_time()}
+
+        # Transfers sent from this screen that are still in the outbox
+        self.pending_transfers = set()
+        backend_api.get_outbox().add_listener(
+            lambda transfer: self.root.after(0, self.on_transfer_update, transfer))
+
         self.setup_ui()
+        self.camera.start()
         self.update_video_feed()
+        if SHOW_STATS:
+            self.update_stats()
 
     def setup_ui(self):
         notebook = ttk.Notebook(self.root)
+        self.notebook = notebook
 
         self.register_tab = ttk.Frame(notebook)
         self.payment_tab = ttk.Frame(notebook)
@@ -45,6 +100,11 @@ class FacePayApp:
         notebook.add(self.register_tab, text="🧍 Register")
         notebook.add(self.payment_tab, text="💸 Send Payment")
         notebook.pack(expand=True, fill="both")
+        notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+        self.stats_label = tk.Label(self.root, text="", fg="gray")
+        if SHOW_STATS:
+            self.stats_label.pack(side="bottom", anchor="e")
 
         self.build_register_tab()
         self.build_payment_tab()
@@ -72,19 +132,20 @@ class FacePayApp:
         self.register_button.pack(pady=10)
 
     def capture_face_for_register(self):
-        ret, frame = CAP.read()
-        if not ret:
-            messagebox.showerror("Error", "Failed to capture frame.")
-            return
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        try:
-            self.face_embedding = get_face_embedding(frame_rgb)
-            self.captured_frame = frame.copy()
+        self.capture_button.config(state=tk.DISABLED)
+        self.register_status.config(text="⏳ Capturing face...", fg="blue")
+        self.recognizer.request(self.on_register_capture, match=False)
+
+    def on_register_capture(self, result):
+        self.capture_button.config(state=tk.NORMAL)
+        if result["error"] is None:
+            self.face_embedding = result["embedding"]
+            self.captured_frame = result["frame"].copy()
             self.register_status.config(text="✅ Face captured successfully", fg="green")
             self.register_button.config(state=tk.NORMAL)
-        except Exception as e:
+        else:
             self.register_status.config(text="❌ Face not found or multiple faces", fg="red")
-            print("Face embedding error:", e)
+            print("Face embedding error:", result["error"])
             self.face_embedding = None
             self.captured_frame = None
             self.register_button.config(state=tk.DISABLED)
@@ -105,7 +166,7 @@ class FacePayApp:
 
         # Save user locally
         new_user = register_user(name, stripe_customer_id, self.face_embedding)
-        USERS.append(new_user)
+        USERS.add(new_user["user_id"], name, stripe_customer_id, self.face_embedding)
         save_face_image(new_user["user_id"], self.captured_frame)
 
         messagebox.showinfo("Success", f"✅ Registered {name} successfully.")
@@ -142,26 +203,46 @@ class FacePayApp:
         self.send_button.pack(pady=10)
 
     def verify_face_for_payment(self):
-        ret, frame = CAP.read()
-        if not ret:
-            messagebox.showerror("Error", "Could not capture frame.")
-            return
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        try:
-            embedding = get_face_embedding(frame_rgb)
-            matched_user = match_face(embedding, USERS)
-            if matched_user:
-                self.face_verified = True
-                self.sender_id = matched_user["user_id"]
-                self.payment_status.config(text=f"✅ Verified: {matched_user['name']}", fg="green")
-                self.send_button.config(state=tk.NORMAL)
-            else:
-                self.payment_status.config(text="❌ Face not recognized", fg="red")
-                self.face_verified = False
-                self.send_button.config(state=tk.DISABLED)
-        except Exception as e:
-            print("Verification error:", e)
+        self.verify_button.config(state=tk.DISABLED)
+        self.payment_status.config(text="⏳ Verifying...", fg="blue")
+        self.recognizer.request(self.on_verify_result)
+
+    def on_verify_result(self, result):
+        self.verify_button.config(state=tk.NORMAL)
+        if result["error"] is not None:
+            print("Verification error:", result["error"])
             self.payment_status.config(text="❌ Verification failed", fg="red")
+            return
+        self.show_verification(result["user"])
+
+    def on_continuous_result(self, result):
+        if result["user"] is None and time.monotonic() - self.verified_at < VERIFY_HOLD_SECONDS:
+            return  # a missed frame or two should not undo a fresh verification
+        if result["user"] is None and result["error"] is not None:
+            if self.face_verified:
+                self.show_verification(None)
+            return
+        if result["user"] is not None and self.face_verified and result["user"]["user_id"] == self.sender_id:
+            self.verified_at = time.monotonic()
+            return
+        self.show_verification(result["user"])
+
+    def show_verification(self, matched_user):
+        if matched_user:
+            self.face_verified = True
+            self.sender_id = matched_user["user_id"]
+            self.verified_at = time.monotonic()
+            self.payment_status.config(text=f"✅ Verified: {matched_user['name']}", fg="green")
+            self.send_button.config(state=tk.NORMAL)
+        else:
+            self.payment_status.config(text="❌ Face not recognized", fg="red")
+            self.face_verified = False
+            self.sender_id = None
+            self.send_button.config(state=tk.DISABLED)
+
+    def on_tab_changed(self, event):
+        on_payment_tab = self.notebook.select() == str(self.payment_tab)
+        self.recognizer.set_continuous(CONTINUOUS_RECOGNITION and on_payment_tab)
 
     def send_payment(self):
         if not self.face_verified:
@@ -187,36 +268,78 @@ class FacePayApp:
 
         amount_cents = int(amount * 100)
 
-        # Send transfer via backend
-        result = backend_api.send_transfer(
+        # Hand the transfer to the outbox; the result arrives in on_transfer_update
+        result = backend_api.queue_transfer(
             sender_customer_id=self.sender_id,
             recipient_account_id=recipient_account_id,
-            amount_cents=amount_cents
+            amount_cents=amount_cents,
+            wait=0
         )
+        self.send_button.config(state=tk.DISABLED)
+        self.face_verified = False
+        if result.get("status") == "queued":
+            self.pending_transfers.add(result["transfer_id"])
+            self.payment_status.config(text="⏳ Payment queued, sending...", fg="orange")
+        else:
+            self.show_transfer_result(result)
 
+    def on_transfer_update(self, transfer):
+        if transfer["id"] not in self.pending_transfers:
+            return
+        if transfer["status"] == "queued":
+            self.payment_status.config(
+                text=f"⏳ Payment queued, backend unreachable (attempt {transfer['attempts']})...", fg="orange")
+            return
+        self.pending_transfers.discard(transfer["id"])
+        self.show_transfer_result(transfer["result"])
+
+    def show_transfer_result(self, result):
         if result.get("status") == "success":
+            self.payment_status.config(text="✅ Payment sent", fg="green")
             messagebox.showinfo("Success", f"Payment sent! Charge ID: {result.get('charge_id')}")
         else:
+            self.payment_status.config(text="❌ Payment failed", fg="red")
             messagebox.showerror("Payment Failed", result.get("error") or "Unknown error.")
 
     def update_video_feed(self):
-        ret, frame = CAP.read()
-        if ret:
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            img = Image.fromarray(frame_rgb)
-            imgtk = ImageTk.PhotoImage(image=img)
-            if self.register_tab.winfo_ismapped():
-                self.reg_video_label.imgtk = imgtk
-                self.reg_video_label.configure(image=imgtk)
-            if self.payment_tab.winfo_ismapped():
-                self.pay_video_label.imgtk = imgtk
-                self.pay_video_label.configure(image=imgtk)
-        self.root.after(30, self.update_video_feed)
+        # Give inference the CPU while a recognition is running
+        fps = PREVIEW_BUSY_FPS if self.recognizer.busy else PREVIEW_FPS
+        self.camera.set_preview_fps(fps)
+        if self.notebook.winfo_viewable():
+            self.render_preview()
+        self.root.after(max(1, int(1000 / fps)), self.update_video_feed)
+
+    def render_preview(self):
+        size = self.camera.preview_size
+        if size is None:
+            return
+        if self.preview_image is None:
+            # One PhotoImage shared by both tabs; only the mapped label gets redrawn
+            self.preview_image = ImageTk.PhotoImage("RGB", size)
+            self.reg_video_label.configure(image=self.preview_image)
+            self.pay_video_label.configure(image=self.preview_image)
+        with self.camera.preview() as (seq, rgb):
+            if seq == self.preview_seq:
+                return
+            self.preview_seq = seq
+            self.preview_image.paste(Image.frombuffer("RGB", size, rgb, "raw", "RGB", 0, 1))
+        self.stats["rendered"] += 1
+
+    def update_stats(self):
+        now, cpu = time.monotonic(), time.process_time()
+        elapsed = now - self.stats["wall"]
+        self.stats_label.config(text=(
+            f"preview {self.stats['rendered'] / elapsed:.1f} fps · camera {self.camera.capture_fps:.1f} fps · "
+            f"CPU {100 * (cpu - self.stats['cpu']) / elapsed:.0f}%"
+        ))
+        self.stats.update(rendered=0, wall=now, cpu=cpu)
+        self.root.after(1000, self.update_stats)
 
 if __name__ == "__main__":
     root = tk.Tk()
     app = FacePayApp(root)
     root.mainloop()
+    app.camera.stop()
 
 CAP.release()
 
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import cv2
+
+
+class Recognizer:
+    """
+    Runs face detection, embedding and matching for the kiosk on a worker thread
+    so the Tk main loop never blocks on inference.
+
+    The camera loop hands over every frame with submit_frame(); only the newest
+    one is kept, so frames that arrive while a recognition is running are
+    dropped rather than queued. request() asks for the next frame to be
+    recognized and calls back with the result on the Tk thread (via root.after).
+    With continuous recognition on, every fresh frame (at most one per
+    `interval` seconds) is recognized and passed to on_result.
+
+    Results are dicts with "frame" (BGR), "embedding", "user" (the match or
+    None) and "error" (the exception if no face could be embedded, else None).
+    """
+
+    def __init__(self, root, embed, match, on_result=None, interval=0.5):
+        self.root = root
+        self.embed = embed
+        self.match = match
+        self.on_result = on_result
+        self.interval = interval
+        self.continuous = False
+        self.busy = False
+        self._cond = threading.Condition()
+        self._frame = None
+        self._frame_seq = 0
+        self._done_seq = 0
+        self._requests = []
+        self._last_continuous = 0.0
+        self._thread = threading.Thread(target=self._run, name="recognizer", daemon=True)
+        self._thread.start()
+
+    def submit_frame(self, frame_bgr):
+        """Offers the latest camera frame; an unprocessed older frame is discarded."""
+        with self._cond:
+            self._frame = frame_bgr
+            self._frame_seq += 1
+            self._cond.notify()
+
+    def request(self, callback, match=True):
+        """Recognizes the next frame and calls callback(result) on the Tk thread."""
+        with self._cond:
+            self._requests.append((callback, match))
+            self._cond.notify()
+
+    def set_continuous(self, enabled):
+        with self._cond:
+            self.continuous = enabled
+            self._cond.notify()
+
+    def _ready(self):
+        if self._frame is None or self._frame_seq == self._done_seq:
+            return False
+        if self._requests:
+            return True
+        return self.continuous and time.monotonic() - self._last_continuous >= self.interval
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    # Wake up again when the continuous interval is due
+                    self._cond.wait(self.interval if self.continuous else None)
+                frame, self._frame = self._frame, None
+                self._done_seq = self._frame_seq
+                requests, self._requests = self._requests, []
+                continuous = self.continuous
+                if continuous:
+                    self._last_continuous = time.monotonic()
+                self.busy = True
+
+            result = self._recognize(frame, match=continuous or any(m for _, m in requests))
+            self.busy = False
+
+            for callback, _ in requests:
+                self.root.after(0, callback, result)
+            if continuous and self.on_result is not None:
+                self.root.after(0, self.on_result, result)
+
+    def _recognize(self, frame, match):
+        result = {"frame": frame, "embedding": None, "user": None, "error": None}
+        try:
+            result["embedding"] = self.embed(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if match:
+                result["user"] = self.match(result["embedding"])
+        except Exception as e:
+            result["error"] = e
+        return result
@@ -0,0 +1,142 @@
+import os
+import threading
+
+import numpy as np
+
+BLOCK_ROWS = 65536  # rows assigned per matrix product while building
+
+
+def _nearest_centroids(vectors, centroids, count=1):
+    """Returns the indices of the `count` closest centroids for each row of vectors."""
+    c_norms = np.einsum("ij,ij->i", centroids, centroids)
+    scores = c_norms[None, :] - 2.0 * (vectors @ centroids.T)
+    if count == 1:
+        return np.argmin(scores, axis=1)
+    count = min(count, centroids.shape[0])
+    return np.argpartition(scores, count - 1, axis=1)[:, :count]
+
+
+class IVFIndex:
+    """
+    Inverted-file index over a FaceGallery's embedding matrix.
+    Embeddings are bucketed by their nearest k-means centroid; a query only scans
+    the buckets of its `nprobe` nearest centroids. Distances inside those buckets
+    are exact, so the caller's threshold still means the same thing - raising
+    nprobe trades latency for recall.
+    """
+
+    def __init__(self, centroids, nprobe=8):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._cell_of = {}
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    # === Training ===
+    @classmethod
+    def train(cls, matrix, nlist, nprobe=8, iterations=20, sample_size=None, seed=0):
+        """Runs k-means on (a sample of) the gallery matrix to pick nlist centroids."""
+        rng = np.random.default_rng(seed)
+        n = matrix.shape[0]
+        nlist = max(1, min(nlist, n))
+        sample_size = sample_size or min(n, 64 * nlist)
+        sample = matrix[rng.choice(n, size=sample_size, replace=False)].astype(np.float32)
+
+        centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = _nearest_centroids(sample, centroids)
+            counts = np.bincount(assign, minlength=nlist)
+            order = np.argsort(assign, kind="stable")
+            starts = np.searchsorted(assign[order], np.arange(nlist))
+            empty = counts == 0
+            sums = np.add.reduceat(sample[order], starts[~empty], axis=0)
+            centroids[~empty] = sums / counts[~empty, None]
+            # Re-seed empty cells from random sample points so no centroid is wasted
+            if empty.any():
+                centroids[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+        return cls(centroids, nprobe=nprobe)
+
+    def build(self, matrix, size):
+        """Assigns the first `size` rows of matrix to cells, replacing any previous contents."""
+        cells = np.empty(size, dtype=np.int64)
+        for start in range(0, size, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, size)
+            cells[start:stop] = _nearest_centroids(matrix[start:stop], self.centroids)
+        self._set_cells(cells)
+        return cells
+
+    def _set_cells(self, cells):
+        order = np.argsort(cells, kind="stable")
+        bounds = np.searchsorted(cells[order], np.arange(self.nlist + 1))
+        with self._lock:
+            self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(self.nlist)]
+            self._cell_of = dict(enumerate(cells.tolist()))
+
+    # === Incremental updates ===
+    def add(self, row, vec):
+        """Files a new or changed gallery row under its nearest centroid."""
+        cell = int(_nearest_centroids(np.asarray(vec, dtype=np.float32)[None, :], self.centroids)[0])
+        with self._lock:
+            old = self._cell_of.get(row)
+            if old == cell:
+                return
+            if old is not None:
+                self._lists[old] = self._lists[old][self._lists[old] != row]
+            self._lists[cell] = np.append(self._lists[cell], row)
+            self._cell_of[row] = cell
+
+    def remove(self, row):
+        with self._lock:
+            old = self._cell_of.pop(row, None)
+            if old is not None:
+                self._lists[old] = self._lists[old][self._lists[old] != row]
+
+    # === Search ===
+    def candidates(self, query, nprobe=None):
+        """Returns the gallery rows stored in the query's nprobe closest cells."""
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        cells = _nearest_centroids(query[None, :], self.centroids, count=nprobe)[0]
+        with self._lock:
+            lists = [self._lists[c] for c in cells]
+        return np.concatenate(lists) if lists else np.empty(0, dtype=np.int64)
+
+    # === Persistence ===
+    def save(self, path, user_ids):
+        """
+        Writes centroids and each user's cell to an .npz file, keyed by user_id
+        so the file stays valid if the gallery is loaded in a different row order.
+        """
+        with self._lock:
+            rows = np.fromiter(self._cell_of.keys(), dtype=np.int64, count=len(self._cell_of))
+            cells = np.fromiter(self._cell_of.values(), dtype=np.int64, count=len(self._cell_of))
+        ids = np.array([user_ids[r] for r in rows], dtype=str)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, user_ids=ids, cells=cells)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, matrix, user_ids, nprobe=8):
+        """
+        Restores a saved index for the current gallery. Users the file knows keep
+        their saved cell; anyone enrolled since is assigned to the nearest centroid.
+        """
+        with np.load(path) as data:
+            centroids = data["centroids"]
+            saved = dict(zip(data["user_ids"].tolist(), data["cells"].tolist()))
+        if centroids.shape[1] != matrix.shape[1]:
+            raise ValueError(f"index dimension {centroids.shape[1]} does not match gallery")
+
+        index = cls(centroids, nprobe=nprobe)
+        size = len(user_ids)
+        cells = np.array([saved.get(uid, -1) for uid in user_ids], dtype=np.int64)
+        missing = np.flatnonzero(cells < 0)
+        if missing.size:
+            cells[missing] = _nearest_centroids(matrix[missing], index.centroids)
+        index._set_cells(cells[:size])
+        return index
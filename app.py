@@ -1,30 +1,89 @@
 import os
-import base64
-import io
-import json
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from PIL import Image
 from dotenv import load_dotenv
 import stripe
-import numpy as np
 
-from face_utils import get_face_embedding, find_matching_user_by_embedding
+from face_utils import (
+    get_face_embedding, get_face_embedding_from_bytes, find_matching_user_by_embedding, add_to_gallery,
+    warm_up_model, get_gallery,
+    start_gallery_sync, GALLERY_SYNC
+)
 from user_store import register_user
+from payment_journal import get_journal
+from payment_query import get_index
+from charge_queue import ChargeQueue
+from idempotency import IdempotencyCache, IdempotencyConflict, IDEMPOTENCY_HEADER, payment_fingerprint
+from verify_tokens import issue_token, redeem_token, TokenError
+from image_decode import read_image_request, read_face_crop, read_face_crop_bytes, decode_face_crop, ImageRequestError
+from db_pool import pool_stats
+import metrics
+from metrics import span
 
 # === Load env variables and Stripe key ===
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Run Stripe charges in the background and let clients poll /api/pay/<payment_id>
+PAY_ASYNC = os.getenv("PAY_ASYNC", "true").lower() == "true"
+PAY_CURRENCY = "gbp"
+# Longest a status request may block waiting for a charge to finish
+PAY_STATUS_MAX_WAIT = 25
+# How long a payment response is replayed for a retried idempotency key
+PAY_IDEMPOTENCY_TTL = float(os.getenv("PAY_IDEMPOTENCY_TTL", "86400"))
+# Bearer token for the read-only payment reporting routes; unset disables them
+REPORTS_TOKEN = os.getenv("REPORTS_TOKEN")
+# Most records one /api/payments request returns
+PAYMENTS_MAX_LIMIT = 10000
+# Longest window /api/payments/failure_rate covers (a year)
+FAILURE_RATE_MAX_MINUTES = 366 * 24 * 60
+# Bearer token required by /metrics when set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 # === App Setup ===
 app = Flask(__name__)
 CORS(app)
 
-LOG_FILE = "data/payment_log.json"
-LOG_LOCK = threading.Lock()
+# Set once the model is built and warmed and the gallery is loaded
+READY = threading.Event()
+
+# === Request metrics ===
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    metrics.finish_request(request.endpoint or "unknown", request.method, response.status_code)
+    return response
+
+metrics.register(metrics.Gauge(
+    "facepay_db_pool", "Database connection pool state and counters", ("stat",),
+    lambda: {(name,): value for name, value in pool_stats().items()}))
+
+# === Startup: warm model + gallery before taking traffic ===
+def warm_up():
+    """
+    Builds and warms the Facenet model (or waits for the embedding service, see
+    EMBEDDING_SERVICE), then loads the user gallery and starts listening for changes to it.
+    Called from the gunicorn post_worker_init hook (see gunicorn.conf.py),
+    so a worker only accepts requests once this has finished.
+    """
+    try:
+        warm_up_model()
+        if get_gallery() is None:
+            raise RuntimeError("user gallery could not be loaded")
+        if GALLERY_SYNC:
+            start_gallery_sync()
+        # Re-run charges left pending by a worker that died mid-charge
+        CHARGES.start_reclaimer()
+        metrics.start_flusher()
+        READY.set()
+        print(f"[STARTUP] Worker {os.getpid()} ready")
+    except Exception as e:
+        print("[STARTUP ERROR] Warm-up failed:", e)
 
 # === Logging Payments ===
 def log_payment(amount, currency, recipient, status, **kwargs):
@@ -36,16 +95,31 @@ def log_payment(amount, currency, recipient, status, **kwargs):
         "status": status
     }
     record.update(kwargs)
-
-    with LOG_LOCK:
-        try:
-            with open(LOG_FILE, "r") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            data = []
-        data.append(record)
-        with open(LOG_FILE, "w") as f:
-            json.dump(data, f, indent=4)
+    with span("log_payment"):
+        get_journal().append(record)
+
+def embed_request_face(image_bytes, face_crop, landmarks):
+    """Embeds the client's face crop when one was sent, otherwise the full frame."""
+    if face_crop is not None:
+        return get_face_embedding(face_crop, detect=False, landmarks=landmarks)
+    return get_face_embedding_from_bytes(image_bytes)
+
+# === Health Checks ===
+@app.route("/healthz/live")
+def healthz_live():
+    return jsonify({"status": "ok"})
+
+@app.route("/healthz/ready")
+def healthz_ready():
+    if READY.is_set():
+        return jsonify({"status": "ready"})
+    return jsonify({"status": "starting"}), 503
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"status": "error", "error": "Unauthorized"}), 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # === Serve Frontend Files ===
 @app.route("/")
@@ -63,21 +137,24 @@ def serve_js():
 # === API: Register Face + Stripe ID ===
 @app.route("/api/register", methods=["POST"])
 def api_register():
-    data = request.get_json()
+    try:
+        with span("read_request"):
+            data, image_bytes = read_image_request(request)
+            face_crop, landmarks = read_face_crop(request, data)
+    except ImageRequestError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
     name = data.get("name")
     stripe_id = data.get("stripe_id")
-    image_data = data.get("image_data")
 
-    if not all([name, stripe_id, image_data]):
+    if not all([name, stripe_id]) or (image_bytes is None and face_crop is None):
         return jsonify({"status": "error", "error": "Missing fields"}), 400
 
     try:
-        img_bytes = base64.b64decode(image_data.split(",")[1])
-        image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        np_image = np.array(image)
-
-        embedding = get_face_embedding(np_image)
+        embedding = embed_request_face(image_bytes, face_crop, landmarks)
         user = register_user(name, stripe_id, embedding)
+        if user["created"]:
+            add_to_gallery(user)
 
         return jsonify({"status": "success", "user_id": user["user_id"]})
     except Exception as e:
@@ -86,22 +163,23 @@ def api_register():
 # === API: Verify Face ===
 @app.route("/api/verify", methods=["POST"])
 def api_verify():
-    data = request.get_json()
-    image_data = data.get("image_data")
+    try:
+        with span("read_request"):
+            data, image_bytes = read_image_request(request)
+            face_crop, landmarks = read_face_crop(request, data)
+    except ImageRequestError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
 
-    if not image_data:
+    if image_bytes is None and face_crop is None:
         return jsonify({"status": "error", "error": "No image data provided"}), 400
 
     try:
-        img_bytes = base64.b64decode(image_data.split(",")[1])
-        image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        np_image = np.array(image)
-
-        embedding = get_face_embedding(np_image)
+        embedding = embed_request_face(image_bytes, face_crop, landmarks)
         user = find_matching_user_by_embedding(embedding)
 
         if user:
-            return jsonify({"status": "success"})
+            # /api/pay can redeem this instead of sending (and re-embedding) the face again
+            return jsonify({"status": "success", "verify_token": issue_token(user)})
         else:
             return jsonify({"status": "error", "error": "Face not recognized"}), 401
     except Exception as e:
@@ -110,39 +188,150 @@ def api_verify():
 # === API: Pay After Face Verification ===
 @app.route("/api/pay", methods=["POST"])
 def api_pay():
-    data = request.get_json()
+    # Only the raw bytes are read here: the face is decoded if it is needed,
+    # which it is not when a verification token is redeemed
+    try:
+        with span("read_request"):
+            data, image_bytes = read_image_request(request)
+            crop_bytes = read_face_crop_bytes(request, data)
+    except ImageRequestError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
     recipient_id = data.get("recipient_id")
     amount = data.get("amount")
-    image_data = data.get("image_data")
+    verify_token = data.get("verify_token")
 
-    if not all([recipient_id, amount, image_data]):
+    if not all([recipient_id, amount]) or (image_bytes is None and crop_bytes is None and not verify_token):
         return jsonify({"status": "error", "error": "Missing fields"}), 400
 
-    try:
-        img_bytes = base64.b64decode(image_data.split(",")[1])
-        image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        np_image = np.array(image)
-        embedding = get_face_embedding(np_image)
+    # Retries carrying the same key get the first response back, with no new
+    # inference or charge; the key is also passed on to Stripe
+    key = request.headers.get(IDEMPOTENCY_HEADER) or data.get("idempotency_key")
+    if not key:
+        body, status = pay_with_face(recipient_id, amount, image_bytes, crop_bytes, data, verify_token)
+        return jsonify(body), status
 
-        user = find_matching_user_by_embedding(embedding)
-        if not user:
-            return jsonify({"status": "error", "error": "Face not recognized"}), 401
+    fingerprint = payment_fingerprint(recipient_id, amount, PAY_CURRENCY, verify_token, image_bytes, crop_bytes)
+    try:
+        body, status = PAY_REQUESTS.run(key, fingerprint, lambda: pay_with_face(
+            recipient_id, amount, image_bytes, crop_bytes, data, verify_token,
+            idempotency_key=key, fingerprint=fingerprint
+        ))
+    except IdempotencyConflict as e:
+        return jsonify({"status": "error", "error": str(e)}), 422
+    return jsonify(body), status
+
+def pay_with_face(recipient_id, amount, image_bytes, crop_bytes, fields, verify_token=None,
+                  idempotency_key=None, fingerprint=None):
+    """
+    Identifies the payer (from a verification token, or by matching their face)
+    and charges them. Returns (response body, HTTP status).
+    The face (frame or crop bytes, with the request fields describing the crop)
+    is only decoded when there is no usable token.
+    """
+    try:
+        if idempotency_key:
+            # Another worker may already have taken this payment
+            existing = CHARGES.find_by_key(idempotency_key)
+            if existing:
+                payment_id, existing_fingerprint = existing
+                if existing_fingerprint != fingerprint:
+                    raise IdempotencyConflict("Idempotency key was used with different parameters")
+                return {"status": "pending", "payment_id": payment_id}, 202
 
         if not recipient_id.startswith("acct_"):
-            return jsonify({"status": "error", "error": "Invalid recipient ID"}), 400
+            return {"status": "error", "error": "Invalid recipient ID"}, 400
+
+        user = None
+        if verify_token:
+            try:
+                with span("token_redeem"):
+                    user = redeem_token(verify_token)
+            except TokenError as e:
+                # The client attaches the face alongside the token, so an expired or
+                # foreign token falls back to matching it
+                if image_bytes is None and crop_bytes is None:
+                    return {"status": "error", "error": str(e)}, 401
+                print(f"[PAY] Verification token rejected ({e}); matching the face instead")
+        if user is None:
+            face_crop, landmarks = decode_face_crop(crop_bytes, fields) if crop_bytes is not None else (None, None)
+            embedding = embed_request_face(image_bytes, face_crop, landmarks)
+            user = find_matching_user_by_embedding(embedding)
+            if not user:
+                return {"status": "error", "error": "Face not recognized"}, 401
 
         cents = int(float(amount) * 100)
         payload = {
             "sender_customer_id": user["user_id"],
             "recipient_account_id": recipient_id,
-            "amount_cents": cents
+            "amount_cents": cents,
+            "idempotency_key": idempotency_key
         }
 
-        res = charge_and_transfer_internal(payload)
-        return jsonify(res)
-
+        if not PAY_ASYNC:
+            if not idempotency_key:
+                return charge_and_transfer_internal(payload), 200
+            # Charged here, but recorded in payment_jobs so other workers see the key
+            payment_id, result = CHARGES.run(payload, idempotency_key=idempotency_key, fingerprint=fingerprint)
+            if result is None:
+                return {"status": "pending", "payment_id": payment_id}, 202
+            return result, 200
+
+        with span("charge_submit"):
+            payment_id = CHARGES.submit(payload, idempotency_key=idempotency_key, fingerprint=fingerprint)
+        return {"status": "pending", "payment_id": payment_id}, 202
+
+    except IdempotencyConflict:
+        raise
+    except ImageRequestError as e:
+        return {"status": "error", "error": str(e)}, 400
     except Exception as e:
-        return jsonify({"status": "error", "error": f"Payment failed: {e}"}), 400
+        return {"status": "error", "error": f"Payment failed: {e}"}, 400
+
+# === API: Payment Status (poll or long-poll with ?wait=seconds) ===
+@app.route("/api/pay/<payment_id>", methods=["GET"])
+def api_pay_status(payment_id):
+    wait = min(max(request.args.get("wait", 0, type=float), 0), PAY_STATUS_MAX_WAIT)
+    result = CHARGES.status(payment_id, wait=wait)
+    if result is None:
+        return jsonify({"status": "error", "error": "Unknown payment"}), 404
+    return jsonify({**result, "payment_id": payment_id})
+
+# === API: Payment History (read-only) ===
+def reports_authorized():
+    return bool(REPORTS_TOKEN) and request.headers.get("Authorization") == f"Bearer {REPORTS_TOKEN}"
+
+@app.route("/api/payments", methods=["GET"])
+def api_payments():
+    if not reports_authorized():
+        return jsonify({"status": "error", "error": "Unauthorized"}), 403
+
+    recipient = request.args.get("recipient")
+    day = request.args.get("day")
+    charge_id = request.args.get("charge_id")
+    if not any([recipient, day, charge_id]):
+        return jsonify({"status": "error", "error": "recipient, day or charge_id is required"}), 400
+
+    limit = max(1, min(request.args.get("limit", 1000, type=int), PAYMENTS_MAX_LIMIT))
+    records = get_index().find(recipient=recipient, day=day, charge_id=charge_id, limit=limit)
+    return jsonify({"status": "success", "payments": records})
+
+@app.route("/api/payments/rollups", methods=["GET"])
+def api_payment_rollups():
+    if not reports_authorized():
+        return jsonify({"status": "error", "error": "Unauthorized"}), 403
+
+    rollups = get_index().rollups(day=request.args.get("day"), recipient=request.args.get("recipient"))
+    return jsonify({"status": "success", "rollups": rollups})
+
+@app.route("/api/payments/failure_rate", methods=["GET"])
+def api_payment_failure_rate():
+    if not reports_authorized():
+        return jsonify({"status": "error", "error": "Unauthorized"}), 403
+
+    minutes = max(1, min(request.args.get("minutes", 60, type=int), FAILURE_RATE_MAX_MINUTES))
+    result = get_index().failure_rate(datetime.now() - timedelta(minutes=minutes))
+    return jsonify({"status": "success", **result})
 
 # === Stripe Logic ===
 def charge_and_transfer_internal(data):
@@ -151,16 +340,19 @@ def charge_and_transfer_internal(data):
         recipient_account_id = data.get("recipient_account_id")
         amount_cents = data.get("amount_cents")
 
-        payment_intent = stripe.PaymentIntent.create(
-            amount=amount_cents,
-            currency="gbp",
-            customer=sender_customer_id,
-            payment_method_types=["card"],
-            payment_method="pm_card_visa",
-            off_session=True,
-            confirm=True,
-            transfer_data={"destination": recipient_account_id},
-        )
+        with span("stripe"):
+            payment_intent = stripe.PaymentIntent.create(
+                amount=amount_cents,
+                currency=PAY_CURRENCY,
+                customer=sender_customer_id,
+                payment_method_types=["card"],
+                payment_method="pm_card_visa",
+                off_session=True,
+                confirm=True,
+                transfer_data={"destination": recipient_account_id},
+                idempotency_key=data.get("idempotency_key"),
+            )
+        metrics.record_payment("success")
 
         log_payment(
             amount=amount_cents / 100,
@@ -177,6 +369,7 @@ def charge_and_transfer_internal(data):
         }
 
     except Exception as e:
+        metrics.record_payment("failed")
         log_payment(
             amount=data.get("amount_cents", 0) / 100,
             currency="GBP",
@@ -187,7 +380,11 @@ def charge_and_transfer_internal(data):
         print("[ERROR] Stripe payment failed:", e)
         return {"status": "error", "error": str(e)}
 
+CHARGES = ChargeQueue(charge_and_transfer_internal)
+PAY_REQUESTS = IdempotencyCache(ttl=PAY_IDEMPOTENCY_TTL)
+
 # === Run App ===
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    threading.Thread(target=warm_up, daemon=True).start()
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,511 @@
+"""
+Asyncio serving mode for the FacePay API (Quart), an alternative to app.py:
+
+    hypercorn asgi_app:app --bind 0.0.0.0:$PORT
+
+One event loop serves every in-flight request, so waiting on Postgres (asyncpg),
+Stripe (its async client) or the journal does not hold a worker. Image decoding,
+inference and matching are CPU-bound and run on a bounded thread pool
+(ASGI_CPU_WORKERS); requests beyond that wait for a slot without holding a thread.
+
+Routes and responses are the same as app.py's, except that /api/pay charges
+inline and answers with the final result, as app.py does with PAY_ASYNC off.
+Payments sent with an idempotency key are recorded in payment_jobs like
+app.py's, so a key is honoured across workers and entry points, a repeat gets
+{"status": "pending", "payment_id"} to poll at /api/pay/<payment_id>, and a
+job left pending by a crashed worker is charged again by a ChargeQueue
+reclaimer. Sampled request traces (TRACE_SAMPLE_RATE) are a Flask-only
+feature; stage and request latency metrics work in both.
+
+VERIFY_TOKEN_SECRET must be set: hypercorn forks its workers without a hook
+for sharing a generated one (gunicorn.conf.py does that for app.py). Under
+hypercorn --workers N, also set METRICS_DIR to a directory shared by the
+workers (see metrics.py).
+"""
+import asyncio
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import asyncpg
+import stripe
+from dotenv import load_dotenv
+from quart import Quart, Response, g, jsonify, request, send_from_directory
+from quart_cors import cors
+
+from charge_queue import ChargeQueue
+from face_utils import (
+    get_face_embedding, get_face_embedding_from_bytes, find_matching_user_by_embedding, add_to_gallery,
+    warm_up_model, get_gallery,
+    start_gallery_sync, GALLERY_SYNC
+)
+from embedding_format import encode_embedding
+from payment_journal import get_journal
+from idempotency import AsyncIdempotencyCache, IdempotencyConflict, IDEMPOTENCY_HEADER, payment_fingerprint
+from verify_tokens import issue_token, read_token, TokenError
+from image_decode import read_image_request, read_face_crop, read_face_crop_bytes, decode_face_crop, ImageRequestError
+import metrics
+from metrics import span
+
+# === Load env variables and Stripe key ===
+load_dotenv()
+if not os.getenv("VERIFY_TOKEN_SECRET"):
+    raise RuntimeError("asgi_app needs VERIFY_TOKEN_SECRET: tokens must verify in every worker")
+stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+DATABASE_URL = os.getenv("DATABASE_URL")
+PAY_IDEMPOTENCY_TTL = float(os.getenv("PAY_IDEMPOTENCY_TTL", "86400"))
+PAY_CURRENCY = "gbp"
+PAY_STATUS_MAX_WAIT = 25
+PAY_STATUS_POLL_INTERVAL = 0.25
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Threads for decode / inference / matching; more than the cores only adds contention
+ASGI_CPU_WORKERS = int(os.getenv("ASGI_CPU_WORKERS", str(os.cpu_count() or 2)))
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "10"))
+
+# === App Setup ===
+app = Quart(__name__)
+app = cors(app)
+
+READY = threading.Event()
+PAY_REQUESTS = AsyncIdempotencyCache(ttl=PAY_IDEMPOTENCY_TTL)
+
+_cpu_executor = ThreadPoolExecutor(max_workers=ASGI_CPU_WORKERS, thread_name_prefix="cpu")
+_cpu_slots = None
+_db = None
+_loop = None
+
+async def run_cpu(fn, *args):
+    """
+    Runs fn on the CPU pool. Waiting for a slot happens here, before the work
+    is handed over, so a burst of requests queues as coroutines holding only
+    their upload bytes rather than as decoded images in the executor's queue.
+    """
+    async with _cpu_slots:
+        return await asyncio.get_running_loop().run_in_executor(_cpu_executor, fn, *args)
+
+# === Startup ===
+def warm_up():
+    """Same as app.warm_up: model (or embedding service), gallery and gallery sync."""
+    warm_up_model()
+    if get_gallery() is None:
+        raise RuntimeError("user gallery could not be loaded")
+    if GALLERY_SYNC:
+        start_gallery_sync()
+    CHARGES.start_reclaimer()
+    metrics.start_flusher()
+
+@app.before_serving
+async def start():
+    global _cpu_slots, _db, _loop
+    _loop = asyncio.get_running_loop()
+    _cpu_slots = asyncio.Semaphore(ASGI_CPU_WORKERS)
+    _db = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=ASYNC_DB_POOL_SIZE)
+
+    async def warm():
+        try:
+            await asyncio.get_running_loop().run_in_executor(_cpu_executor, warm_up)
+            READY.set()
+            print(f"[STARTUP] Async worker {os.getpid()} ready")
+        except Exception as e:
+            print("[STARTUP ERROR] Warm-up failed:", e)
+
+    app.add_background_task(warm)
+
+@app.after_serving
+async def stop():
+    await _db.close()
+    _cpu_executor.shutdown(wait=False)
+
+metrics.register(metrics.Gauge(
+    "facepay_async_db_pool", "asyncpg pool connections (size / idle)", ("stat",),
+    lambda: {("size",): _db.get_size(), ("idle",): _db.get_idle_size()} if _db is not None else {}))
+
+# === Request metrics ===
+# metrics.start_request / finish_request keep their state per thread, which does
+# not fit interleaved coroutines; request latency is recorded here instead
+@app.before_request
+async def start_request_metrics():
+    g.started = time.perf_counter()
+
+@app.after_request
+async def finish_request_metrics(response):
+    if metrics.METRICS_ENABLED:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - g.started,
+            endpoint=request.endpoint or "unknown", method=request.method, status=response.status_code)
+    return response
+
+# === Reading uploads ===
+class _LoadedRequest:
+    """
+    The parts of a request that image_decode reads, loaded on the event loop so
+    that its synchronous parsers (and the face crop decode) can run on the CPU pool.
+    """
+
+    def __init__(self, mimetype, args, form=None, files=None, body=None, json=None):
+        self.mimetype = mimetype
+        self.args = args
+        self.form = form
+        self.files = files
+        self._body = body
+        self._json = json
+
+    def get_data(self):
+        return self._body
+
+    def get_json(self, silent=False):
+        return self._json
+
+async def load_request():
+    mimetype = request.mimetype or ""
+    if mimetype == "multipart/form-data":
+        return _LoadedRequest(mimetype, request.args, form=await request.form, files=await request.files)
+    if mimetype.startswith("image/"):
+        return _LoadedRequest(mimetype, request.args, body=await request.get_data())
+    return _LoadedRequest(mimetype, request.args, json=await request.get_json(silent=True))
+
+def parse_upload(loaded):
+    """(fields, image_bytes, face_crop, landmarks), as app.py's routes read them."""
+    data, image_bytes = read_image_request(loaded)
+    face_crop, landmarks = read_face_crop(loaded, data)
+    return data, image_bytes, face_crop, landmarks
+
+async def read_upload():
+    with span("read_request"):
+        return await run_cpu(parse_upload, await load_request())
+
+async def read_pay_upload():
+    """(fields, image_bytes, crop_bytes): nothing is decoded, see app.api_pay."""
+    with span("read_request"):
+        loaded = await load_request()
+        data, image_bytes = read_image_request(loaded)
+        return data, image_bytes, read_face_crop_bytes(loaded, data)
+
+def embed_request_face(image_bytes, face_crop, landmarks):
+    """Embeds the client's face crop when one was sent, otherwise the full frame."""
+    if face_crop is not None:
+        return get_face_embedding(face_crop, detect=False, landmarks=landmarks)
+    return get_face_embedding_from_bytes(image_bytes)
+
+def identify(image_bytes, face_crop, landmarks):
+    return find_matching_user_by_embedding(embed_request_face(image_bytes, face_crop, landmarks))
+
+def identify_encoded(image_bytes, crop_bytes, fields):
+    """identify() for /api/pay, which defers decoding the crop until it is needed."""
+    face_crop, landmarks = decode_face_crop(crop_bytes, fields) if crop_bytes is not None else (None, None)
+    return identify(image_bytes, face_crop, landmarks)
+
+# === Logging Payments ===
+async def log_payment(amount, currency, recipient, status, **kwargs):
+    record = {
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "amount": amount,
+        "currency": currency,
+        "to": recipient,
+        "status": status
+    }
+    record.update(kwargs)
+    journal = get_journal()
+    with span("log_payment"):
+        if journal.fsync == "always":
+            # append waits for the group commit's fsync
+            await asyncio.to_thread(journal.append, record)
+        else:
+            journal.append(record)
+
+# === Health Checks ===
+@app.route("/healthz/live")
+async def healthz_live():
+    return jsonify({"status": "ok"})
+
+@app.route("/healthz/ready")
+async def healthz_ready():
+    if READY.is_set():
+        return jsonify({"status": "ready"})
+    return jsonify({"status": "starting"}), 503
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"status": "error", "error": "Unauthorized"}), 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# === Serve Frontend Files ===
+@app.route("/")
+async def serve_index():
+    return await send_from_directory("frontend", "index.html")
+
+@app.route("/style.css")
+async def serve_css():
+    return await send_from_directory("frontend", "style.css")
+
+@app.route("/script.js")
+async def serve_js():
+    return await send_from_directory("frontend", "script.js")
+
+# === API: Register Face + Stripe ID ===
+@app.route("/api/register", methods=["POST"])
+async def api_register():
+    try:
+        data, image_bytes, face_crop, landmarks = await read_upload()
+    except ImageRequestError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    name = data.get("name")
+    stripe_id = data.get("stripe_id")
+
+    if not all([name, stripe_id]) or (image_bytes is None and face_crop is None):
+        return jsonify({"status": "error", "error": "Missing fields"}), 400
+
+    try:
+        embedding = await run_cpu(embed_request_face, image_bytes, face_crop, landmarks)
+        with span("db_register"):
+            created = await _db.fetchval("""
+                INSERT INTO users (user_id, name, stripe_customer_id, face_embedding)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id
+            """, stripe_id, name, stripe_id, encode_embedding(embedding)) is not None
+        if created:
+            add_to_gallery({"user_id": stripe_id, "name": name, "stripe_customer_id": stripe_id,
+                            "face_embedding": embedding})
+
+        return jsonify({"status": "success", "user_id": stripe_id})
+    except Exception as e:
+        return jsonify({"status": "error", "error": f"Registration failed: {e}"}), 400
+
+# === API: Verify Face ===
+@app.route("/api/verify", methods=["POST"])
+async def api_verify():
+    try:
+        data, image_bytes, face_crop, landmarks = await read_upload()
+    except ImageRequestError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    if image_bytes is None and face_crop is None:
+        return jsonify({"status": "error", "error": "No image data provided"}), 400
+
+    try:
+        user = await run_cpu(identify, image_bytes, face_crop, landmarks)
+        if user:
+            return jsonify({"status": "success", "verify_token": issue_token(user)})
+        else:
+            return jsonify({"status": "error", "error": "Face not recognized"}), 401
+    except Exception as e:
+        return jsonify({"status": "error", "error": f"Verification failed: {e}"}), 400
+
+# === API: Pay After Face Verification ===
+@app.route("/api/pay", methods=["POST"])
+async def api_pay():
+    try:
+        data, image_bytes, crop_bytes = await read_pay_upload()
+    except ImageRequestError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    recipient_id = data.get("recipient_id")
+    amount = data.get("amount")
+    verify_token = data.get("verify_token")
+
+    if not all([recipient_id, amount]) or (image_bytes is None and crop_bytes is None and not verify_token):
+        return jsonify({"status": "error", "error": "Missing fields"}), 400
+
+    key = request.headers.get(IDEMPOTENCY_HEADER) or data.get("idempotency_key")
+    if not key:
+        body, status = await pay_with_face(recipient_id, amount, image_bytes, crop_bytes, data, verify_token)
+        return jsonify(body), status
+
+    fingerprint = payment_fingerprint(recipient_id, amount, PAY_CURRENCY, verify_token, image_bytes, crop_bytes)
+    try:
+        body, status = await PAY_REQUESTS.run(key, fingerprint, lambda: pay_with_face(
+            recipient_id, amount, image_bytes, crop_bytes, data, verify_token,
+            idempotency_key=key, fingerprint=fingerprint
+        ))
+    except IdempotencyConflict as e:
+        return jsonify({"status": "error", "error": str(e)}), 422
+    return jsonify(body), status
+
+async def redeem_token(token):
+    """verify_tokens.redeem_token on the async pool."""
+    claims = read_token(token)
+    async with _db.acquire() as conn:
+        if secrets.randbelow(100) == 0:  # clear out old entries now and then, as redeem_token does
+            await conn.execute("DELETE FROM used_verify_tokens WHERE expires_at < now()")
+        jti = await conn.fetchval("""
+            INSERT INTO used_verify_tokens (jti, expires_at)
+            VALUES ($1, to_timestamp($2))
+            ON CONFLICT (jti) DO NOTHING
+            RETURNING jti
+        """, claims["jti"], claims["exp"])
+    if jti is None:
+        raise TokenError("Verification token already used")
+    return {"user_id": claims["uid"]}
+
+async def pay_with_face(recipient_id, amount, image_bytes, crop_bytes, fields, verify_token=None,
+                        idempotency_key=None, fingerprint=None):
+    """
+    Identifies the payer (from a verification token, or by matching their face)
+    and charges them. Returns (response body, HTTP status). As in app.py, the
+    face is only decoded when there is no usable token.
+    """
+    try:
+        if idempotency_key:
+            # Another worker (or app.py) may already have taken this payment
+            existing = await find_job(idempotency_key, fingerprint)
+            if existing:
+                return {"status": "pending", "payment_id": existing}, 202
+
+        if not recipient_id.startswith("acct_"):
+            return {"status": "error", "error": "Invalid recipient ID"}, 400
+
+        user = None
+        if verify_token:
+            try:
+                with span("token_redeem"):
+                    user = await redeem_token(verify_token)
+            except TokenError as e:
+                # As in app.py: fall back to the attached face, if there is one
+                if image_bytes is None and crop_bytes is None:
+                    return {"status": "error", "error": str(e)}, 401
+                print(f"[PAY] Verification token rejected ({e}); matching the face instead")
+        if user is None:
+            user = await run_cpu(identify_encoded, image_bytes, crop_bytes, fields)
+            if not user:
+                return {"status": "error", "error": "Face not recognized"}, 401
+
+        cents = int(float(amount) * 100)
+        payload = {
+            "sender_customer_id": user["user_id"],
+            "recipient_account_id": recipient_id,
+            "amount_cents": cents,
+            "idempotency_key": idempotency_key
+        }
+        if not idempotency_key:
+            return await charge_and_transfer_internal(payload), 200
+
+        # Recorded in payment_jobs first, as ChargeQueue.run does, so other workers see the key
+        payment_id = uuid.uuid4().hex
+        if not await create_job(payment_id, idempotency_key, fingerprint, payload):
+            return {"status": "pending", "payment_id": await find_job(idempotency_key, fingerprint)}, 202
+        result = await charge_and_transfer_internal(payload)
+        await finish_job(payment_id, result)
+        return result, 200
+
+    except IdempotencyConflict:
+        raise
+    except ImageRequestError as e:
+        return {"status": "error", "error": str(e)}, 400
+    except Exception as e:
+        return {"status": "error", "error": f"Payment failed: {e}"}, 400
+
+# === Payment jobs (the payment_jobs rows ChargeQueue keeps) ===
+async def create_job(payment_id, idempotency_key, fingerprint, payload):
+    """ChargeQueue._create on the async pool: False if a job already exists for the key."""
+    async with _db.acquire() as conn:
+        created = await conn.fetchval("""
+            INSERT INTO payment_jobs
+                (payment_id, status, result, idempotency_key, fingerprint, payload, claimed_at, attempts)
+            VALUES ($1, 'pending', $2::jsonb, $3, $4, $5::jsonb, now(), 1)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING payment_id
+        """, payment_id, json.dumps({"status": "pending"}), idempotency_key, fingerprint, json.dumps(payload))
+    return created is not None
+
+async def find_job(idempotency_key, fingerprint):
+    """payment_id of the job created with this key, or None; IdempotencyConflict if its parameters differ."""
+    async with _db.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT payment_id, fingerprint FROM payment_jobs WHERE idempotency_key = $1
+        """, idempotency_key)
+    if row is None:
+        return None
+    if row["fingerprint"] != fingerprint:
+        raise IdempotencyConflict("Idempotency key was used with different parameters")
+    return row["payment_id"]
+
+async def finish_job(payment_id, result):
+    status = "success" if result.get("status") == "success" else "error"
+    try:
+        async with _db.acquire() as conn:
+            # A reclaimed duplicate may finish second: the first result stands
+            await conn.execute("""
+                UPDATE payment_jobs SET status = $1, result = $2::jsonb, updated_at = now()
+                WHERE payment_id = $3 AND status = 'pending'
+            """, status, json.dumps(result), payment_id)
+    except Exception as e:
+        print(f"[ERROR] Could not record result of payment {payment_id}:", e)
+
+# === API: Payment Status (poll or long-poll with ?wait=seconds) ===
+@app.route("/api/pay/<payment_id>", methods=["GET"])
+async def api_pay_status(payment_id):
+    wait = min(max(request.args.get("wait", 0, type=float), 0), PAY_STATUS_MAX_WAIT)
+    deadline = time.monotonic() + wait
+    while True:
+        async with _db.acquire() as conn:
+            row = await conn.fetchrow("SELECT status, result FROM payment_jobs WHERE payment_id = $1", payment_id)
+        if row is None:
+            return jsonify({"status": "error", "error": "Unknown payment"}), 404
+        if row["status"] != "pending" or time.monotonic() >= deadline:
+            return jsonify({**json.loads(row["result"]), "payment_id": payment_id})
+        await asyncio.sleep(PAY_STATUS_POLL_INTERVAL)
+
+# === Stripe Logic ===
+async def charge_and_transfer_internal(data):
+    try:
+        sender_customer_id = data.get("sender_customer_id")
+        recipient_account_id = data.get("recipient_account_id")
+        amount_cents = data.get("amount_cents")
+
+        with span("stripe"):
+            payment_intent = await stripe.PaymentIntent.create_async(
+                amount=amount_cents,
+                currency=PAY_CURRENCY,
+                customer=sender_customer_id,
+                payment_method_types=["card"],
+                payment_method="pm_card_visa",
+                off_session=True,
+                confirm=True,
+                transfer_data={"destination": recipient_account_id},
+                idempotency_key=data.get("idempotency_key"),
+            )
+        metrics.record_payment("success")
+
+        await log_payment(
+            amount=amount_cents / 100,
+            currency="GBP",
+            recipient=recipient_account_id,
+            status="Completed",
+            charge_id=payment_intent.id
+        )
+
+        return {
+            "status": "success",
+            "charge_id": payment_intent.id,
+            "message": "Charge successful"
+        }
+
+    except Exception as e:
+        metrics.record_payment("failed")
+        await log_payment(
+            amount=data.get("amount_cents", 0) / 100,
+            currency="GBP",
+            recipient=data.get("recipient_account_id"),
+            status="Failed",
+            error=str(e)
+        )
+        print("[ERROR] Stripe payment failed:", e)
+        return {"status": "error", "error": str(e)}
+
+def charge_blocking(payload):
+    """charge_and_transfer_internal for ChargeQueue's threads (the reclaimer), run on the serving loop."""
+    return asyncio.run_coroutine_threadsafe(charge_and_transfer_internal(payload), _loop).result()
+
+CHARGES = ChargeQueue(charge_blocking)
+
+# === Run App ===
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -1,17 +1,55 @@
 import os
+import threading
+import uuid
 import requests
-import json
 from datetime import datetime
 from dotenv import load_dotenv
-import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from payment_journal import get_journal
+from transfer_outbox import TransferOutbox
 
 load_dotenv()
 BACKEND_URL = os.getenv("BACKEND_URL")
 if not BACKEND_URL:
     raise RuntimeError("BACKEND_URL is not set")
 
-LOG_FILE = "data/payment_log.json"
-LOG_LOCK = threading.Lock()
+# One keep-alive session for every backend call; retries are short and bounded,
+# anything longer is the outbox's job
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "4"))
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", "2"))
+BACKEND_RETRY_BACKOFF = float(os.getenv("BACKEND_RETRY_BACKOFF", "0.3"))
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "3"))
+BACKEND_READ_TIMEOUT = float(os.getenv("BACKEND_READ_TIMEOUT", "15"))
+
+# Backend answers that mean "not decided yet, send the same key again"
+RETRYABLE_STATUSES = (409, 429, 500, 502, 503, 504)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Returns this process's pooled backend session, creating it on first use."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                retry = Retry(
+                    total=BACKEND_RETRIES,
+                    backoff_factor=BACKEND_RETRY_BACKOFF,
+                    status_forcelist=(502, 503, 504),
+                    # Safe for POST: every transfer carries an idempotency key
+                    allowed_methods=None,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BACKEND_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session, _session_pid = session, os.getpid()
+    return _session
 
 def log_payment(amount, currency, recipient, status, **kwargs):
     record = {
@@ -22,18 +60,7 @@ def log_payment(amount, currency, recipient, status, **kwargs):
         "status": status
     }
     record.update(kwargs)
-    try:
-        LOG_LOCK.acquire()
-        try:
-            with open(LOG_FILE, "r") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            data = []
-        data.append(record)
-        with open(LOG_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-    finally:
-        LOG_LOCK.release()
+    get_journal().append(record)
 
 def register_user(stripe_customer_id, name):
     """Simulated backend call to register user (usually store on backend)."""
@@ -50,44 +77,96 @@ def validate_recipient(recipient_account_id):
     else:
         return {"status": "error", "valid": False, "error": "Invalid Stripe Connect Account ID"}
 
-def send_transfer(sender_customer_id, recipient_account_id, amount_cents):
-    """
-    Call backend (Stripe) to create a destination charge from sender customer to recipient connect account.
-    """
+def _post_transfer(sender_customer_id, recipient_account_id, amount_cents, idempotency_key):
+    """One delivery attempt. Returns (data, retryable); nothing is logged here."""
+    payload = {
+        "sender_customer_id": sender_customer_id,
+        "recipient_account_id": recipient_account_id,
+        "amount_cents": amount_cents
+    }
+    try:
+        res = get_session().post(
+            f"{BACKEND_URL}/charge_and_transfer",
+            json=payload,
+            headers={"Idempotency-Key": idempotency_key},
+            timeout=(BACKEND_CONNECT_TIMEOUT, BACKEND_READ_TIMEOUT)
+        )
+    except requests.RequestException as e:
+        return {"status": "error", "error": str(e)}, True
+
     try:
-        payload = {
-            "sender_customer_id": sender_customer_id,
-            "recipient_account_id": recipient_account_id,
-            "amount_cents": amount_cents
-        }
-        res = requests.post(f"{BACKEND_URL}/charge_and_transfer", json=payload, timeout=15)
         data = res.json()
+    except ValueError:
+        data = {"status": "error", "error": res.text or f"HTTP {res.status_code}"}
+    if res.status_code == 200 and data.get("status") == "success":
+        return data, False
+    data.setdefault("error", res.text)
+    data["status"] = "error"
+    return data, res.status_code in RETRYABLE_STATUSES
 
-        if res.status_code == 200 and data.get("status") == "success":
-            log_payment(
-                amount=amount_cents / 100,
-                currency="GBP",
-                recipient=recipient_account_id,
-                status="Completed",
-                charge_id=data.get("charge_id")
-            )
-        else:
-            log_payment(
-                amount=amount_cents / 100,
-                currency="GBP",
-                recipient=recipient_account_id,
-                status="Failed",
-                error=data.get("error") or res.text
-            )
-        return data
-
-    except Exception as e:
+def _log_transfer(amount_cents, recipient_account_id, data):
+    if data.get("status") == "success":
+        log_payment(
+            amount=amount_cents / 100,
+            currency="GBP",
+            recipient=recipient_account_id,
+            status="Completed",
+            charge_id=data.get("charge_id")
+        )
+    else:
         log_payment(
             amount=amount_cents / 100,
             currency="GBP",
             recipient=recipient_account_id,
-            status="Error",
-            error=str(e)
+            status="Failed",
+            error=data.get("error")
         )
-        print("[ERROR] Transfer request failed:", e)
-        return {"status": "error", "error": str(e)}
+
+def send_transfer(sender_customer_id, recipient_account_id, amount_cents, idempotency_key=None):
+    """
+    Call backend (Stripe) to create a destination charge from sender customer to recipient connect account.
+    Pass the same idempotency_key when retrying a transfer so it is charged at most once.
+    Blocks until the backend answers; the kiosk uses queue_transfer instead.
+    """
+    idempotency_key = idempotency_key or uuid.uuid4().hex
+    data, _ = _post_transfer(sender_customer_id, recipient_account_id, amount_cents, idempotency_key)
+    if data.get("status") != "success":
+        print("[ERROR] Transfer request failed:", data.get("error"))
+    _log_transfer(amount_cents, recipient_account_id, data)
+    return data
+
+# === Outbox ===
+def _deliver(transfer):
+    data, retryable = _post_transfer(
+        transfer["sender_customer_id"], transfer["recipient_account_id"],
+        transfer["amount_cents"], transfer["idempotency_key"]
+    )
+    if not retryable:
+        _log_transfer(transfer["amount_cents"], transfer["recipient_account_id"], data)
+    return data, retryable
+
+_outbox = None
+
+def get_outbox():
+    """Returns the transfer outbox, starting its drainer (which also resumes transfers left from a previous run)."""
+    global _outbox
+    if _outbox is None:
+        _outbox = TransferOutbox(_deliver)
+    _outbox.start()
+    return _outbox
+
+def queue_transfer(sender_customer_id, recipient_account_id, amount_cents, idempotency_key=None, wait=5.0):
+    """
+    Durably queues a transfer and waits up to `wait` seconds for it to go through.
+    Returns the backend's answer if it came in time, otherwise
+    {"status": "queued", "transfer_id", "idempotency_key"}; the transfer is then
+    delivered in the background (see get_outbox().add_listener).
+    """
+    idempotency_key = idempotency_key or uuid.uuid4().hex
+    outbox = get_outbox()
+    transfer = outbox.put(sender_customer_id, recipient_account_id, amount_cents, idempotency_key)
+    if wait > 0:
+        transfer = outbox.wait(transfer["id"], wait)
+    if transfer["result"] is not None:
+        return transfer["result"]
+    return {"status": "queued", "transfer_id": transfer["id"], "idempotency_key": idempotency_key}
@@ -0,0 +1,284 @@
+"""
+Offline benchmark of the /api/verify and /api/pay hot path.
+
+    python benchmark.py [--sizes 1000,100000,1000000] [--requests 500] [--output bench.json]
+    python benchmark.py --compare old.json --output new.json
+
+Nothing external is needed. It uses a deterministic stub embedder instead of
+DeepFace, a SQLite file instead of Postgres, and a mocked Stripe client. For
+each synthetic gallery size it times every stage of a request on its own:
+
+    decode      image bytes -> RGB array (image_decode.decode_image)
+    embed       embedders.StubEmbedder (plus --embed-ms of simulated model time)
+    match       FaceGallery.match, optionally through the IVF index
+    db_fetch    primary-key lookup of the matched user
+    charge      mocked stripe.PaymentIntent.create (plus --stripe-ms)
+    journal     PaymentJournal.append
+    gallery_load  full users table read + bulk decode, as in load_gallery()
+
+It reports p50/p99/mean latency and single-thread throughput per stage and for
+the whole verify and pay requests. Results are saved as JSON with the git
+commit, so runs of different commits can be compared with --compare.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from ann_index import IVFIndex
+from embedders import StubEmbedder
+from embedding_format import decode_embedding, decode_embeddings, encode_embedding
+from face_gallery import EMBEDDING_DIM, FaceGallery
+from image_decode import decode_image
+from payment_journal import PaymentJournal
+
+THRESHOLD = 10
+
+
+# === Stand-ins ===
+class _PaymentIntent:
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self._count = 0
+
+    def create(self, **kwargs):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        self._count += 1
+        return type("PaymentIntent", (), {"id": f"pi_bench_{self._count}", "status": "succeeded"})()
+
+
+class MockStripe:
+    """Just enough of the stripe module for charge_and_transfer_internal's call."""
+
+    def __init__(self, latency_ms=0.0):
+        self.PaymentIntent = _PaymentIntent(latency_ms)
+
+
+# === Synthetic data ===
+def make_gallery(size, seed):
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((size, EMBEDDING_DIM), dtype=np.float32)
+    user_ids = [f"cus_bench{i:07d}" for i in range(size)]
+    return user_ids, matrix
+
+
+def make_images(count, width, height, seed):
+    """JPEG frames with smooth content plus noise, so they compress like photos."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    images = []
+    for _ in range(count):
+        fx, fy, phase = rng.uniform(0.005, 0.03, 2).tolist() + [rng.uniform(0, 6.28)]
+        base = 127 + 80 * np.sin(x * fx + phase)[..., None] * np.cos(y * fy)[..., None]
+        pixels = base + rng.normal(0, 12, (height, width, 3))
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def make_database(path, user_ids, matrix):
+    db = sqlite3.connect(path)
+    db.execute("""
+        CREATE TABLE users (
+            user_id TEXT PRIMARY KEY, name TEXT, stripe_customer_id TEXT, face_embedding BLOB NOT NULL
+        )
+    """)
+    db.executemany(
+        "INSERT INTO users VALUES (?, ?, ?, ?)",
+        ((user_id, f"User {i}", user_id, encode_embedding(matrix[i])) for i, user_id in enumerate(user_ids)),
+    )
+    db.commit()
+    return db
+
+
+# === Measurement ===
+def summarize(samples_ns):
+    samples = np.asarray(samples_ns, dtype=np.float64) / 1e6
+    total_s = samples.sum() / 1000
+    return {
+        "count": int(samples.size),
+        "p50_ms": round(float(np.percentile(samples, 50)), 4),
+        "p99_ms": round(float(np.percentile(samples, 99)), 4),
+        "mean_ms": round(float(samples.mean()), 4),
+        "throughput_per_s": round(samples.size / total_s, 1) if total_s else None,
+    }
+
+
+def load_gallery_from(db):
+    rows = db.execute("SELECT user_id, name, stripe_customer_id, face_embedding FROM users").fetchall()
+    user_ids, names, stripe_ids, blobs = zip(*rows)
+    return FaceGallery.from_arrays(list(user_ids), list(names), list(stripe_ids), decode_embeddings(blobs))
+
+
+def bench_size(size, args, images, workdir):
+    print(f"[BENCH] Gallery of {size} users")
+    user_ids, matrix = make_gallery(size, args.seed)
+    db = make_database(os.path.join(workdir, f"users-{size}.sqlite3"), user_ids, matrix)
+    embedder = StubEmbedder(matrix, match_rate=args.match_rate, cost_ms=args.embed_ms)
+    stripe = MockStripe(args.stripe_ms)
+    journal = PaymentJournal(directory=os.path.join(workdir, f"journal-{size}"), fsync=args.journal_fsync)
+
+    timings = {stage: [] for stage in ("decode", "embed", "match", "db_fetch", "charge", "journal", "verify", "pay")}
+    load_times = []
+    for _ in range(args.load_repeats if size < 1_000_000 else 1):
+        started = time.perf_counter_ns()
+        gallery = load_gallery_from(db)
+        load_times.append(time.perf_counter_ns() - started)
+
+    if args.index == "ivf":
+        started = time.perf_counter()
+        nlist = max(1, int(4 * np.sqrt(size)))
+        matrix_snapshot, snapshot_ids = gallery.snapshot()
+        index = IVFIndex.train(matrix_snapshot, nlist=nlist, nprobe=args.nprobe, seed=args.seed)
+        index.build(matrix_snapshot, len(snapshot_ids))
+        gallery.attach_index(index)
+        print(f"[BENCH]   IVF index ({nlist} lists) trained in {time.perf_counter() - started:.1f}s")
+
+    matched = 0
+    for i in range(args.warmup + args.requests):
+        image_bytes = images[i % len(images)]
+        stage = {}
+        clock = time.perf_counter_ns
+
+        t0 = clock()
+        image = decode_image(image_bytes)
+        t1 = clock()
+        embedding = embedder.embed(image)
+        t2 = clock()
+        user = gallery.match(embedding, threshold=THRESHOLD)
+        t3 = clock()
+        stage.update(decode=t1 - t0, embed=t2 - t1, match=t3 - t2)
+
+        if user is not None:
+            t4 = clock()
+            row = db.execute(
+                "SELECT name, stripe_customer_id, face_embedding FROM users WHERE user_id = ?", (user["user_id"],)
+            ).fetchone()
+            decode_embedding(row[2])
+            t5 = clock()
+            intent = stripe.PaymentIntent.create(
+                amount=1000, currency="gbp", customer=user["user_id"], payment_method_types=["card"],
+                payment_method="pm_card_visa", off_session=True, confirm=True,
+                transfer_data={"destination": "acct_bench"}, idempotency_key=f"bench-{i}",
+            )
+            t6 = clock()
+            journal.append({
+                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "amount": 10.0, "currency": "GBP",
+                "to": "acct_bench", "status": "Completed", "charge_id": intent.id,
+            })
+            t7 = clock()
+            stage.update(db_fetch=t5 - t4, charge=t6 - t5, journal=t7 - t6)
+
+        if i < args.warmup:
+            continue
+        for name, value in stage.items():
+            timings[name].append(value)
+        timings["verify"].append(stage["decode"] + stage["embed"] + stage["match"])
+        if user is not None:
+            matched += 1
+            timings["pay"].append(sum(stage.values()))
+
+    journal.close()
+    db.close()
+    result = {name: summarize(values) for name, values in timings.items() if values}
+    result["gallery_load"] = summarize(load_times)
+    result["match_rate"] = round(matched / args.requests, 4)
+    return result
+
+
+# === Reporting ===
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    for size, stages in results.items():
+        print(f"\n== {size} users (match rate {stages['match_rate']:.0%}) ==")
+        print(f"{'stage':<14}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'ops/s':>12}")
+        for name, s in stages.items():
+            if isinstance(s, dict):
+                print(f"{name:<14}{s['p50_ms']:>10.3f}{s['p99_ms']:>10.3f}{s['mean_ms']:>10.3f}{s['throughput_per_s']:>12}")
+
+
+def print_comparison(previous, results):
+    print(f"\n== Compared with {previous['meta'].get('commit')} ({previous['meta']['timestamp']}) ==")
+    print(f"{'size':<10}{'stage':<14}{'p50 before':>12}{'p50 now':>10}{'p99 before':>12}{'p99 now':>10}")
+    for size, stages in results.items():
+        old_stages = previous["results"].get(size, {})
+        for name, s in stages.items():
+            old = old_stages.get(name)
+            if isinstance(s, dict) and isinstance(old, dict):
+                print(f"{size:<10}{name:<14}{old['p50_ms']:>12.3f}{s['p50_ms']:>10.3f}"
+                      f"{old['p99_ms']:>12.3f}{s['p99_ms']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the verify/pay hot path")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma-separated gallery sizes")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--images", type=int, default=32, help="distinct synthetic frames")
+    parser.add_argument("--image-size", default="640x480", help="WIDTHxHEIGHT of the synthetic frames")
+    parser.add_argument("--match-rate", type=float, default=0.9)
+    parser.add_argument("--embed-ms", type=float, default=0.0, help="simulated model time per embedding")
+    parser.add_argument("--stripe-ms", type=float, default=0.0, help="simulated Stripe round trip")
+    parser.add_argument("--journal-fsync", choices=("always", "interval", "never"), default="interval")
+    parser.add_argument("--index", choices=("none", "ivf"), default="none")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--load-repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    images = make_images(args.images, width, height, args.seed)
+    workdir = tempfile.mkdtemp(prefix="facepay-bench-")
+    try:
+        results = {}
+        for size in (int(s) for s in args.sizes.split(",")):
+            results[str(size)] = bench_size(size, args, images, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Bulk enrollment of an existing customer base, instead of one /api/register call
+per person.
+
+    python bulk_enroll.py photos/                 # photos/<stripe_customer_id>[__<name>].jpg
+    python bulk_enroll.py customers.csv           # columns: image, stripe_customer_id, name
+
+Images are embedded by a pool of worker processes, each running Facenet on
+batches of faces. Embeddings are streamed into a temporary staging table with
+COPY and moved into users with INSERT ... ON CONFLICT DO NOTHING, so customers
+that are already enrolled are left untouched.
+
+Images without exactly one detectable face are written to a failures CSV.
+Progress is saved to a checkpoint file after every committed batch; running the
+same command again continues where the last run stopped.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+from dotenv import load_dotenv
+
+from embedding_format import encode_embedding
+from image_decode import decode_image
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+_face_utils = None
+
+
+# === Input ===
+def read_directory(path):
+    """Yields (image_path, stripe_customer_id, name) for <stripe_customer_id>[__<name>].<ext> files."""
+    for filename in sorted(os.listdir(path)):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        stripe_customer_id, _, name = stem.partition("__")
+        yield os.path.join(path, filename), stripe_customer_id, name or stripe_customer_id
+
+
+def read_manifest(path):
+    """Yields (image_path, stripe_customer_id, name) from a CSV manifest; image paths are relative to it."""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            stripe_customer_id = row["stripe_customer_id"].strip()
+            name = (row.get("name") or "").strip() or stripe_customer_id
+            yield os.path.join(base, row["image"]), stripe_customer_id, name
+
+
+def read_source(source):
+    return list(read_directory(source) if os.path.isdir(source) else read_manifest(source))
+
+
+# === Embedding (runs in worker processes) ===
+def _init_worker(threads):
+    """Loads the model once per worker; TensorFlow / ONNX Runtime are only imported in the workers."""
+    global _face_utils
+    os.environ.setdefault("TF_NUM_INTRAOP_THREADS", str(threads))
+    os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+    os.environ.setdefault("ONNX_THREADS", str(threads))
+    import face_utils
+    # Always embeds in-process, even when EMBEDDING_SERVICE is set
+    face_utils.warm_up_local_model()
+    _face_utils = face_utils
+
+
+def embed_chunk(chunk):
+    """
+    Embeds one chunk of (image_path, stripe_customer_id, name) entries.
+    Returns (encoded embedding, None) or (None, reason) per entry, in order.
+    """
+    images, results = [], [None] * len(chunk)
+    for i, (image_path, _, _) in enumerate(chunk):
+        try:
+            with open(image_path, "rb") as f:
+                images.append((i, decode_image(f.read())))
+        except (OSError, ValueError) as e:
+            results[i] = (None, f"unreadable image: {e}")
+
+    embeddings = _face_utils.embed_faces([image for _, image in images])
+    for (i, _), embedding in zip(images, embeddings):
+        if isinstance(embedding, Exception):
+            results[i] = (None, str(embedding))
+        else:
+            results[i] = (encode_embedding(embedding), None)
+    return results
+
+
+# === Loading ===
+def _copy_text(value):
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def insert_rows(conn, rows):
+    """
+    COPYs (stripe_customer_id, name, embedding bytes) rows into the staging table and
+    moves them into users. Returns the number of newly enrolled users. Commits.
+    """
+    buffer = io.StringIO()
+    for stripe_customer_id, name, blob in rows:
+        user_id = _copy_text(stripe_customer_id)
+        # COPY text format: bytea in hex form, with its backslash escaped
+        buffer.write(f"{user_id}\t{_copy_text(name)}\t{user_id}\t\\\\x{blob.hex()}\n")
+    buffer.seek(0)
+
+    with conn.cursor() as cur:
+        cur.copy_expert("COPY enroll_staging (user_id, name, stripe_customer_id, face_embedding) FROM STDIN", buffer)
+        cur.execute("""
+            INSERT INTO users (user_id, name, stripe_customer_id, face_embedding)
+            SELECT user_id, name, stripe_customer_id, face_embedding FROM enroll_staging
+            ON CONFLICT (user_id) DO NOTHING
+        """)
+        inserted = cur.rowcount
+    conn.commit()
+    return inserted
+
+
+# === Checkpoint and report ===
+def load_checkpoint(path, source):
+    if not os.path.exists(path):
+        return {"source": os.path.abspath(source), "next": 0, "enrolled": 0, "existing": 0, "failed": 0}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["source"] != os.path.abspath(source):
+        raise SystemExit(f"{path} belongs to {checkpoint['source']}; pass a different --checkpoint")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def append_failures(path, failures):
+    if not failures:
+        return
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["image", "stripe_customer_id", "reason"])
+        writer.writerows(failures)
+
+
+# === Main ===
+def enroll(source, workers, batch_size, copy_rows, checkpoint_path, failures_path):
+    entries = read_source(source)
+    checkpoint = load_checkpoint(checkpoint_path, source)
+    start = checkpoint["next"]
+    if start:
+        print(f"[ENROLL] Resuming at entry {start} of {len(entries)}")
+
+    chunks = [entries[i:i + batch_size] for i in range(start, len(entries), batch_size)]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE enroll_staging (
+                    user_id TEXT, name TEXT, stripe_customer_id TEXT, face_embedding BYTEA
+                ) ON COMMIT DELETE ROWS
+            """)
+        conn.commit()
+
+        rows, failures = [], []
+        position, started_at = start, time.monotonic()
+
+        def flush():
+            # Rows and failures are only checkpointed once the rows are committed
+            inserted = insert_rows(conn, rows) if rows else 0
+            append_failures(failures_path, failures)
+            checkpoint.update(
+                next=position,
+                enrolled=checkpoint["enrolled"] + inserted,
+                existing=checkpoint["existing"] + len(rows) - inserted,
+                failed=checkpoint["failed"] + len(failures),
+            )
+            save_checkpoint(checkpoint_path, checkpoint)
+            rows.clear()
+            failures.clear()
+            rate = (position - start) / max(time.monotonic() - started_at, 1e-9)
+            print(f"[ENROLL] {position}/{len(entries)} processed, {checkpoint['enrolled']} enrolled, "
+                  f"{checkpoint['failed']} failed ({rate:.1f} images/s)")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads,)) as pool:
+            for chunk, results in zip(chunks, pool.map(embed_chunk, chunks)):
+                for (image_path, stripe_customer_id, name), (blob, reason) in zip(chunk, results):
+                    if blob is None:
+                        failures.append((image_path, stripe_customer_id, reason))
+                    else:
+                        rows.append((stripe_customer_id, name, blob))
+                position += len(chunk)
+                if len(rows) >= copy_rows:
+                    flush()
+        flush()
+    finally:
+        conn.close()
+
+    print(f"✅ Enrolled {checkpoint['enrolled']} users ({checkpoint['existing']} already enrolled, "
+          f"{checkpoint['failed']} failed; see {failures_path}).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enroll many customers from a directory of photos or a CSV manifest")
+    parser.add_argument("source", help="directory of <stripe_customer_id>[__<name>].jpg files, or a CSV manifest")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="embedding processes (each loads its own copy of Facenet)")
+    parser.add_argument("--batch-size", type=int, default=32, help="images per Facenet forward pass")
+    parser.add_argument("--copy-rows", type=int, default=2000, help="rows per COPY / commit")
+    parser.add_argument("--checkpoint", default="bulk_enroll.checkpoint.json")
+    parser.add_argument("--failures", default="bulk_enroll.failures.csv")
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        raise Exception("DATABASE_URL is not set in your environment!")
+    enroll(args.source, args.workers, args.batch_size, args.copy_rows, args.checkpoint, args.failures)
@@ -0,0 +1,150 @@
+"""
+Measures what a quantized gallery (GALLERY_PRECISION=int8) changes
+compared with the float32 matcher, before switching it on.
+
+    python calibrate_gallery.py                      # embeddings from the users table
+    python calibrate_gallery.py --synthetic 1000000  # random Facenet-sized vectors
+
+Probes are enrolled embeddings with Gaussian noise added so that they land at
+given distances from the original (around the match threshold), plus
+impostor probes built from random vectors. Each probe is matched by the float32
+gallery and by each quantized one, and the report counts decisions that differ
+at the threshold (wrong user, accept vs reject), the error of the quantized
+distance estimate, scan time and memory held in RAM.
+
+Quantization is a memory saving, not a speed-up: the scan decodes codes back
+to float32 before each BLAS product, so expect int8 to scan at about the same
+speed as float32. The scan times here show it for a given host.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from db_pool import connection
+from embedding_format import decode_embeddings
+from face_gallery import EMBEDDING_DIM, FaceGallery, quantize
+
+
+def load_embeddings():
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, face_embedding FROM users")
+            rows = cur.fetchall()
+    if not rows:
+        raise SystemExit("The users table is empty; use --synthetic N")
+    user_ids, blobs = zip(*rows)
+    return list(user_ids), decode_embeddings(blobs)
+
+
+def make_probes(matrix, count, distances, impostor_share, rng):
+    """Returns (probes, source rows); impostor probes have source -1."""
+    n, dim = matrix.shape
+    probes, sources = [], []
+    genuine = int(round(count * (1 - impostor_share)))
+    for i in range(genuine):
+        row = int(rng.integers(n))
+        sigma = distances[i % len(distances)] / np.sqrt(dim)
+        probes.append(matrix[row] + rng.normal(0, sigma, dim).astype(np.float32))
+        sources.append(row)
+    # Impostors: random vectors with the gallery's per-dimension spread
+    mean, std = matrix.mean(axis=0), matrix.std(axis=0)
+    for _ in range(count - genuine):
+        probes.append((mean + std * rng.standard_normal(dim)).astype(np.float32))
+        sources.append(-1)
+    return probes, sources
+
+
+def resident_bytes(gallery):
+    n = len(gallery)
+    if gallery.precision == "float32":
+        return n * gallery.dim * 4 + n * 4
+    return n * gallery.dim * np.dtype(gallery.precision).itemsize + n * 4 + n * 4
+
+
+def calibrate(user_ids, matrix, precisions, probes, threshold):
+    names = [None] * len(user_ids)
+    baseline = FaceGallery.from_arrays(user_ids, names, names, matrix)
+    reference = [baseline.match(p, threshold=threshold) for p in probes]
+
+    report = {}
+    for precision in ("float32",) + tuple(precisions):
+        gallery = baseline if precision == "float32" else FaceGallery.from_arrays(
+            user_ids, names, names, matrix, precision=precision)
+
+        started = time.perf_counter()
+        results = [gallery.match(p, threshold=threshold) for p in probes]
+        scan_ms = (time.perf_counter() - started) * 1000 / len(probes)
+
+        other_user = accept_flips = reject_flips = 0
+        for ref, res in zip(reference, results):
+            if ref is None and res is not None:
+                accept_flips += 1
+            elif ref is not None and res is None:
+                reject_flips += 1
+            elif ref is not None and ref["user_id"] != res["user_id"]:
+                other_user += 1
+
+        entry = {
+            "scan_ms": round(scan_ms, 3),
+            "resident_mb": round(resident_bytes(gallery) / 2**20, 1),
+            "accepted": sum(r is not None for r in results),
+            "decisions_changed": accept_flips + reject_flips + other_user,
+            "now_accepted": accept_flips,
+            "now_rejected": reject_flips,
+            "different_user": other_user,
+        }
+        if precision != "float32":
+            # How far the scan's estimate of ||g - q|| (exact norms, quantized dot
+            # products) is from the exact distance
+            codes, scales = quantize(matrix, precision)
+            approx = codes.astype(np.float32) * scales[:, None]
+            sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+            errors = []
+            for p in probes[:50]:
+                exact = np.sqrt(((matrix - p) ** 2).sum(axis=1))
+                estimate = np.sqrt(np.maximum(sq_norms - 2.0 * (approx @ p) + p @ p, 0))
+                errors.append(np.abs(estimate - exact))
+            errors = np.concatenate(errors)
+            entry["distance_error_mean"] = round(float(errors.mean()), 5)
+            entry["distance_error_max"] = round(float(errors.max()), 5)
+        report[precision] = entry
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare quantized gallery matching with float32")
+    parser.add_argument("--synthetic", type=int, help="use N random vectors instead of the users table")
+    parser.add_argument("--precisions", default="int8")
+    parser.add_argument("--threshold", type=float, default=10)
+    parser.add_argument("--probes", type=int, default=2000)
+    parser.add_argument("--distances", default="2,4,6,8,9,9.5,10,10.5,11,12",
+                        help="distances of genuine probes from their enrolled embedding")
+    parser.add_argument("--impostors", type=float, default=0.2, help="share of impostor probes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report as JSON")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.synthetic:
+        matrix = rng.standard_normal((args.synthetic, EMBEDDING_DIM), dtype=np.float32)
+        user_ids = [f"synthetic_{i}" for i in range(args.synthetic)]
+    else:
+        user_ids, matrix = load_embeddings()
+    distances = [float(d) for d in args.distances.split(",")]
+    probes, _ = make_probes(matrix, args.probes, distances, args.impostors, rng)
+
+    print(f"[CALIBRATE] {len(user_ids)} users, {len(probes)} probes, threshold {args.threshold}")
+    report = calibrate(user_ids, matrix, [p for p in args.precisions.split(",") if p], probes, args.threshold)
+
+    print(f"{'precision':<10}{'scan ms':>9}{'RAM MB':>9}{'accepted':>10}{'changed':>9}"
+          f"{'+accept':>9}{'-accept':>9}{'other':>7}{'err mean':>10}{'err max':>9}")
+    for precision, r in report.items():
+        print(f"{precision:<10}{r['scan_ms']:>9.2f}{r['resident_mb']:>9.1f}{r['accepted']:>10}"
+              f"{r['decisions_changed']:>9}{r['now_accepted']:>9}{r['now_rejected']:>9}{r['different_user']:>7}"
+              f"{r.get('distance_error_mean', 0):>10.4f}{r.get('distance_error_max', 0):>9.4f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"users": len(user_ids), "probes": len(probes), "threshold": args.threshold,
+                       "results": report}, f, indent=2)
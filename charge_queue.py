@@ -0,0 +1,248 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import Json, RealDictCursor
+from dotenv import load_dotenv
+
+from db_pool import connection
+from idempotency import IdempotencyConflict
+
+load_dotenv()
+
+# Threads making Stripe calls per web worker; they mostly wait on the network
+CHARGE_WORKERS = int(os.getenv("CHARGE_WORKERS", "8"))
+# How long finished jobs stay in this process's memory for fast status lookups
+CHARGE_JOB_TTL = float(os.getenv("CHARGE_JOB_TTL", "600"))
+# A pending job whose claim is older than this is taken to have lost its worker
+# (crash, restart) and is charged again by another one; keep it well above the
+# longest a Stripe call can take
+CHARGE_LEASE_SECONDS = float(os.getenv("CHARGE_LEASE_SECONDS", "300"))
+# Attempts after which a job that keeps losing its worker is marked failed
+CHARGE_MAX_ATTEMPTS = int(os.getenv("CHARGE_MAX_ATTEMPTS", "3"))
+RECLAIM_INTERVAL = 30
+RECLAIM_BATCH = 100
+POLL_INTERVAL = 0.25
+
+
+class _Job:
+    __slots__ = ("done", "result", "finished_at")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.finished_at = None
+
+
+class ChargeQueue:
+    """
+    Runs payment charges on a bounded pool of I/O threads so request workers can
+    return as soon as the face has been matched.
+
+    Job state is written to the payment_jobs table, so a status request answered
+    by a different gunicorn worker (or host) still finds it; the submitting
+    process also keeps it in memory to answer its own long-polls without the DB.
+
+    Each job row carries its payload and a lease (claimed_at). Every process runs
+    a reclaimer (see start_reclaimer) that re-queues jobs whose lease has expired,
+    so a worker dying mid-charge does not leave its jobs pending forever. The
+    job's payment_id doubles as the Stripe idempotency key when the client sent
+    none, so a charge that went through before the crash is not made twice.
+    """
+
+    def __init__(self, charge, max_workers=CHARGE_WORKERS, ttl=CHARGE_JOB_TTL,
+                 lease=CHARGE_LEASE_SECONDS, max_attempts=CHARGE_MAX_ATTEMPTS):
+        self.charge = charge
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._executor = None
+        self._pid = None
+        self._reclaimer_pid = None
+
+    def _get_executor(self):
+        # Executor threads do not survive fork; each worker gets its own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._jobs = {}
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="charge")
+            return self._executor
+
+    def submit(self, payload, idempotency_key=None, fingerprint=None):
+        """
+        Records a pending job, queues the charge and returns its payment_id.
+        If a job already exists for idempotency_key (from any worker), nothing is
+        queued and that job's payment_id is returned instead; IdempotencyConflict
+        if it was created with a different fingerprint.
+        """
+        payment_id = uuid.uuid4().hex
+        payload = {**payload, "idempotency_key": payload.get("idempotency_key") or payment_id}
+        if not self._create(payment_id, idempotency_key, fingerprint, payload):
+            return self._existing(idempotency_key, fingerprint)
+        self._queue(payment_id, payload)
+        return payment_id
+
+    def _queue(self, payment_id, payload):
+        executor = self._get_executor()
+        job = _Job()
+        with self._lock:
+            self._expire()
+            self._jobs[payment_id] = job
+        executor.submit(self._run, payment_id, job, payload)
+
+    def run(self, payload, idempotency_key=None, fingerprint=None):
+        """
+        Records a pending job and charges it in the calling thread (PAY_ASYNC off).
+        Returns (payment_id, result); result is None when a job already existed
+        for idempotency_key, whose payment_id is returned instead (as in submit).
+        """
+        payment_id = uuid.uuid4().hex
+        payload = {**payload, "idempotency_key": payload.get("idempotency_key") or payment_id}
+        if not self._create(payment_id, idempotency_key, fingerprint, payload):
+            return self._existing(idempotency_key, fingerprint), None
+        return payment_id, self._charge(payment_id, payload)
+
+    @staticmethod
+    def _create(payment_id, idempotency_key, fingerprint, payload):
+        """Inserts a pending job, claimed by this process; False if one already exists for idempotency_key."""
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO payment_jobs
+                        (payment_id, status, result, idempotency_key, fingerprint, payload, claimed_at, attempts)
+                    VALUES (%s, 'pending', %s, %s, %s, %s, now(), 1)
+                    ON CONFLICT (idempotency_key) DO NOTHING
+                    RETURNING payment_id
+                """, (payment_id, Json({"status": "pending"}), idempotency_key, fingerprint, Json(payload)))
+                return cur.fetchone() is not None
+
+    def find_by_key(self, idempotency_key):
+        """Returns (payment_id, fingerprint) of the job created with this key, or None."""
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT payment_id, fingerprint FROM payment_jobs WHERE idempotency_key = %s
+                """, (idempotency_key,))
+                return cur.fetchone()
+
+    def _existing(self, idempotency_key, fingerprint):
+        """payment_id of the job that won the insert for this key, checked against our fingerprint."""
+        payment_id, existing_fingerprint = self.find_by_key(idempotency_key)
+        if existing_fingerprint != fingerprint:
+            raise IdempotencyConflict("Idempotency key was used with different parameters")
+        return payment_id
+
+    def _run(self, payment_id, job, payload):
+        result = self._charge(payment_id, payload)
+        job.result = result
+        job.finished_at = time.monotonic()
+        job.done.set()
+
+    def _charge(self, payment_id, payload):
+        """Runs the charge and records its result on the job row."""
+        try:
+            result = self.charge(payload)
+        except Exception as e:
+            result = {"status": "error", "error": str(e)}
+        status = "success" if result.get("status") == "success" else "error"
+
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    # A reclaimed duplicate may finish second: the first result stands
+                    cur.execute("""
+                        UPDATE payment_jobs SET status = %s, result = %s, updated_at = now()
+                        WHERE payment_id = %s AND status = 'pending'
+                    """, (status, Json(result), payment_id))
+        except Exception as e:
+            print(f"[ERROR] Could not record result of payment {payment_id}:", e)
+        return result
+
+    # === Leases ===
+    def start_reclaimer(self):
+        """Starts this process's reclaimer thread (once per process; call after fork)."""
+        with self._lock:
+            if self._reclaimer_pid == os.getpid():
+                return
+            self._reclaimer_pid = os.getpid()
+        threading.Thread(target=self._reclaim_loop, name="charge-reclaim", daemon=True).start()
+
+    def _reclaim_loop(self):
+        while True:
+            time.sleep(RECLAIM_INTERVAL)
+            try:
+                self.reclaim()
+            except Exception as e:
+                print("[CHARGES] Reclaiming expired jobs failed:", e)
+
+    def reclaim(self):
+        """
+        Takes over pending jobs whose lease has expired and queues them here; jobs
+        already tried max_attempts times are marked failed instead. Returns the
+        number re-queued. SKIP LOCKED lets every worker sweep at once without
+        two of them taking the same job.
+        """
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE payment_jobs SET status = 'error', result = %s, updated_at = now()
+                    WHERE status = 'pending' AND attempts >= %s
+                      AND claimed_at < now() - make_interval(secs => %s)
+                    RETURNING payment_id
+                """, (Json({"status": "error", "error": "Charge was interrupted; please try again"}),
+                      self.max_attempts, self.lease))
+                for (payment_id,) in cur.fetchall():
+                    print(f"[CHARGES] Giving up on payment {payment_id} after {self.max_attempts} attempts")
+
+                cur.execute("""
+                    UPDATE payment_jobs SET claimed_at = now(), attempts = attempts + 1, updated_at = now()
+                    WHERE payment_id IN (
+                        SELECT payment_id FROM payment_jobs
+                        WHERE status = 'pending' AND payload IS NOT NULL
+                          AND claimed_at < now() - make_interval(secs => %s)
+                        ORDER BY claimed_at
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING payment_id, payload
+                """, (self.lease, RECLAIM_BATCH))
+                reclaimed = cur.fetchall()
+
+        for payment_id, payload in reclaimed:
+            print(f"[CHARGES] Reclaimed payment {payment_id} from an expired lease")
+            self._queue(payment_id, payload)
+        return len(reclaimed)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        for payment_id in [p for p, j in self._jobs.items() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[payment_id]
+
+    def status(self, payment_id, wait=0):
+        """
+        Returns the job's result dict ({"status": "pending"} while running), waiting up
+        to `wait` seconds for it to finish. Returns None for an unknown payment_id.
+        """
+        with self._lock:
+            job = self._jobs.get(payment_id) if self._pid == os.getpid() else None
+        if job is not None:
+            job.done.wait(wait)
+            return job.result if job.done.is_set() else {"status": "pending"}
+
+        deadline = time.monotonic() + wait
+        while True:
+            with connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("SELECT status, result FROM payment_jobs WHERE payment_id = %s", (payment_id,))
+                    row = cur.fetchone()
+            if row is None:
+                return None
+            if row["status"] != "pending" or time.monotonic() >= deadline:
+                return row["result"]
+            time.sleep(POLL_INTERVAL)
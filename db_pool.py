@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Connections idle longer than this get a "SELECT 1" before being handed out
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", "30"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+_inherited = []
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+    Callers block (up to `timeout`) when all connections are checked out.
+    The pool notices when it is used in a forked child (e.g. a gunicorn worker
+    after preload) and starts over instead of sharing the parent's sockets.
+    """
+
+    def __init__(self, dsn, size=5, timeout=10.0, check_after=30.0):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, returned_at)
+        self._open = 0
+        self.stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "connects": 0,
+            "discarded": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Never close the parent's connections from the child, not even by letting
+            # them be garbage collected: that sends a terminate message on a socket
+            # the parent is still using. Park them for the life of the process.
+            _inherited.extend(conn for conn, _ in self._idle)
+            self._reset()
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        self._check_fork()
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    conn = None
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise PoolTimeout(f"no database connection free after {self.timeout}s")
+                self._cond.wait(remaining)
+
+        if conn is not None and not self._healthy(conn, time.monotonic() - returned_at):
+            # Replace the dead connection but keep its slot
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+            conn = None
+            with self._cond:
+                self.stats["discarded"] += 1
+
+        connected = conn is None
+        if connected:
+            try:
+                conn = psycopg2.connect(self.dsn)
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self.stats["connects"] += int(connected)
+            self.stats["checkouts"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+        return conn
+
+    def putconn(self, conn, broken=False):
+        if self._pid != os.getpid():
+            return
+        if not broken and not conn.closed:
+            try:
+                # Leave no transaction open between checkouts
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._open -= 1
+            self.stats["discarded"] += 1
+            self._cond.notify()
+
+    def snapshot(self):
+        """Returns pool counters plus current in-use / idle connection counts."""
+        with self._cond:
+            stats = dict(self.stats)
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._open - len(self._idle)
+            stats["size"] = self.size
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DATABASE_URL, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, check_after=DB_POOL_CHECK_AFTER
+                )
+    return _pool
+
+
+@contextmanager
+def connection():
+    """
+    Checks a connection out of the shared pool for the duration of the block.
+    The transaction is committed if the block succeeds and rolled back otherwise.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, broken=broken)
+
+
+def pool_stats():
+    return get_pool().snapshot()
@@ -0,0 +1,152 @@
+"""
+Compares embedding backends (see embedders.py) on the same images before
+switching EMBEDDER_BACKEND:
+
+    python embedder_parity.py --images faces/ --candidates onnx,onnx-int8
+    python embedder_parity.py --images crops/ --no-detect
+    python embedder_parity.py --synthetic 200 --reference stub --candidates stub --no-detect
+
+Each backend runs in a fresh process so that its cold start (imports, model load,
+warm-up), per-image latency and peak RSS are measured on their own. Against the
+reference backend every candidate reports:
+  - detection disagreements (a face found by one backend and not the other)
+  - distance between the two embeddings of each image, and their cosine similarity
+  - match decisions: for pairs of images, whether "same person" (distance under
+    --threshold) comes out differently than with the reference
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+from image_decode import decode_image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def load_images(source, synthetic, seed):
+    if synthetic:
+        rng = np.random.default_rng(seed)
+        return [(f"synthetic_{i}", rng.integers(0, 256, (240, 240, 3), dtype=np.uint8)) for i in range(synthetic)]
+    images = []
+    for name in sorted(os.listdir(source)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(source, name), "rb") as f:
+                images.append((name, decode_image(f.read())))
+    if not images:
+        raise SystemExit(f"No images in {source}")
+    return images
+
+
+def run_backend(name, source, synthetic, seed, detect):
+    """Runs in its own process: returns embeddings (None where no face) and timings."""
+    started = time.perf_counter()
+    from embedders import create_embedder
+    embedder = create_embedder(name)
+    embedder.warm_up()
+    cold_start = time.perf_counter() - started
+
+    embeddings, latencies = [], []
+    for _, image in load_images(source, synthetic, seed):
+        t0 = time.perf_counter()
+        try:
+            embeddings.append(embedder.embed(image, detect=detect))
+        except ValueError:
+            embeddings.append(None)
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    return {
+        "embeddings": embeddings,
+        "cold_start_s": round(cold_start, 2),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "latency_p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def pairwise_distances(matrix):
+    sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+    return np.sqrt(np.maximum(sq_norms[:, None] - 2.0 * (matrix @ matrix.T) + sq_norms[None, :], 0))
+
+
+def compare(reference, candidate, threshold):
+    both = [i for i, (r, c) in enumerate(zip(reference, candidate)) if r is not None and c is not None]
+    report = {
+        "embedded_by_both": len(both),
+        "only_reference": sum(r is not None and c is None for r, c in zip(reference, candidate)),
+        "only_candidate": sum(r is None and c is not None for r, c in zip(reference, candidate)),
+    }
+    if not both:
+        return report
+
+    ref = np.stack([reference[i] for i in both]).astype(np.float32)
+    cand = np.stack([candidate[i] for i in both]).astype(np.float32)
+    distance = np.linalg.norm(ref - cand, axis=1)
+    cosine = (ref * cand).sum(axis=1) / (np.linalg.norm(ref, axis=1) * np.linalg.norm(cand, axis=1) + 1e-12)
+    report.update({
+        "distance_mean": round(float(distance.mean()), 4),
+        "distance_p99": round(float(np.percentile(distance, 99)), 4),
+        "distance_max": round(float(distance.max()), 4),
+        "cosine_mean": round(float(cosine.mean()), 5),
+        "cosine_min": round(float(cosine.min()), 5),
+    })
+
+    upper = np.triu_indices(len(both), k=1)
+    ref_same = pairwise_distances(ref)[upper] < threshold
+    cand_same = pairwise_distances(cand)[upper] < threshold
+    report.update({
+        "pairs": int(ref_same.size),
+        "pairs_matched_reference": int(ref_same.sum()),
+        "decisions_changed": int((ref_same != cand_same).sum()),
+        "now_matched": int((cand_same & ~ref_same).sum()),
+        "now_unmatched": int((ref_same & ~cand_same).sum()),
+    })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare embeddings and match decisions between embedding backends")
+    parser.add_argument("--images", help="directory of face images (.jpg/.png)")
+    parser.add_argument("--synthetic", type=int, help="use N random images instead (plumbing check only)")
+    parser.add_argument("--reference", default="deepface")
+    parser.add_argument("--candidates", default="onnx")
+    parser.add_argument("--no-detect", action="store_true", help="images are already tight face crops")
+    parser.add_argument("--threshold", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report as JSON")
+    args = parser.parse_args()
+    if not args.images and not args.synthetic:
+        parser.error("--images or --synthetic is required")
+
+    names = [args.reference] + [c for c in args.candidates.split(",") if c]
+    runs = []
+    # spawn: a clean process per backend, so imports and memory are its own
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        print(f"[PARITY] Running {name}...")
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(run_backend, (name, args.images, args.synthetic, args.seed, not args.no_detect)))
+
+    reference = runs[0]["embeddings"]
+    print(f"[PARITY] {len(reference)} images, reference {args.reference}, threshold {args.threshold}")
+    print(f"{'backend':<12}{'cold s':>8}{'p50 ms':>9}{'p99 ms':>9}{'RSS MB':>9}{'faces':>7}"
+          f"{'dist mean':>11}{'dist max':>10}{'cos min':>9}{'pairs':>9}{'changed':>9}")
+    report = []
+    for i, (name, run) in enumerate(zip(names, runs)):
+        entry = {"backend": name, **{key: value for key, value in run.items() if key != "embeddings"}}
+        entry["faces"] = sum(e is not None for e in run["embeddings"])
+        if i > 0:
+            entry.update(compare(reference, run["embeddings"], args.threshold))
+        report.append(entry)
+        print(f"{name:<12}{entry['cold_start_s']:>8.2f}{entry['latency_p50_ms']:>9.2f}{entry['latency_p99_ms']:>9.2f}"
+              f"{entry['peak_rss_mb']:>9.1f}{entry['faces']:>7}{entry.get('distance_mean', 0):>11.4f}"
+              f"{entry.get('distance_max', 0):>10.4f}{entry.get('cosine_min', 1):>9.4f}"
+              f"{entry.get('pairs', 0):>9}{entry.get('decisions_changed', 0):>9}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"images": len(reference), "reference": args.reference, "threshold": args.threshold,
+                       "detect": not args.no_detect, "results": report}, f, indent=2)
@@ -0,0 +1,280 @@
+"""
+Face embedding backends, selected with EMBEDDER_BACKEND:
+
+    deepface  Facenet on TensorFlow through DeepFace (the original path)
+    onnx      the same Facenet network exported to ONNX, run by ONNX Runtime on
+              CPU, with OpenCV's Haar cascades for detection; no TensorFlow import.
+              ONNX_INT8=true runs a dynamically int8-quantized copy of the model.
+    stub      deterministic vectors derived from the image bytes, for tests and
+              benchmark.py; no model at all
+
+Every backend produces Facenet-compatible 128-d vectors, so galleries and the
+match threshold carry over; embedder_parity.py measures how closely they agree.
+The deepface backend embeds single images with DeepFace.represent exactly as
+before the backends existed; only batched forward passes (EMBED_BATCH_SIZE > 1)
+run the Keras model directly, as they always have.
+ONNX Runtime is optional and only imported by the onnx backends
+(pip install onnxruntime). The ONNX model is supplied locally (it is not downloaded):
+
+    python embedders.py export-onnx models/facenet.onnx   # needs deepface and tf2onnx
+"""
+import os
+import sys
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+from face_gallery import EMBEDDING_DIM
+
+load_dotenv()
+
+EMBEDDER_BACKEND = os.getenv("EMBEDDER_BACKEND", "deepface").lower()
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "models/facenet.onnx")
+ONNX_INT8 = os.getenv("ONNX_INT8", "false").lower() == "true"
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))  # 0 = one per core
+
+FACENET_INPUT_SIZE = (160, 160)
+# Stub: strangers are ~16 apart, a re-captured face ~3 (see benchmark.py)
+STUB_PROBE_NOISE = 0.3
+
+
+# === Shared preprocessing ===
+def align_by_eyes(face_bgr, landmarks):
+    """Rotates a face crop so the eyes are level, as DeepFace's own alignment does."""
+    (lx, ly), (rx, ry) = sorted([tuple(landmarks["left_eye"]), tuple(landmarks["right_eye"])])
+    angle = np.degrees(np.arctan2(ry - ly, rx - lx))
+    center = ((lx + rx) / 2.0, (ly + ry) / 2.0)
+    height, width = face_bgr.shape[:2]
+    rotation = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(np.ascontiguousarray(face_bgr), rotation, (width, height))
+
+
+def prepare_face(face_bgr, target_size=FACENET_INPUT_SIZE):
+    """
+    Resizes and pads a face crop to the Facenet input as float32 in [0, 1], the
+    same way DeepFace's preprocessing.resize_image does (without importing it).
+    """
+    img = face_bgr
+    if img.shape[0] > 0 and img.shape[1] > 0:
+        factor = min(target_size[0] / img.shape[0], target_size[1] / img.shape[1])
+        img = cv2.resize(np.ascontiguousarray(img), (int(img.shape[1] * factor), int(img.shape[0] * factor)))
+        diff_0 = target_size[0] - img.shape[0]
+        diff_1 = target_size[1] - img.shape[1]
+        img = np.pad(img, ((diff_0 // 2, diff_0 - diff_0 // 2), (diff_1 // 2, diff_1 - diff_1 // 2), (0, 0)),
+                     "constant")
+        if img.shape[0:2] != target_size:
+            img = cv2.resize(img, target_size)
+    img = img.astype(np.float32)
+    if img.max() > 1:
+        img /= 255.0
+    return img
+
+
+# === Backends ===
+class Embedder(ABC):
+    """
+    detect_faces(img_bgr) returns the aligned face crops in an image (BGR),
+    raising ValueError when there is none; forward(faces) maps an (n, 160, 160, 3)
+    batch from prepare_face to (n, 128) embeddings.
+    """
+
+    name = None
+
+    @abstractmethod
+    def detect_faces(self, img_bgr):
+        ...
+
+    @abstractmethod
+    def forward(self, faces):
+        ...
+
+    def detect(self, img_bgr):
+        return self.detect_faces(img_bgr)[0]
+
+    def embed(self, image, detect=True, landmarks=None):
+        """Embeds the face in an RGB image, unbatched (see face_utils.get_face_embedding)."""
+        img_bgr = image[:, :, ::-1]
+        if detect:
+            face = self.detect(img_bgr)
+        else:
+            face = align_by_eyes(img_bgr, landmarks) if landmarks else img_bgr
+        return self.forward(prepare_face(face)[np.newaxis])[0].astype(np.float32)
+
+    def warm_up(self, batch_size=1):
+        self.forward(np.zeros((batch_size, *FACENET_INPUT_SIZE, 3), dtype=np.float32))
+        try:
+            self.detect_faces(np.zeros((*FACENET_INPUT_SIZE, 3), dtype=np.uint8))
+        except ValueError:
+            pass
+
+
+class DeepFaceEmbedder(Embedder):
+    name = "deepface"
+
+    def __init__(self):
+        from deepface import DeepFace
+        self._deepface = DeepFace
+        self.model = DeepFace.build_model("Facenet")
+
+    def detect_faces(self, img_bgr):
+        faces = self._deepface.extract_faces(img_path=img_bgr, detector_backend="opencv", align=True)
+        # extract_faces gives RGB in [0, 1]; the model takes BGR
+        return [face["face"][:, :, ::-1] for face in faces]
+
+    def forward(self, faces):
+        return self.model.model(faces, training=False).numpy()
+
+    def embed(self, image, detect=True, landmarks=None):
+        img_bgr = image[:, :, ::-1]
+        if detect:
+            result = self._deepface.represent(img_path=img_bgr, model_name="Facenet")
+        else:
+            face = align_by_eyes(img_bgr, landmarks) if landmarks else img_bgr
+            result = self._deepface.represent(img_path=face, model_name="Facenet", detector_backend="skip")
+        return np.asarray(result[0]["embedding"], dtype=np.float32)
+
+    def warm_up(self, batch_size=1):
+        blank = np.zeros((*FACENET_INPUT_SIZE, 3), dtype=np.uint8)
+        self._deepface.represent(img_path=blank, model_name="Facenet", enforce_detection=False)
+        if batch_size > 1:
+            self.forward(np.zeros((batch_size, *FACENET_INPUT_SIZE, 3), dtype=np.float32))
+
+
+class HaarDetector:
+    """
+    OpenCV Haar cascade face detection with eye-based alignment, the method
+    behind DeepFace's "opencv" detector backend, without DeepFace.
+    """
+
+    def __init__(self):
+        self.faces = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+        self.eyes = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_eye.xml"))
+        self._lock = threading.Lock()  # cascade classifiers are not safe to share between threads
+
+    def __call__(self, img_bgr):
+        img_bgr = np.ascontiguousarray(img_bgr)
+        gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+        with self._lock:
+            boxes = self.faces.detectMultiScale(gray, 1.1, 10)
+        if len(boxes) == 0:
+            raise ValueError("Face could not be detected in the image")
+
+        crops = []
+        for x, y, w, h in boxes:
+            crop = img_bgr[y:y + h, x:x + w]
+            with self._lock:
+                eyes = self.eyes.detectMultiScale(gray[y:y + h, x:x + w], 1.1, 10)
+            if len(eyes) >= 2:
+                # The two largest detections, as DeepFace picks them
+                eyes = sorted(eyes, key=lambda e: e[2] * e[3], reverse=True)[:2]
+                centers = [(ex + ew / 2.0, ey + eh / 2.0) for ex, ey, ew, eh in eyes]
+                crop = align_by_eyes(crop, {"left_eye": centers[0], "right_eye": centers[1]})
+            crops.append(crop)
+        return crops
+
+
+class OnnxEmbedder(Embedder):
+    name = "onnx"
+
+    def __init__(self, model_path=ONNX_MODEL_PATH, int8=ONNX_INT8, threads=ONNX_THREADS):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("EMBEDDER_BACKEND=onnx needs ONNX Runtime: pip install onnxruntime")
+        if int8:
+            model_path = quantized_model(model_path)
+            self.name = "onnx-int8"
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.detector = HaarDetector()
+
+    def detect_faces(self, img_bgr):
+        return self.detector(img_bgr)
+
+    def forward(self, faces):
+        return self.session.run(None, {self.input_name: np.asarray(faces, dtype=np.float32)})[0]
+
+
+class StubEmbedder(Embedder):
+    """
+    Deterministic stand-in for a real model: the same image always gives the
+    same embedding. Given a gallery matrix, a `match_rate` share of images map
+    to a noisy copy of an enrolled face, the rest to a stranger.
+    """
+
+    name = "stub"
+
+    def __init__(self, gallery_matrix=None, match_rate=0.9, cost_ms=0.0):
+        self.gallery_matrix = gallery_matrix
+        self.match_rate = match_rate if gallery_matrix is not None else 0.0
+        self.cost_ms = cost_ms
+
+    def detect_faces(self, img_bgr):
+        return [img_bgr]
+
+    def forward(self, faces):
+        if self.cost_ms:
+            time.sleep(self.cost_ms / 1000)
+        embeddings = np.empty((len(faces), EMBEDDING_DIM), dtype=np.float32)
+        for i, face in enumerate(faces):
+            rng = np.random.default_rng(zlib.crc32(np.ascontiguousarray(face).data))
+            if rng.random() < self.match_rate:
+                base = self.gallery_matrix[rng.integers(len(self.gallery_matrix))]
+            else:
+                base = rng.standard_normal(EMBEDDING_DIM, dtype=np.float32)
+            embeddings[i] = base + rng.normal(0, STUB_PROBE_NOISE, EMBEDDING_DIM).astype(np.float32)
+        return embeddings
+
+
+BACKENDS = {
+    "deepface": DeepFaceEmbedder,
+    "onnx": OnnxEmbedder,
+    "onnx-int8": lambda: OnnxEmbedder(int8=True),
+    "stub": StubEmbedder,
+}
+
+
+def create_embedder(name=EMBEDDER_BACKEND):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown EMBEDDER_BACKEND {name!r} (expected one of {', '.join(BACKENDS)})")
+
+
+# === Model files ===
+def quantized_model(model_path):
+    """Path of the int8 copy of an ONNX model, quantizing it first if it is missing or older."""
+    root, ext = os.path.splitext(model_path)
+    int8_path = f"{root}.int8{ext}"
+    if not os.path.exists(int8_path) or os.path.getmtime(int8_path) < os.path.getmtime(model_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        print(f"[EMBEDDER] Quantizing {model_path} to int8...")
+        quantize_dynamic(model_path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def export_facenet_onnx(path):
+    """Converts DeepFace's Keras Facenet model to ONNX (one-off, needs tf2onnx)."""
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    model = DeepFace.build_model("Facenet").model
+    spec = (tf.TensorSpec((None, *FACENET_INPUT_SIZE, 3), tf.float32, name="input"),)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=path)
+    print(f"[EMBEDDER] Wrote {path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "export-onnx":
+        raise SystemExit("usage: python embedders.py export-onnx <output.onnx>")
+    export_facenet_onnx(sys.argv[2])
@@ -0,0 +1,83 @@
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class _Pending:
+    __slots__ = ("item", "done", "result", "error")
+
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EmbeddingBatcher:
+    """
+    Collects inputs submitted by concurrent request threads and runs them through
+    `forward` as one batch. A batch is dispatched when it reaches max_batch_size
+    or when its first input has waited max_wait_ms, whichever comes first.
+
+    forward takes an (n, ...) array and returns n results in the same order.
+    """
+
+    def __init__(self, forward, max_batch_size=8, max_wait_ms=5.0):
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, item, timeout=30):
+        """Queues one input and blocks until its own result is ready."""
+        self._ensure_dispatcher()
+        pending = _Pending(item)
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("embedding batch did not complete in time")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _ensure_dispatcher(self):
+        # Threads do not survive fork, so each gunicorn worker starts its own
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self.forward(np.stack([p.item for p in batch]))
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            for pending in batch:
+                pending.done.set()
@@ -0,0 +1,71 @@
+import json
+import struct
+
+import numpy as np
+
+# Stored layout of users.face_embedding (BYTEA):
+#   4-byte header: b"E", format version (uint8), dimension (uint16, little-endian)
+#   followed by `dimension` little-endian float32 values.
+# The header is exactly one float32 wide, so a column of these blobs can be viewed
+# as an (n, dim + 1) float32 matrix without parsing.
+FORMAT_MAGIC = b"E"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<cBH")
+DEFAULT_DIM = 128  # Facenet
+
+
+def encoded_size(dim=DEFAULT_DIM):
+    return HEADER.size + 4 * dim
+
+
+def encode_embedding(embedding):
+    """Packs an embedding (list or array) into the versioned float32 blob."""
+    vec = np.asarray(embedding, dtype="<f4").reshape(-1)
+    return HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, vec.shape[0]) + vec.tobytes()
+
+
+def decode_embedding(value):
+    """
+    Returns a read-only float32 view over a stored embedding.
+    Legacy JSON text rows (from before the BYTEA migration) are still accepted.
+    """
+    if isinstance(value, str):
+        return np.asarray(json.loads(value), dtype=np.float32)
+
+    buf = memoryview(value)
+    if len(buf) < HEADER.size:
+        raise ValueError("embedding blob too short")
+    magic, version, dim = HEADER.unpack_from(buf)
+    if magic != FORMAT_MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"unknown embedding format {magic!r} v{version}")
+    if len(buf) != encoded_size(dim):
+        raise ValueError(f"embedding blob is {len(buf)} bytes, expected {encoded_size(dim)}")
+    return np.frombuffer(buf, dtype="<f4", offset=HEADER.size)
+
+
+def decode_embeddings(values, dim=DEFAULT_DIM):
+    """
+    Decodes a column of stored embeddings into an (n, dim) float32 matrix.
+    When every value is a well-formed blob this is one join and one copy;
+    otherwise it falls back to decoding row by row.
+    Raises ValueError if any value cannot be decoded.
+    """
+    values = list(values)
+    if not values:
+        return np.empty((0, dim), dtype=np.float32)
+
+    size = encoded_size(dim)
+    if all(not isinstance(v, str) and len(v) == size for v in values):
+        blob = b"".join(values)
+        table = np.frombuffer(blob, dtype="<f4").reshape(len(values), dim + 1)
+        header = HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, dim)
+        if np.all(table[:, 0].view(np.uint32) == np.frombuffer(header, dtype=np.uint32)[0]):
+            return np.ascontiguousarray(table[:, 1:], dtype=np.float32)
+
+    matrix = np.empty((len(values), dim), dtype=np.float32)
+    for i, value in enumerate(values):
+        vec = decode_embedding(value)
+        if vec.shape[0] != dim:
+            raise ValueError(f"row {i}: expected {dim}-dim embedding, got {vec.shape[0]}")
+        matrix[i] = vec
+    return matrix
@@ -0,0 +1,430 @@
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+from embedding_format import encode_embedding
+
+EMBEDDING_DIM = 128  # Facenet
+RERANK_CANDIDATES = 4
+# Quantized scores are approximate, so more finalists get the exact float32 check
+QUANTIZED_RERANK_CANDIDATES = 16
+PRECISIONS = ("float32", "int8")
+# Rows converted to float32 per step of the quantized scan (~1 MB, stays in cache)
+SCAN_BLOCK_ROWS = 2048
+
+
+def quantize(vectors, precision):
+    """
+    Returns int8 (codes, scales) with vectors ~= codes * scales[:, None], one
+    scale per vector (its largest component maps to 127).
+    """
+    if precision != "int8":
+        raise ValueError(f"cannot quantize to {precision!r} (only int8)")
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, vectors.shape[-1])
+    peak = np.abs(vectors).max(axis=1)
+    scales = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def quantized_dots(codes, scales, query, rows=None):
+    """
+    Approximate g.q for every gallery row (or just `rows`), decoding the codes a
+    block at a time into a small float32 buffer and doing one BLAS product per block.
+    The decode costs more than the smaller codes save in memory reads: quantization
+    shrinks the gallery, it does not speed up the scan.
+    """
+    n = codes.shape[0] if rows is None else len(rows)
+    out = np.empty(n, dtype=np.float32)
+    buffer = np.empty((min(SCAN_BLOCK_ROWS, max(n, 1)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, n, SCAN_BLOCK_ROWS):
+        stop = min(start + SCAN_BLOCK_ROWS, n)
+        block = buffer[:stop - start]
+        np.copyto(block, codes[start:stop] if rows is None else codes[rows[start:stop]], casting="unsafe")
+        np.dot(block, query, out=out[start:stop])
+    out *= scales if rows is None else scales[rows]
+    return out
+
+
+def row_checksum(user_id, embedding):
+    """
+    Hash of one user row as (hi, lo) signed 64-bit halves of
+    md5(user_id || md5(stored embedding)), as gallery_sync.table_checksum()
+    computes it in SQL.
+    """
+    row = user_id + hashlib.md5(encode_embedding(embedding)).hexdigest()
+    digest = hashlib.md5(row.encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True), int.from_bytes(digest[8:], "big", signed=True)
+
+
+def _spilled_matrix(capacity, dim, rows, spill_dir=None):
+    """
+    Returns a (capacity, dim) float32 matrix backed by an unlinked temporary file,
+    starting with `rows`. It is mapped copy-on-write: the bulk of it stays in the
+    page cache (reclaimable, and shared with forked workers) and rows written
+    later stay private to the process that wrote them.
+    """
+    f = tempfile.TemporaryFile(dir=spill_dir, prefix="facepay-gallery-")
+    initial = np.memmap(f, dtype=np.float32, mode="w+", shape=(capacity, dim))
+    for start in range(0, len(rows), 65536):
+        stop = min(start + 65536, len(rows))
+        initial[start:stop] = rows[start:stop]
+    initial.flush()
+    del initial
+    return np.memmap(f, dtype=np.float32, mode="c", shape=(capacity, dim))
+
+
+class FaceGallery:
+    """
+    Process-resident gallery of enrolled faces.
+    Embeddings live in one contiguous float32 matrix, with user_id / name /
+    stripe_customer_id kept in parallel arrays indexed by row.
+
+    With precision "int8" the scan runs over a quantized copy held in memory
+    (4x smaller), and the float32 matrix, only read to re-rank the closest few
+    candidates exactly, is spilled to a temporary file in spill_dir. This saves
+    memory at about the same scan time as float32.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, capacity=1024, precision="float32", spill_dir=None, initial=None):
+        """`initial` optionally pre-fills the first rows of the matrix (see from_arrays)."""
+        if precision not in PRECISIONS:
+            raise ValueError(f"unknown gallery precision {precision!r}")
+        self.dim = dim
+        self.precision = precision
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._size = 0
+        initial = np.empty((0, dim), dtype=np.float32) if initial is None else initial
+        if precision == "float32":
+            self._matrix = np.empty((capacity, dim), dtype=np.float32)
+            self._matrix[:len(initial)] = initial
+            self._codes = self._scales = None
+        else:
+            self._matrix = _spilled_matrix(capacity, dim, initial, spill_dir)
+            self._codes = np.zeros((capacity, dim), dtype=np.dtype(precision))
+            self._scales = np.ones(capacity, dtype=np.float32)
+            self._codes[:len(initial)], self._scales[:len(initial)] = quantize(initial, precision)
+        self._sq_norms = np.empty(capacity, dtype=np.float32)
+        self._user_ids = [None] * capacity
+        self._names = [None] * capacity
+        self._stripe_ids = [None] * capacity
+        self._row_of = {}
+        # Change log for external snapshots (see export): user_id -> sequence number
+        # of its last change, kept once something asks for a version()
+        self._changes = None
+        self._seq = 0
+        self._checksum = None  # [count, hi, lo], kept up to date once something asks for it
+        self.index = None
+
+    def __len__(self):
+        return self._size
+
+    # === Building ===
+    @classmethod
+    def from_rows(cls, rows, dim=EMBEDDING_DIM, **options):
+        """
+        Builds a gallery from (user_id, name, stripe_customer_id, embedding) rows.
+        Rows whose embedding has the wrong shape are skipped.
+        Options (precision, spill_dir) are passed to the constructor.
+        """
+        rows = list(rows)
+        gallery = cls(dim=dim, capacity=max(len(rows), 1024), **options)
+        for user_id, name, stripe_customer_id, embedding in rows:
+            try:
+                gallery._put(user_id, name, stripe_customer_id, embedding)
+            except ValueError as e:
+                print(f"[GALLERY] Skipping user {user_id}: {e}")
+        return gallery
+
+    @classmethod
+    def from_arrays(cls, user_ids, names, stripe_ids, matrix, **options):
+        """
+        Builds a gallery from parallel columns and an (n, dim) embedding matrix
+        without going row by row. Duplicate user_ids keep their last row.
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n, dim = matrix.shape
+        if len(set(user_ids)) != n:
+            return cls.from_rows(zip(user_ids, names, stripe_ids, matrix), dim=dim, **options)
+
+        gallery = cls(dim=dim, capacity=max(n, 1024), initial=matrix, **options)
+        gallery._sq_norms[:n] = np.einsum("ij,ij->i", matrix, matrix)
+        gallery._user_ids[:n] = user_ids
+        gallery._names[:n] = names
+        gallery._stripe_ids[:n] = stripe_ids
+        gallery._row_of = {user_id: row for row, user_id in enumerate(user_ids)}
+        gallery._size = n
+        return gallery
+
+    def add(self, user_id, name, stripe_customer_id, embedding):
+        """Inserts a user, or replaces the stored row if the user_id is already present."""
+        with self._lock:
+            self._put(user_id, name, stripe_customer_id, embedding)
+
+    def _put(self, user_id, name, stripe_customer_id, embedding):
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vec.shape[0] != self.dim:
+            raise ValueError(f"expected {self.dim}-dim embedding, got {vec.shape[0]}")
+
+        row = self._row_of.get(user_id)
+        if self._checksum is not None:
+            if row is not None:
+                self._toggle_checksum(user_id, self._matrix[row], -1)
+            self._toggle_checksum(user_id, vec, 1)
+        if row is None:
+            if self._size == self._matrix.shape[0]:
+                self._grow()
+            row = self._size
+
+        self._matrix[row] = vec
+        if self._codes is not None:
+            codes, scales = quantize(vec[None, :], self.precision)
+            self._codes[row], self._scales[row] = codes[0], scales[0]
+        self._sq_norms[row] = np.dot(vec, vec)
+        self._user_ids[row] = user_id
+        self._names[row] = name
+        self._stripe_ids[row] = stripe_customer_id
+
+        if user_id not in self._row_of:
+            self._row_of[user_id] = row
+            self._size += 1
+        self._log_change(user_id)
+        if self.index is not None:
+            self.index.add(row, vec)
+
+    def _grow(self):
+        capacity = self._matrix.shape[0] * 2
+        if self._codes is None:
+            matrix = np.empty((capacity, self.dim), dtype=np.float32)
+            matrix[:self._size] = self._matrix[:self._size]
+        else:
+            matrix = _spilled_matrix(capacity, self.dim, self._matrix[:self._size], self.spill_dir)
+            codes = np.zeros((capacity, self.dim), dtype=self._codes.dtype)
+            codes[:self._size] = self._codes[:self._size]
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:self._size] = self._scales[:self._size]
+            self._codes, self._scales = codes, scales
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        extra = [None] * (capacity - len(self._user_ids))
+        self._user_ids += extra
+        self._names += extra
+        self._stripe_ids += extra
+        # Swap in the new buffers last so a concurrent reader's snapshot stays valid
+        self._matrix, self._sq_norms = matrix, sq_norms
+
+    def remove(self, user_id):
+        """Drops a user; the last row moves into its slot so the matrix stays contiguous."""
+        with self._lock:
+            row = self._row_of.pop(user_id, None)
+            if row is None:
+                return
+            if self._checksum is not None:
+                self._toggle_checksum(user_id, self._matrix[row], -1)
+            self._log_change(user_id)
+            last = self._size - 1
+            if self.index is not None:
+                self.index.remove(row)
+                self.index.remove(last)
+            if row != last:
+                self._matrix[row] = self._matrix[last]
+                if self._codes is not None:
+                    self._codes[row] = self._codes[last]
+                    self._scales[row] = self._scales[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._user_ids[row] = self._user_ids[last]
+                self._names[row] = self._names[last]
+                self._stripe_ids[row] = self._stripe_ids[last]
+                self._row_of[self._user_ids[row]] = row
+                # Its row number changed: a snapshot being written may hold either copy
+                self._log_change(self._user_ids[row])
+                if self.index is not None:
+                    self.index.add(row, self._matrix[row])
+            self._user_ids[last] = self._names[last] = self._stripe_ids[last] = None
+            self._size = last
+
+    # === Checksum (see gallery_sync.py) ===
+    def set_checksum(self, checksum):
+        """
+        Seeds the checksum with (count, hi, lo) as table_checksum() gave it for the
+        rows this gallery was loaded from; from then on add() and remove() keep it
+        current, one row at a time.
+        """
+        with self._lock:
+            self._checksum = list(checksum)
+
+    def checksum(self):
+        """(count, hi, lo): XOR of row_checksum() over every user, computed once and then kept current."""
+        with self._lock:
+            return self._checksum_locked()
+
+    def _checksum_locked(self):
+        if self._checksum is None:
+            self._checksum = [0, 0, 0]
+            for row in range(self._size):
+                self._toggle_checksum(self._user_ids[row], self._matrix[row], 1)
+        return tuple(self._checksum)
+
+    def _toggle_checksum(self, user_id, embedding, count):
+        hi, lo = row_checksum(user_id, embedding)
+        self._checksum[0] += count
+        self._checksum[1] ^= hi
+        self._checksum[2] ^= lo
+
+    def items(self):
+        """Returns (user_id, embedding) pairs for every user in the gallery."""
+        matrix, user_ids = self.snapshot()
+        return list(zip(user_ids, matrix))
+
+    def attach_index(self, index):
+        """Routes future matches through an approximate index (see ann_index.IVFIndex)."""
+        self.index = index
+
+    def snapshot(self):
+        """Returns (matrix, user_ids) views over the filled part of the gallery."""
+        with self._lock:
+            return self._matrix[:self._size], self._user_ids[:self._size]
+
+    # === Snapshots for other processes (see sharded_matcher.py) ===
+    def export(self, vectors_path, norms_path):
+        """
+        Saves the embedding matrix and squared norms as .npy files (for memory-mapping
+        from other processes). Returns (user_ids in row order, version).
+
+        Only the views are taken under the lock; the files are written after it
+        is released, so matching and updates carry on meanwhile. Rows changed
+        during the write may be saved either way, but their users show up in
+        changed_since(version), which callers match from the live rows.
+        """
+        with self._lock:
+            n = self._size
+            matrix, sq_norms = self._matrix[:n], self._sq_norms[:n]
+            user_ids = self._user_ids[:n]
+            version = self._version()
+        np.save(vectors_path, matrix)
+        np.save(norms_path, sq_norms)
+        return user_ids, version
+
+    def version(self):
+        """
+        (checksum, sequence number) of the gallery's current content; changes
+        from here on are reported by changed_since().
+        """
+        with self._lock:
+            return self._version()
+
+    def _version(self):
+        if self._changes is None:
+            self._changes = {}
+        return self._checksum_locked(), self._seq
+
+    def changed_since(self, version):
+        """user_ids added, replaced, moved or removed after `version` was taken."""
+        seq = version[1]
+        with self._lock:
+            return {user_id for user_id, changed in (self._changes or {}).items() if changed > seq}
+
+    def forget_changes(self, version):
+        """Drops change records up to `version`, once nothing asks about them any more."""
+        seq = version[1]
+        with self._lock:
+            if self._changes:
+                self._changes = {user_id: changed for user_id, changed in self._changes.items() if changed > seq}
+
+    def _log_change(self, user_id):
+        if self._changes is not None:
+            self._seq += 1
+            self._changes[user_id] = self._seq
+
+    def rows_of(self, user_ids):
+        """Current rows of the given users; users no longer present are left out."""
+        with self._lock:
+            return np.array([self._row_of[u] for u in user_ids if u in self._row_of], dtype=np.int64)
+
+    def user_at(self, row):
+        return {
+            "user_id": self._user_ids[row],
+            "name": self._names[row],
+            "stripe_customer_id": self._stripe_ids[row]
+        }
+
+    # === Matching ===
+    def match(self, embedding, threshold=10, nprobe=None):
+        """
+        Finds the closest enrolled user in one vectorized pass (or, with an index
+        attached, a pass over the candidate rows it returns; nprobe overrides its setting).
+        Returns the user dict plus "distance" and "margin" (gap to the runner-up),
+        or None if the gallery is empty or the best distance is not under threshold.
+        """
+        with self._lock:
+            n = self._size
+            matrix = self._matrix[:n]
+            sq_norms = self._sq_norms[:n]
+            codes = self._codes[:n] if self._codes is not None else None
+            scales = self._scales[:n] if self._codes is not None else None
+        if n == 0:
+            return None
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if query.shape[0] != self.dim:
+            raise ValueError(f"expected {self.dim}-dim embedding, got {query.shape[0]}")
+
+        rows = None
+        if self.index is not None:
+            rows = self.index.candidates(query, nprobe=nprobe)
+            rows = rows[rows < n]
+            if rows.size == 0:
+                return None
+
+        # ||g - q||^2 = ||g||^2 - 2 g.q + ||q||^2, computed as one matrix-vector product
+        # (over the quantized codes when the gallery has them; norms are always exact)
+        if codes is not None:
+            dots = quantized_dots(codes, scales, query, rows)
+            rerank = QUANTIZED_RERANK_CANDIDATES
+        else:
+            dots = (matrix if rows is None else matrix[rows]) @ query
+            rerank = RERANK_CANDIDATES
+        sq_dists = (sq_norms if rows is None else sq_norms[rows]) - 2.0 * dots + np.dot(query, query)
+
+        m = sq_dists.shape[0]
+        k = min(rerank, m)
+        top = np.argpartition(sq_dists, k - 1)[:k] if m > k else np.arange(m)
+        if rows is not None:
+            top = rows[top]
+        return self._rerank(top, query, threshold)
+
+    def match_rows(self, embedding, rows, threshold=10):
+        """
+        Like match(), but only considers the given candidate rows (e.g. merged from
+        an external scan); all of them are compared exactly.
+        """
+        return self._rerank(np.asarray(rows, dtype=np.int64), np.asarray(embedding, dtype=np.float32).reshape(-1), threshold)
+
+    def _rerank(self, top, query, threshold):
+        # The finalists' vectors and users are read together under the lock: the scan
+        # above ran without it, and a concurrent remove() may have moved another user
+        # into one of its rows, so the user returned (and charged) is always the one
+        # whose vector was measured
+        with self._lock:
+            top = top[top < self._size]
+            vectors = self._matrix[top].astype(np.float64)
+            users = [self.user_at(int(row)) for row in top]
+        if not users:
+            return None
+
+        # Recompute the few finalists exactly to avoid cancellation error in the expansion
+        exact = np.sqrt(((vectors - query) ** 2).sum(axis=1))
+        order = np.argsort(exact)
+        best, best_dist = int(order[0]), float(exact[order[0]])
+        margin = float(exact[order[1]] - best_dist) if len(top) > 1 else float("inf")
+
+        if best_dist >= threshold:
+            return None
+
+        user = users[best]
+        user["distance"] = best_dist
+        user["margin"] = margin
+        return user
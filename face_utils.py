@@ -1,52 +1,302 @@
 import numpy as np
-from deepface import DeepFace
-from scipy.spatial.distance import euclidean
-import psycopg2
 import os
-import ast  # To safely parse the stringified list from DB
+import threading
+import time
 
 from dotenv import load_dotenv
 load_dotenv()
 
-# === Connect to PostgreSQL ===
-def get_db_connection():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
+from db_pool import connection
+from face_gallery import FaceGallery
+from embedding_batcher import EmbeddingBatcher
+from embedders import align_by_eyes, create_embedder, prepare_face
+from embedding_format import decode_embedding, decode_embeddings
+from image_decode import decode_image
+from inference_client import EmbeddingClient, EMBEDDING_SERVICE
+from ann_index import IVFIndex
+from gallery_sync import GallerySync, table_checksum
+from metrics import Gauge, register, record_match, span
+from sharded_matcher import ShardedMatcher, ShardError, MATCH_SHARDS, MATCH_SHARDS_MIN_USERS
+
+# How long a worker trusts its in-memory gallery before re-reading the users table
+GALLERY_MAX_AGE = float(os.getenv("GALLERY_MAX_AGE", "60"))
+
+# Optional approximate index for large galleries ("ivf" or "none")
+FACE_INDEX = os.getenv("FACE_INDEX", "none").lower()
+FACE_INDEX_PATH = os.getenv("FACE_INDEX_PATH", "data/face_index.npz")
+FACE_INDEX_MIN_USERS = int(os.getenv("FACE_INDEX_MIN_USERS", "50000"))
+FACE_INDEX_NLIST = int(os.getenv("FACE_INDEX_NLIST", "0"))  # 0 = 4 * sqrt(users)
+FACE_INDEX_NPROBE = int(os.getenv("FACE_INDEX_NPROBE", "8"))  # higher = better recall, slower
+
+# Gallery storage: "float32", or "int8" to scan a quantized copy (4x less memory);
+# quantized galleries keep the exact float32 vectors, used only for re-ranking, in a temp file.
+# This saves memory only: numpy has no int8 BLAS, so the scan decodes to float32 and is about
+# as fast as float32 (see calibrate_gallery.py)
+GALLERY_PRECISION = os.getenv("GALLERY_PRECISION", "float32").lower()
+if GALLERY_PRECISION == "float16":
+    # Dropped: it scanned ~3x slower than float32 and saved less memory than int8
+    print("[WARNING] GALLERY_PRECISION=float16 is no longer supported; using float32 (int8 saves more memory)")
+    GALLERY_PRECISION = "float32"
+GALLERY_SPILL_DIR = os.getenv("GALLERY_SPILL_DIR") or None
+
+# Micro-batching of concurrent embedding requests (EMBED_BATCH_SIZE=1 disables it)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "1"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+# Apply users table changes from LISTEN/NOTIFY rather than reloading every GALLERY_MAX_AGE
+GALLERY_SYNC = os.getenv("GALLERY_SYNC", "true").lower() == "true"
+
+_gallery = None
+_gallery_sync = None
+_gallery_loaded_at = 0.0
+_gallery_lock = threading.Lock()
+_matcher = ShardedMatcher() if MATCH_SHARDS > 0 else None
+# With EMBEDDING_SERVICE set, faces are embedded by inference_server.py and this
+# process never loads a model (backends are created on first local use)
+_embedding_client = EmbeddingClient(EMBEDDING_SERVICE) if EMBEDDING_SERVICE else None
+_embedder = None
+_embedder_lock = threading.Lock()
 
 # === Get embedding from image ===
-def get_face_embedding(image):
-    img_rgb = image[:, :, ::-1]
-    embedding_obj = DeepFace.represent(img_path=img_rgb, model_name="Facenet")[0]
-    return embedding_obj["embedding"]
+def get_face_embedding(image, detect=True, landmarks=None):
+    """
+    Embeds the face in an RGB image. With detect=False the image is taken to be a
+    tight face crop supplied by the client: full-frame detection is skipped and the
+    crop is only aligned (when eye landmarks are given) and embedded.
+    """
+    if _embedding_client is not None:
+        with span("embed"):
+            return _embedding_client.embed(image, detect=detect, landmarks=landmarks).tolist()
+    return compute_face_embedding(image, detect=detect, landmarks=landmarks)
 
-# === Compare embeddings against DB users ===
-def find_matching_user_by_embedding(captured_embedding, threshold=10):
+def get_face_embedding_from_bytes(data):
+    """
+    Embeds the face in encoded image bytes (JPEG/PNG). With an embedding service the
+    bytes are sent as they are and decoded there, which is far less to send than pixels.
+    """
+    if _embedding_client is not None:
+        with span("embed"):
+            return _embedding_client.embed_encoded(data).tolist()
+    with span("decode"):
+        image = decode_image(data)
+    return compute_face_embedding(image)
+
+def compute_face_embedding(image, detect=True, landmarks=None):
+    """get_face_embedding in this process, whatever EMBEDDING_SERVICE says (used by inference_server.py)."""
+    embedder = get_embedder()
+    if _batcher is None:
+        with span("detect_embed" if detect else "embed"):
+            return embedder.embed(image, detect=detect, landmarks=landmarks).tolist()
+
+    # Detection and alignment stay per image; only the forward pass is batched
+    img_bgr = image[:, :, ::-1]
+    if detect:
+        with span("detect"):
+            face = prepare_face(embedder.detect(img_bgr))
+    else:
+        face = prepare_face(align_by_eyes(img_bgr, landmarks) if landmarks else img_bgr)
+    with span("embed"):
+        return _batcher.submit(face).tolist()
+
+def get_embedder():
+    """This process's embedding backend (EMBEDDER_BACKEND, see embedders.py), created on first use."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = create_embedder()
+    return _embedder
+
+def _forward_batch(faces):
+    return get_embedder().forward(faces)
+
+def embed_faces(images, require_single=True):
+    """
+    Embeds a list of RGB images with a single forward pass (for offline jobs
+    such as bulk_enroll.py). Returns one entry per image: the float32 embedding, or a
+    ValueError saying why the image is unusable ("no face" / "multiple faces").
+    """
+    embedder = get_embedder()
+    results = [None] * len(images)
+    faces, positions = [], []
+    for i, image in enumerate(images):
+        try:
+            detected = embedder.detect_faces(image[:, :, ::-1])
+        except ValueError:
+            results[i] = ValueError("no face")
+            continue
+        if require_single and len(detected) > 1:
+            results[i] = ValueError("multiple faces")
+            continue
+        faces.append(prepare_face(detected[0]))
+        positions.append(i)
+
+    if faces:
+        for i, embedding in zip(positions, _forward_batch(np.stack(faces))):
+            results[i] = embedding.astype(np.float32)
+    return results
+
+_batcher = (
+    EmbeddingBatcher(_forward_batch, max_batch_size=EMBED_BATCH_SIZE, max_wait_ms=EMBED_BATCH_WAIT_MS)
+    if EMBED_BATCH_SIZE > 1 else None
+)
+
+def warm_up_model():
+    """
+    Loads the embedding model and runs one dummy inference so the first real
+    request does not pay for graph construction. With an embedding service it
+    only waits for the service to answer.
+    """
+    if _embedding_client is not None:
+        _embedding_client.wait_ready()
+        return
+    warm_up_local_model()
+
+def warm_up_local_model():
+    get_embedder().warm_up(batch_size=EMBED_BATCH_SIZE)
+
+# === In-memory gallery of enrolled users ===
+def load_gallery():
+    """
+    Reads every user once and builds the vectorized gallery. The table checksum
+    is read from the same snapshot, so gallery sync can compare against it.
+    """
+    with span("gallery_fetch"), connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            checksum = table_checksum(cur)
+            cur.execute("SELECT user_id, name, stripe_customer_id, face_embedding FROM users")
+            rows = cur.fetchall()
+
+    options = {"precision": GALLERY_PRECISION, "spill_dir": GALLERY_SPILL_DIR}
+    if not rows:
+        gallery = FaceGallery(**options)
+        gallery.set_checksum(checksum)
+        return gallery
+
+    user_ids, names, stripe_ids, blobs = (list(col) for col in zip(*rows))
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, name, stripe_customer_id, face_embedding FROM users")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        print("[DB ERROR] Failed to fetch users:", e)
-        return None
+        gallery = FaceGallery.from_arrays(user_ids, names, stripe_ids, decode_embeddings(blobs), **options)
+    except ValueError:
+        # Some rows are malformed: decode one by one and skip the bad ones
+        parsed = []
+        for user_id, name, stripe_customer_id, blob in rows:
+            try:
+                parsed.append((user_id, name, stripe_customer_id, decode_embedding(blob)))
+            except Exception as e:
+                print(f"[ERROR] Failed to parse embedding for user {user_id}: {e}")
+        gallery = FaceGallery.from_rows(parsed, **options)
+    gallery.set_checksum(checksum)
 
-    for row in rows:
-        user_id, name, stripe_customer_id, stored_embedding_str = row
+    if FACE_INDEX == "ivf" and len(gallery) >= FACE_INDEX_MIN_USERS:
+        gallery.attach_index(load_or_train_index(gallery))
+    return gallery
 
+def load_or_train_index(gallery, retrain=False):
+    """
+    Restores the IVF index saved at FACE_INDEX_PATH, or trains and saves a new one.
+    """
+    matrix, user_ids = gallery.snapshot()
+    if not retrain and os.path.exists(FACE_INDEX_PATH):
         try:
-            # Parse string back into list of floats
-            stored_embedding = ast.literal_eval(stored_embedding_str)
+            return IVFIndex.load(FACE_INDEX_PATH, matrix, user_ids, nprobe=FACE_INDEX_NPROBE)
         except Exception as e:
-            print(f"[ERROR] Failed to parse embedding for user {user_id}: {e}")
-            continue
+            print("[INDEX] Could not load saved index, retraining:", e)
+
+    nlist = FACE_INDEX_NLIST or int(4 * np.sqrt(len(user_ids)))
+    index = IVFIndex.train(matrix, nlist, nprobe=FACE_INDEX_NPROBE)
+    index.build(matrix, len(user_ids))
+    try:
+        index.save(FACE_INDEX_PATH, user_ids)
+    except OSError as e:
+        print("[INDEX] Could not save index:", e)
+    return index
+
+def get_gallery():
+    """
+    Returns this process's gallery, loading it on first use. Unless gallery sync
+    is connected and receiving changes, it is also reloaded once it is older
+    than GALLERY_MAX_AGE. A failed reload keeps serving the previous gallery.
+    """
+    if _gallery is not None and (_sync_healthy() or time.monotonic() - _gallery_loaded_at < GALLERY_MAX_AGE):
+        return _gallery
+    return reload_gallery(only_if_stale=True)
+
+def _sync_healthy():
+    return _gallery_sync is not None and _gallery_sync.is_healthy()
+
+def reload_gallery(only_if_stale=False):
+    """Re-reads the users table and swaps in the new gallery."""
+    global _gallery, _gallery_loaded_at
+    with _gallery_lock:
+        stale = _gallery is None or (
+            not _sync_healthy() and time.monotonic() - _gallery_loaded_at >= GALLERY_MAX_AGE
+        )
+        if stale or not only_if_stale:
+            try:
+                _gallery = load_gallery()
+            except Exception as e:
+                print("[DB ERROR] Failed to fetch users:", e)
+                if _gallery is None:
+                    return None
+            _gallery_loaded_at = time.monotonic()
+    return _gallery
+
+def start_gallery_sync():
+    """
+    Keeps this process's gallery current from users table notifications
+    (see gallery_sync.py) instead of periodic full reloads.
+    """
+    global _gallery_sync
+    if _gallery_sync is None:
+        _gallery_sync = GallerySync(
+            on_upsert=lambda *user: get_gallery().add(*user),
+            on_delete=lambda user_id: get_gallery().remove(user_id),
+            on_resync=reload_gallery,
+            local_checksum=lambda: get_gallery().checksum(),
+        )
+    _gallery_sync.start()
+
+def add_to_gallery(user):
+    """Makes a freshly registered user matchable in this process without a reload."""
+    gallery = get_gallery()
+    if gallery is not None:
+        gallery.add(user["user_id"], user["name"], user["stripe_customer_id"], user["face_embedding"])
+
+# === Compare embeddings against DB users ===
+def find_matching_user_by_embedding(captured_embedding, threshold=10):
+    """
+    Returns the closest user under threshold (with "distance" and "margin"), or None.
+    """
+    gallery = get_gallery()
+    if gallery is None:
+        return None
+    with span("match"):
+        try:
+            if _matcher is not None and len(gallery) >= MATCH_SHARDS_MIN_USERS:
+                user = _matcher.match(gallery, captured_embedding, threshold=threshold)
+            else:
+                user = gallery.match(captured_embedding, threshold=threshold)
+        except ShardError as e:
+            print("[SHARDS] Matching in-process:", e)
+            user = gallery.match(captured_embedding, threshold=threshold)
+    record_match(user)
+    return user
 
-        dist = euclidean(captured_embedding, stored_embedding)
-        if dist < threshold:
-            return {
-                "user_id": user_id,
-                "name": name,
-                "stripe_customer_id": stripe_customer_id
-            }
+def match_face(embedding, users, threshold=10):
+    """
+    Matches against a caller-held set of users (the kiosk's local copy): a
+    FaceGallery, or a list of user dicts with "face_embedding".
+    Returns the closest user under threshold (with "distance" and "margin"), or None.
+    """
+    if not isinstance(users, FaceGallery):
+        users = FaceGallery.from_rows(
+            (u["user_id"], u["name"], u["stripe_customer_id"], u["face_embedding"]) for u in users
+        )
+    user = users.match(embedding, threshold=threshold)
+    record_match(user)
+    return user
 
-    return None
+register(Gauge(
+    "facepay_gallery_users", "Users in this worker's in-memory gallery", (),
+    lambda: {(): len(_gallery) if _gallery is not None else 0}))
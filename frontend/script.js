@@ -1,5 +1,24 @@
-let capturedImageData = null;
+let capturedImageBlob = null;
+let capturedFace = null;
 let faceVerified = false;
+// Single-use token from /api/verify; lets /api/pay skip re-checking the face
+let verifyToken = null;
+// Reused when the same payment is retried, so the server charges it at most once
+let paymentKey = null;
+
+// Longest side of the uploaded frame; matches IMAGE_MAX_SIDE on the server
+const CAPTURE_MAX_SIDE = 640;
+// Longest side of an uploaded face crop (server accepts up to FACE_CROP_MAX_SIDE)
+const FACE_CROP_SIDE = 320;
+// Padding around the detected box, as a share of its longest side. Kept at 0: the
+// server embeds the crop as-is (no re-detection), and gallery embeddings come from
+// tight detector crops, so any margin shifts the embedding away from the enrolled one
+const FACE_CROP_MARGIN = 0;
+const FACE_CROP_MIN_SIDE = 64;
+
+// Browser face detection (Shape Detection API) where available; lets us upload
+// just the face so the server can skip full-frame detection
+const faceDetector = "FaceDetector" in window ? new FaceDetector({ maxDetectedFaces: 2, fastMode: true }) : null;
 
 // Start webcam streams on both videos
 async function startWebcam(videoId) {
@@ -27,8 +46,8 @@ function showTab(tabId) {
   }
 }
 
-// Capture face image from video, returns true if successful, false if not
-function captureFace(context) {
+// Capture face image from video as a downscaled JPEG blob, resolves true if successful, false if not
+async function captureFace(context) {
   const video = document.getElementById(context === 'register' ? 'reg_video' : 'pay_video');
 
   if (!video || video.readyState < 2) { // HAVE_CURRENT_DATA
@@ -37,19 +56,88 @@ function captureFace(context) {
     return false;
   }
 
+  const scale = Math.min(1, CAPTURE_MAX_SIDE / Math.max(video.videoWidth, video.videoHeight));
   const canvas = document.createElement("canvas");
-  canvas.width = video.videoWidth;
-  canvas.height = video.videoHeight;
+  canvas.width = Math.round(video.videoWidth * scale);
+  canvas.height = Math.round(video.videoHeight * scale);
   const ctx = canvas.getContext("2d");
   ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
 
-  capturedImageData = canvas.toDataURL("image/jpeg");
+  capturedImageBlob = await new Promise(resolve => canvas.toBlob(resolve, "image/jpeg", 0.9));
+  if (!capturedImageBlob) {
+    return false;
+  }
+  capturedFace = await cropFace(canvas);
   if (context === 'register') {
   document.getElementById("reg_status").textContent = "✅ Face captured successfully!";
   }
   return true;
 }
 
+// Detect a single face in the frame and cut out a tight crop around it.
+// Resolves null when detection is unsupported, fails, or does not find exactly one face.
+async function cropFace(frame) {
+  if (!faceDetector) {
+    return null;
+  }
+  try {
+    const faces = await faceDetector.detect(frame);
+    if (faces.length !== 1) {
+      return null;
+    }
+    const box = faces[0].boundingBox;
+    const margin = Math.max(box.width, box.height) * FACE_CROP_MARGIN;
+    const x = Math.max(0, box.x - margin);
+    const y = Math.max(0, box.y - margin);
+    const w = Math.min(frame.width - x, box.width + 2 * margin);
+    const h = Math.min(frame.height - y, box.height + 2 * margin);
+
+    const scale = Math.min(1, FACE_CROP_SIDE / Math.max(w, h));
+    const crop = document.createElement("canvas");
+    crop.width = Math.round(w * scale);
+    crop.height = Math.round(h * scale);
+    if (Math.min(crop.width, crop.height) < FACE_CROP_MIN_SIDE) {
+      return null; // face too small to embed reliably; let the server detect on the full frame
+    }
+    crop.getContext("2d").drawImage(frame, x, y, w, h, 0, 0, crop.width, crop.height);
+
+    // Eye positions in crop coordinates, used server-side for alignment
+    const eyes = (faces[0].landmarks || []).filter(l => l.type === "eye" && l.locations.length);
+    const landmarks = eyes.length === 2 ? {
+      left_eye: [(eyes[0].locations[0].x - x) * scale, (eyes[0].locations[0].y - y) * scale],
+      right_eye: [(eyes[1].locations[0].x - x) * scale, (eyes[1].locations[0].y - y) * scale],
+    } : null;
+
+    const blob = await new Promise(resolve => crop.toBlob(resolve, "image/jpeg", 0.9));
+    return blob ? { blob, box: [x, y, w, h], landmarks } : null;
+  } catch (error) {
+    console.warn("Face detection unavailable, sending full frame:", error);
+    return null;
+  }
+}
+
+// Build a multipart body from plain fields
+function buildFieldsForm(fields) {
+  const form = new FormData();
+  Object.entries(fields).forEach(([key, value]) => form.append(key, value));
+  return form;
+}
+
+// Build a multipart body with the captured face (or full frame) plus plain fields
+function buildImageForm(fields) {
+  const form = buildFieldsForm(fields);
+  if (capturedFace) {
+    form.append("face", capturedFace.blob, "face.jpg");
+    form.append("face_box", JSON.stringify(capturedFace.box));
+    if (capturedFace.landmarks) {
+      form.append("face_landmarks", JSON.stringify(capturedFace.landmarks));
+    }
+  } else {
+    form.append("image", capturedImageBlob, "frame.jpg");
+  }
+  return form;
+}
+
 // Register user API call
 async function registerUser() {
   const name = document.getElementById("reg_name").value.trim();
@@ -61,7 +149,7 @@ async function registerUser() {
     return;
   }
 
-  if (!captureFace('register')) {
+  if (!(await captureFace('register'))) {
     status.textContent = "❌ Cannot capture face. Please try again.";
     return;
   }
@@ -70,8 +158,7 @@ async function registerUser() {
   try {
     const res = await fetch("/api/register", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ name, stripe_id: stripeId, image_data: capturedImageData }),
+      body: buildImageForm({ name, stripe_id: stripeId }),
     });
 
     const result = await res.json();
@@ -91,8 +178,9 @@ async function verifyFace() {
   const verificationStatus = document.getElementById("face_verification_status");
   verificationStatus.textContent = "";
   faceVerified = false;
+  verifyToken = null;
 
-  if (!captureFace('payment')) {
+  if (!(await captureFace('payment'))) {
     verificationStatus.textContent = "❌ Cannot capture face. Please try again.";
     updateSendButton(false);
     return;
@@ -103,13 +191,13 @@ async function verifyFace() {
   try {
     const res = await fetch("/api/verify", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ image_data: capturedImageData }),
+      body: buildImageForm({}),
     });
     const result = await res.json();
 
     if (result.status === "success") {
       faceVerified = true;
+      verifyToken = result.verify_token || null;
       verificationStatus.textContent = "✅ Face verified successfully!";
       updateSendButton(true);
     } else {
@@ -147,23 +235,25 @@ async function sendPayment() {
     return;
   }
 
-  if (!capturedImageData) {
+  if (!verifyToken && !capturedImageBlob) {
     paymentStatus.textContent = "❌ No face image available. Please verify face again.";
     updateSendButton(false);
     return;
   }
 
   paymentStatus.textContent = "Processing payment...";
+  paymentKey = paymentKey || crypto.randomUUID();
 
   try {
     const res = await fetch("/api/pay", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        recipient_id: recipientId,
-        amount,
-        image_data: capturedImageData,
-      }),
+      headers: { "Idempotency-Key": paymentKey },
+      // The face goes along with the token: if the token is rejected, the server matches it instead
+      body: !capturedImageBlob
+        ? buildFieldsForm({ recipient_id: recipientId, amount, verify_token: verifyToken })
+        : buildImageForm(verifyToken
+          ? { recipient_id: recipientId, amount, verify_token: verifyToken }
+          : { recipient_id: recipientId, amount }),
     });
 
     let result;
@@ -173,13 +263,27 @@ async function sendPayment() {
       throw new Error("Invalid response from server.");
     }
 
+    // Charges run in the background; long-poll until this one settles
+    while (res.ok && result.status === "pending" && result.payment_id) {
+      paymentStatus.textContent = "Processing payment...";
+      const poll = await fetch(`/api/pay/${result.payment_id}?wait=5`);
+      result = await poll.json();
+      if (!poll.ok) {
+        break;
+      }
+    }
+
     if (res.ok && result.status === "success") {
       paymentStatus.textContent = "✅ Payment sent! Charge ID: " + result.charge_id;
       paymentStatus.scrollIntoView({ behavior: "smooth" }); // 👈 scroll here
       faceStatus.textContent = "";
       faceVerified = false;
+      verifyToken = null;
+      paymentKey = null;
       updateSendButton(false);
     } else {
+      paymentKey = null; // the server settled this attempt; a retry is a new payment
+      verifyToken = null; // spent or expired; a retry falls back to the captured face
       paymentStatus.textContent = "❌ Payment failed: " + (result.error || "Unknown error");
       paymentStatus.scrollIntoView({ behavior: "smooth" }); // 👈 scroll here
     }
@@ -195,7 +299,10 @@ async function sendPayment() {
 // Reset payment tab UI when switching tabs
 function resetPaymentUI() {
   faceVerified = false;
-  capturedImageData = null;
+  verifyToken = null;
+  capturedImageBlob = null;
+  capturedFace = null;
+  paymentKey = null;
   updateSendButton(false);
   document.getElementById("face_verification_status").textContent = "";
   document.getElementById("payment_result").textContent = "";
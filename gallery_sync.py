@@ -0,0 +1,175 @@
+"""
+Keeps in-process copies of the users table current without re-reading it.
+
+setup_db.py installs a trigger that runs pg_notify('users_changed', ...) with
+{"op": "INSERT" | "UPDATE" | "DELETE", "user_id": ...} for every changed row.
+GallerySync LISTENs on a dedicated connection, fetches just the changed rows
+and hands them to the owner's callbacks. As a safety net against missed
+notifications (e.g. while reconnecting) it periodically compares a checksum of
+the table with the local copy and asks for a full reload on mismatch.
+
+The checksum XORs a hash of every row (face_gallery.row_checksum), so the local
+side is kept current one change at a time (FaceGallery.checksum) and seeded from
+the same snapshot the gallery was loaded from (load_gallery); a check costs one
+SQL aggregate and no pass over the local copy. Needs PostgreSQL 14+ (bit_xor).
+"""
+import json
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db_pool import connection, DATABASE_URL
+from embedding_format import decode_embedding
+
+load_dotenv()
+
+CHANNEL = "users_changed"
+GALLERY_RESYNC_SECONDS = float(os.getenv("GALLERY_RESYNC_SECONDS", "600"))
+RECONNECT_DELAY = 5
+# A mismatch can be changes whose notifications are still in flight: they are
+# applied and the check repeated this many times before a full reload
+VERIFY_ATTEMPTS = 3
+VERIFY_RETRY_DELAY = 1.0
+
+CHECKSUM_SQL = """
+    SELECT count(*),
+           coalesce(bit_xor(('x' || substr(h, 1, 16))::bit(64)::bigint), 0),
+           coalesce(bit_xor(('x' || substr(h, 17, 16))::bit(64)::bigint), 0)
+    FROM (SELECT md5(user_id || md5(face_embedding)) AS h FROM users) AS rows
+"""
+
+
+def table_checksum(cur=None):
+    """(count, hi, lo) for the users table, matching FaceGallery.checksum()."""
+    if cur is not None:
+        cur.execute(CHECKSUM_SQL)
+        return tuple(cur.fetchone())
+    with connection() as conn:
+        with conn.cursor() as cur:
+            return table_checksum(cur)
+
+
+def fetch_users(user_ids):
+    """Returns {user_id: (name, stripe_customer_id, embedding)} for the ids that still exist."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT user_id, name, stripe_customer_id, face_embedding
+                FROM users WHERE user_id = ANY(%s)
+            """, (list(user_ids),))
+            rows = cur.fetchall()
+    return {
+        user_id: (name, stripe_customer_id, decode_embedding(blob))
+        for user_id, name, stripe_customer_id, blob in rows
+    }
+
+
+class GallerySync:
+    """
+    Background listener applying users table changes to an in-memory copy.
+
+    on_upsert(user_id, name, stripe_customer_id, embedding) and on_delete(user_id)
+    apply single changes; local_checksum() returns the local copy's checksum
+    (FaceGallery.checksum); on_resync() must reload the copy from scratch.
+    is_healthy() tells whether notifications are being received; while it is
+    False the owner should fall back to reloading periodically.
+    """
+
+    def __init__(self, on_upsert, on_delete, on_resync, local_checksum, resync_every=GALLERY_RESYNC_SECONDS):
+        self.on_upsert = on_upsert
+        self.on_delete = on_delete
+        self.on_resync = on_resync
+        self.local_checksum = local_checksum
+        self.resync_every = resync_every
+        self._thread = None
+        self._pid = None
+        self._connected = False
+
+    def is_healthy(self):
+        """True while the listener thread runs in this process and is LISTENing."""
+        return (self._connected and self._pid == os.getpid()
+                and self._thread is not None and self._thread.is_alive())
+
+    def start(self):
+        """Starts the listener thread in this process (a no-op if already running here)."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._connected = False
+        self._thread = threading.Thread(target=self._run, name="gallery-sync", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                self._connected = False
+                print(f"[SYNC] Listener failed, reconnecting in {RECONNECT_DELAY}s:", e)
+                time.sleep(RECONNECT_DELAY)
+
+    def _listen(self):
+        conn = psycopg2.connect(DATABASE_URL)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANNEL}")
+            # Anything could have changed while we were not listening
+            self.verify(conn)
+            self._connected = True
+            next_check = time.monotonic() + self.resync_every
+
+            while True:
+                timeout = max(0.0, next_check - time.monotonic())
+                readable, _, _ = select.select([conn], [], [], timeout)
+                if readable:
+                    self.drain(conn)
+                if time.monotonic() >= next_check:
+                    self.verify(conn)
+                    next_check = time.monotonic() + self.resync_every
+        finally:
+            self._connected = False
+            conn.close()
+
+    def drain(self, conn):
+        """Applies every notification received on the LISTEN connection so far."""
+        conn.poll()
+        changes = {}
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                payload = json.loads(notify.payload)
+                changes[payload["user_id"]] = payload["op"]
+            except (ValueError, KeyError):
+                print("[SYNC] Ignoring malformed notification:", notify.payload)
+        if changes:
+            self.apply(changes)
+
+    def apply(self, changes):
+        """Applies {user_id: op} by fetching the current state of every changed row."""
+        current = fetch_users(user_id for user_id, op in changes.items() if op != "DELETE")
+        for user_id in changes:
+            if user_id in current:
+                self.on_upsert(user_id, *current[user_id])
+            else:
+                self.on_delete(user_id)
+
+    def verify(self, conn=None):
+        """
+        Compares table and local checksums; triggers a full reload if they still
+        differ after applying the notifications that arrived meanwhile.
+        """
+        for _ in range(VERIFY_ATTEMPTS):
+            remote = table_checksum()
+            if remote == self.local_checksum():
+                return
+            if conn is None:
+                break
+            time.sleep(VERIFY_RETRY_DELAY)
+            self.drain(conn)
+        print(f"[SYNC] Gallery out of sync ({remote[0]} users in table), reloading")
+        self.on_resync()
@@ -0,0 +1,58 @@
+import glob
+import os
+import secrets
+import shutil
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# More than one thread switches gunicorn to gthread workers, which lets concurrent
+# requests in a worker share a batched forward pass (EMBED_BATCH_SIZE in face_utils)
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+# Verify tokens issued by one worker are redeemed by another: without a configured
+# VERIFY_TOKEN_SECRET, the master picks one before forking so all workers share it
+# (tokens then only verify on this host; set the variable when running several)
+if not os.getenv("VERIFY_TOKEN_SECRET"):
+    print("[WARNING] VERIFY_TOKEN_SECRET is not set; using a random secret shared by this server's workers")
+    os.environ["VERIFY_TOKEN_SECRET"] = secrets.token_hex(32)
+
+# Metrics: each worker writes its values to METRICS_DIR and /metrics merges them
+# (see metrics.py); the directory starts empty so totals begin at zero
+_own_metrics_dir = not os.getenv("METRICS_DIR")
+if _own_metrics_dir:
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="facepay-metrics-")
+else:
+    os.makedirs(os.environ["METRICS_DIR"], exist_ok=True)
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "metrics-*.json")):
+        os.remove(path)
+
+# Warm-up builds the TensorFlow model, which takes longer than gunicorn's default timeout
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+# With preload the app module (and the user gallery, plain NumPy arrays) is loaded
+# once in the master and shared copy-on-write by the forked workers.
+# TensorFlow is not fork-safe once it has run, so the model is always built per worker,
+# unless EMBEDDING_SERVICE points workers at a shared inference_server.py.
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+
+
+def when_ready(server):
+    if preload_app:
+        from face_utils import get_gallery
+        get_gallery()
+
+
+def on_exit(server):
+    if _own_metrics_dir:
+        shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # Runs in each worker before it accepts connections
+    import app
+    app.warm_up()
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a request with different parameters."""
+
+
+def payment_fingerprint(recipient_id, amount, currency, verify_token=None, image_bytes=None, crop_bytes=None):
+    """
+    What a payment request's idempotency key is bound to: recipient, amount,
+    currency and a digest of the payer's credentials (verification token and/or
+    face image, as the uploaded bytes). A retry resends all of them unchanged,
+    while the same key on another payer's request is a conflict rather than a replay.
+    """
+    payer = hashlib.sha256()
+    for label, part in ((b"t", verify_token), (b"i", image_bytes), (b"f", crop_bytes)):
+        if part is not None:
+            data = part.encode() if isinstance(part, str) else bytes(part)
+            payer.update(label + len(data).to_bytes(8, "big") + data)
+    return f"{recipient_id}:{amount}:{currency}:{payer.hexdigest()[:32]}"
+
+
+IN_PROGRESS = ({"status": "error", "error": "A request with this idempotency key is still in progress"}, 409)
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "done", "response", "expires_at")
+
+    def __init__(self, fingerprint, done):
+        self.fingerprint = fingerprint
+        self.done = done
+        self.response = None
+        self.expires_at = None
+
+
+class IdempotencyCache:
+    """
+    TTL-bounded store of responses by idempotency key.
+
+    run(key, fingerprint, handler) calls handler() once per key and returns its
+    (body, status) response; a replay with the same key gets the stored response
+    back without calling handler again, and a replay that arrives while the first
+    call is still running waits for it. Only successful responses (status < 400)
+    are kept, so a client can retry a rejected request under the same key.
+    """
+
+    _event = threading.Event
+
+    def __init__(self, ttl=24 * 3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _evict(self, now):
+        # Entries are kept in insertion order, so expired ones collect at the front.
+        # A request still running at the front holds eviction back until it finishes.
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at is None:
+                break
+            if entry.expires_at >= now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def _claim(self, key, fingerprint):
+        """Returns (entry, owner): owner is True when this call must run the handler."""
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at is not None and entry.expires_at < now:
+                del self._entries[key]
+                entry = None
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = _Entry(fingerprint, self._event())
+
+        if entry.fingerprint != fingerprint:
+            raise IdempotencyConflict(f"Idempotency key {key!r} was used with different parameters")
+        return entry, owner
+
+    def run(self, key, fingerprint, handler, timeout=60):
+        entry, owner = self._claim(key, fingerprint)
+        if not owner:
+            if not entry.done.wait(timeout):
+                return IN_PROGRESS
+            if entry.response is not None:
+                return entry.response
+            # The first attempt was rejected or failed: this replay runs it afresh
+            return self.run(key, fingerprint, handler, timeout)
+
+        try:
+            response = handler()
+        except BaseException:
+            self._discard(key, entry)
+            raise
+        self._finish(key, entry, response)
+        return response
+
+    def _finish(self, key, entry, response):
+        if response[1] < 400:
+            entry.response = response
+            entry.expires_at = time.monotonic() + self.ttl
+            entry.done.set()
+        else:
+            self._discard(key, entry)
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+
+
+class AsyncIdempotencyCache(IdempotencyCache):
+    """IdempotencyCache for asyncio handlers (see asgi_app.py); handler() returns a coroutine."""
+
+    _event = asyncio.Event
+
+    async def run(self, key, fingerprint, handler, timeout=60):
+        entry, owner = self._claim(key, fingerprint)
+        if not owner:
+            try:
+                await asyncio.wait_for(entry.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                return IN_PROGRESS
+            if entry.response is not None:
+                return entry.response
+            return await self.run(key, fingerprint, handler, timeout)
+
+        try:
+            response = await handler()
+        except BaseException:
+            self._discard(key, entry)
+            raise
+        self._finish(key, entry, response)
+        return response
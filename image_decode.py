@@ -0,0 +1,133 @@
+import base64
+import io
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+# Longest side we need for face detection; Facenet itself only sees a 160x160 crop
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "640"))
+
+# Bounds for client-supplied face crops (see read_face_crop)
+FACE_CROP_MIN_SIDE = int(os.getenv("FACE_CROP_MIN_SIDE", "64"))
+FACE_CROP_MAX_SIDE = int(os.getenv("FACE_CROP_MAX_SIDE", "480"))
+FACE_CROP_MAX_ASPECT = float(os.getenv("FACE_CROP_MAX_ASPECT", "1.6"))
+
+
+class ImageRequestError(ValueError):
+    pass
+
+
+def decode_image(data, max_side=IMAGE_MAX_SIDE):
+    """
+    Decodes image bytes to an RGB uint8 array.
+    JPEGs are decoded with DCT scaling (PIL draft mode) straight to the smallest
+    1/2, 1/4 or 1/8 scale that still keeps the longest side >= max_side, instead
+    of decoding the full frame and shrinking it afterwards.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format == "JPEG" and max(image.size) > max_side:
+            scale = max_side / max(image.size)
+            image.draft("RGB", (int(image.width * scale), int(image.height * scale)))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return np.asarray(image)
+    except (OSError, SyntaxError) as e:
+        raise ImageRequestError(f"Could not decode image: {e}")
+
+
+def decode_data_url(image_data):
+    """Returns the bytes of a base64 data URL (or of a bare base64 string)."""
+    try:
+        return base64.b64decode(image_data.split(",", 1)[-1])
+    except (ValueError, TypeError) as e:
+        raise ImageRequestError(f"Invalid image_data: {e}")
+
+
+def read_image_request(request, field="image"):
+    """
+    Extracts (fields, image_bytes) from a Flask request in any of the accepted shapes:
+      - raw image/jpeg (or other image/*) body, other fields in the query string
+      - multipart/form-data with the image in file `field`, other fields as form values
+      - JSON with a base64 data URL in `<field>_data` (the original format)
+    image_bytes is None when the request carries no image.
+    """
+    content_type = request.mimetype or ""
+
+    if content_type.startswith("image/"):
+        return request.args.to_dict(), request.get_data() or None
+
+    if content_type == "multipart/form-data":
+        upload = request.files.get(field)
+        return request.form.to_dict(), (upload.read() or None) if upload else None
+
+    fields = request.get_json(silent=True)
+    if not isinstance(fields, dict):
+        raise ImageRequestError("Expected a JSON object, an image body or a multipart form")
+    image_data = fields.get(f"{field}_data")
+    return fields, decode_data_url(image_data) if image_data else None
+
+
+def _parse_json_field(value, name):
+    if value is None or isinstance(value, (list, dict)):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise ImageRequestError(f"Invalid {name}")
+
+
+def read_face_crop(request, fields):
+    """
+    Returns (crop_rgb, landmarks) for a client-cropped face, or (None, None) if the
+    request has none. The crop comes in the multipart file "face" or the JSON data URL
+    "face_data", with its "face_box" ([x, y, w, h] in the original frame) and optional
+    "face_landmarks" ({"left_eye": [x, y], "right_eye": [x, y]} in crop coordinates).
+    Raises ImageRequestError if the crop is implausible for a single tight face.
+    """
+    crop_bytes = read_face_crop_bytes(request, fields)
+    if crop_bytes is None:
+        return None, None
+    return decode_face_crop(crop_bytes, fields)
+
+
+def read_face_crop_bytes(request, fields):
+    """The encoded face crop as sent (see read_face_crop), or None; nothing is decoded yet."""
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("face")
+        crop_bytes = upload.read() if upload else None
+    else:
+        crop_bytes = decode_data_url(fields["face_data"]) if fields.get("face_data") else None
+    return crop_bytes or None
+
+
+def decode_face_crop(crop_bytes, fields):
+    """Decodes and checks a crop from read_face_crop_bytes; returns (crop_rgb, landmarks)."""
+    box = _parse_json_field(fields.get("face_box"), "face_box")
+    if not (isinstance(box, list) and len(box) == 4):
+        raise ImageRequestError("face_box must be [x, y, width, height]")
+
+    crop = decode_image(crop_bytes, max_side=FACE_CROP_MAX_SIDE)
+    height, width = crop.shape[:2]
+    if min(width, height) < FACE_CROP_MIN_SIDE or max(width, height) > FACE_CROP_MAX_SIDE:
+        raise ImageRequestError(
+            f"Face crop must be between {FACE_CROP_MIN_SIDE} and {FACE_CROP_MAX_SIDE} pixels per side"
+        )
+    if max(width, height) / min(width, height) > FACE_CROP_MAX_ASPECT:
+        raise ImageRequestError("Face crop aspect ratio is not plausible for a face")
+    try:
+        box_w, box_h = float(box[2]), float(box[3])
+    except (TypeError, ValueError):
+        raise ImageRequestError("face_box must be numeric")
+    if box_w <= 0 or box_h <= 0 or abs(box_w / box_h - width / height) > 0.1:
+        raise ImageRequestError("Face crop does not match face_box")
+
+    landmarks = _parse_json_field(fields.get("face_landmarks"), "face_landmarks")
+    if landmarks is not None and not (
+        isinstance(landmarks, dict) and
+        all(isinstance(landmarks.get(eye), list) and len(landmarks[eye]) == 2 for eye in ("left_eye", "right_eye"))
+    ):
+        raise ImageRequestError("face_landmarks must have left_eye and right_eye as [x, y]")
+    return crop, landmarks
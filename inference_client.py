@@ -0,0 +1,158 @@
+"""
+Client for inference_server.py, and the wire format both sides share.
+
+Kept free of TensorFlow/DeepFace imports so that web workers and the kiosk can
+embed faces through a shared inference server without loading the model.
+
+Every message is a fixed header followed by a payload. A request carries either
+raw RGB pixels (height x width x 3 uint8) or encoded image bytes (JPEG/PNG) to be
+decoded by the server; an empty payload is a ping. The response payload is the
+embedding as little-endian float32, or a UTF-8 error message.
+"""
+import os
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "unix:/path/to.sock" or "host:port"; unset = embed in-process (see face_utils)
+EMBEDDING_SERVICE = os.getenv("EMBEDDING_SERVICE") or None
+EMBEDDING_SERVICE_TIMEOUT = float(os.getenv("EMBEDDING_SERVICE_TIMEOUT", "30"))
+
+MAGIC = b"FPE1"
+# magic, flags, height, width, left eye x/y, right eye x/y, payload length
+REQUEST = struct.Struct("!4sBHHffffI")
+# status, payload length
+RESPONSE = struct.Struct("!BI")
+
+FLAG_DETECT = 1
+FLAG_LANDMARKS = 2
+FLAG_ENCODED = 4
+
+STATUS_OK = 0
+STATUS_NO_FACE = 1  # the image was unusable; raised as ValueError like DeepFace does
+STATUS_ERROR = 2
+
+MAX_PAYLOAD = 32 * 2**20
+
+
+def parse_address(address):
+    """Returns (socket family, address) for "unix:/path" or "host:port"."""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("embedding service closed the connection")
+        received += n
+    return bytes(buffer)
+
+
+class EmbeddingClient:
+    """
+    Thread-safe: each thread keeps its own persistent connection to the server
+    (reopened after a fork), so concurrent requests reach the server together
+    and can share one batched forward pass there.
+    """
+
+    def __init__(self, address=EMBEDDING_SERVICE, timeout=EMBEDDING_SERVICE_TIMEOUT):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _socket(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None or self._local.pid != os.getpid():
+            sock = self._local.sock = self._connect()
+            self._local.pid = os.getpid()
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+        self._local.sock = None
+
+    def _call(self, header, payload):
+        # An embedding has no side effects, so a request on a connection the
+        # server has since closed is simply sent again on a fresh one
+        for attempt in range(2):
+            reused = getattr(self._local, "sock", None) is not None
+            try:
+                sock = self._socket()
+                sock.sendall(header)
+                sock.sendall(payload)
+                status, length = RESPONSE.unpack(recv_exactly(sock, RESPONSE.size))
+                body = recv_exactly(sock, length)
+                break
+            except ConnectionError:
+                self._drop()
+                if attempt or not reused:
+                    raise
+            except OSError:
+                self._drop()
+                raise
+
+        if status == STATUS_OK:
+            return np.frombuffer(body, dtype="<f4").astype(np.float32)
+        message = body.decode("utf-8", "replace")
+        if status == STATUS_NO_FACE:
+            raise ValueError(message)
+        raise RuntimeError(f"embedding service error: {message}")
+
+    def embed(self, image, detect=True, landmarks=None):
+        """Embeds an RGB uint8 array; same arguments as face_utils.get_face_embedding."""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        flags = FLAG_DETECT if detect else 0
+        eyes = (0.0, 0.0, 0.0, 0.0)
+        if landmarks:
+            flags |= FLAG_LANDMARKS
+            eyes = (*landmarks["left_eye"], *landmarks["right_eye"])
+        header = REQUEST.pack(MAGIC, flags, height, width, *eyes, image.nbytes)
+        return self._call(header, image.tobytes())
+
+    def embed_encoded(self, data):
+        """Embeds an encoded image (JPEG/PNG bytes), decoded and face-detected by the server."""
+        header = REQUEST.pack(MAGIC, FLAG_DETECT | FLAG_ENCODED, 0, 0, 0.0, 0.0, 0.0, 0.0, len(data))
+        return self._call(header, bytes(data))
+
+    def ping(self):
+        self._call(REQUEST.pack(MAGIC, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0), b"")
+
+    def wait_ready(self, timeout=120):
+        """Blocks until the server answers (it may still be loading the model)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.ping()
+            except OSError:
+                self._drop()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.5)
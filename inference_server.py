@@ -0,0 +1,111 @@
+"""
+Standalone embedding server: holds the one Facenet model on a host and embeds
+faces for every web worker and kiosk that sets EMBEDDING_SERVICE (see
+inference_client.py for the wire format).
+
+    EMBEDDING_SERVICE=unix:/tmp/facepay-embed.sock python inference_server.py
+
+Each client connection is served on its own thread, so requests from different
+workers run concurrently; with EMBED_BATCH_SIZE > 1 their forward passes are
+batched together (see embedding_batcher.py). Run it on the same host as its
+clients: a Unix socket, or a TCP address on localhost.
+"""
+import argparse
+import os
+import socket
+import socketserver
+
+import numpy as np
+
+from face_utils import compute_face_embedding, warm_up_local_model
+from image_decode import decode_image
+from inference_client import (
+    EMBEDDING_SERVICE, MAGIC, REQUEST, RESPONSE, MAX_PAYLOAD,
+    FLAG_DETECT, FLAG_LANDMARKS, FLAG_ENCODED, STATUS_OK, STATUS_NO_FACE, STATUS_ERROR,
+    parse_address, recv_exactly,
+)
+
+DEFAULT_ADDRESS = "unix:/tmp/facepay-embed.sock"
+
+
+class EmbeddingHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                header = recv_exactly(sock, REQUEST.size)
+            except OSError:
+                return
+            magic, flags, height, width, lx, ly, rx, ry, length = REQUEST.unpack(header)
+            if magic != MAGIC or length > MAX_PAYLOAD:
+                self.reply(STATUS_ERROR, b"bad request")
+                return
+            try:
+                payload = recv_exactly(sock, length)
+            except OSError:
+                return
+
+            if not payload:  # ping
+                self.reply(STATUS_OK, b"")
+                continue
+            try:
+                embedding = self.embed(flags, height, width, (lx, ly, rx, ry), payload)
+                self.reply(STATUS_OK, np.asarray(embedding, dtype="<f4").tobytes())
+            except ValueError as e:
+                self.reply(STATUS_NO_FACE, str(e).encode())
+            except Exception as e:
+                print("[INFERENCE ERROR]", e)
+                self.reply(STATUS_ERROR, str(e).encode())
+
+    def embed(self, flags, height, width, eyes, payload):
+        if flags & FLAG_ENCODED:
+            image = decode_image(payload)
+        else:
+            if len(payload) != height * width * 3:
+                raise ValueError("payload does not match image size")
+            image = np.frombuffer(payload, dtype=np.uint8).reshape(height, width, 3)
+        landmarks = None
+        if flags & FLAG_LANDMARKS:
+            landmarks = {"left_eye": eyes[:2], "right_eye": eyes[2:]}
+        return compute_face_embedding(image, detect=bool(flags & FLAG_DETECT), landmarks=landmarks)
+
+    def reply(self, status, body):
+        self.request.sendall(RESPONSE.pack(status, len(body)) + body)
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address):
+    family, bind = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind):
+            os.remove(bind)  # left over from a previous run
+        return ThreadingUnixServer(bind, EmbeddingHandler)
+    return ThreadingTCPServer(bind, EmbeddingHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve face embeddings to FacePay web workers and kiosks")
+    parser.add_argument("--address", default=EMBEDDING_SERVICE or DEFAULT_ADDRESS,
+                        help='"unix:/path/to.sock" or "host:port" (default: EMBEDDING_SERVICE)')
+    args = parser.parse_args()
+
+    print("[INFERENCE] Loading Facenet...")
+    warm_up_local_model()
+    server = make_server(args.address)
+    print(f"[INFERENCE] Listening on {args.address} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
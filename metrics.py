@@ -0,0 +1,389 @@
+"""
+In-process metrics and sampled request traces.
+
+Code wraps the stages of a request in `with span("embed"):` blocks. Each span
+feeds the facepay_stage_seconds histogram and, when the current request was
+picked for tracing (TRACE_SAMPLE_RATE), is also recorded in that request's
+trace, which is appended to TRACE_LOG as one JSON line when the request ends.
+
+render() gives everything in Prometheus text format for the /metrics route.
+Every process counts in memory. With METRICS_DIR set, it also writes its values
+to <METRICS_DIR>/metrics-<pid>.json about once a second (METRICS_FLUSH_INTERVAL)
+and at each scrape. The worker that answers a scrape then merges every
+process's file, so whichever worker a scrape reaches, it reports the service
+totals:
+  - counters and histograms are summed over all processes, including workers
+    that have exited, so the totals never go backwards
+  - gauges are reported per live process, with a worker="<pid>" label
+gunicorn.conf.py points METRICS_DIR at a fresh directory shared by its workers.
+Without it (a single process), the values are this process's own.
+
+With METRICS_ENABLED=false, span() returns a shared no-op context manager and
+the record functions return immediately.
+"""
+import bisect
+import glob
+import json
+import os
+import random
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Share of requests whose per-stage timings are written to TRACE_LOG (0 disables tracing)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_LOG = os.getenv("TRACE_LOG", "data/traces.jsonl")
+# Directory shared by all worker processes of one server (see render)
+METRICS_DIR = os.getenv("METRICS_DIR") or None
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Euclidean distances between Facenet embeddings; the match threshold is 10
+DISTANCE_BUCKETS = (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14, 16, 20)
+
+_NOOP = nullcontext()
+_local = threading.local()
+_trace_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(into, key, value):
+        into[key] = into.get(key, 0) + value
+
+    def collect(self, values, extra=()):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key, extra)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts plus the +Inf bucket, then sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(into, key, value):
+        state = into.get(key)
+        if state is None:
+            into[key] = [list(value[0]), value[1]]
+        else:
+            state[0] = [a + b for a, b in zip(state[0], value[0])]
+            state[1] += value[1]
+
+    def collect(self, values, extra=()):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, tuple(extra) + (("le", bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, extra)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """Value read at scrape time from callback(), which returns {label tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames, callback):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def snapshot(self):
+        try:
+            return dict(self.callback())
+        except Exception as e:
+            print(f"[METRICS] Could not read {self.name}:", e)
+            return {}
+
+    def reset(self):
+        pass
+
+    def collect(self, values_by_worker, extra=()):
+        """values_by_worker: {pid: {label tuple: value}}, one series per process."""
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for pid, values in values_by_worker.items():
+            for key, value in values.items():
+                yield f"{self.name}{_format_labels(self.labelnames, key, (('worker', pid),))} {value}"
+
+
+_registry = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+REQUEST_SECONDS = register(Histogram(
+    "facepay_request_seconds", "HTTP request latency", ("endpoint", "method", "status")))
+STAGE_SECONDS = register(Histogram(
+    "facepay_stage_seconds", "Latency of individual request stages", ("stage",)))
+MATCH_DISTANCE = register(Histogram(
+    "facepay_match_distance", "Distance to the matched user's embedding", buckets=DISTANCE_BUCKETS))
+MATCHES = register(Counter(
+    "facepay_matches_total", "Face match attempts by result (match / no_match)", ("result",)))
+PAYMENTS = register(Counter(
+    "facepay_payments_total", "Stripe charges by outcome", ("status",)))
+
+
+# === Sharing between worker processes ===
+_flusher_pid = None
+_flush_lock = threading.Lock()
+
+
+def _metrics_file(pid):
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def flush():
+    """Writes this process's values to its file in METRICS_DIR (atomically)."""
+    if METRICS_DIR is None:
+        return
+    state = {
+        metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+        for metric in _registry
+    }
+    path = _metrics_file(os.getpid())
+    with _flush_lock:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pid": os.getpid(), "metrics": state}, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError as e:
+            print("[METRICS] Could not write metrics file:", e)
+
+
+def start_flusher():
+    """Starts this process's background flush thread (once per process)."""
+    global _flusher_pid
+    if METRICS_DIR is None or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def _after_fork():
+    # A forked worker starts from zero: the parent's counts are in the parent's file
+    global _flusher_pid
+    _flusher_pid = None
+    for metric in _registry:
+        metric.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_files():
+    """{pid: {metric name: {label tuple: value}}} from every process's file."""
+    processes = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue  # removed or replaced mid-read
+        processes[data["pid"]] = {
+            name: {tuple(key): value for key, value in values} for name, values in data["metrics"].items()
+        }
+    return processes
+
+
+def render():
+    """All registered metrics in Prometheus text exposition format."""
+    if METRICS_DIR is None:
+        processes = {os.getpid(): {metric.name: metric.snapshot() for metric in _registry}}
+    else:
+        start_flusher()
+        flush()
+        processes = _read_files()
+
+    lines = []
+    for metric in _registry:
+        if metric.kind == "gauge":
+            values = {pid: state.get(metric.name, {}) for pid, state in processes.items()
+                      if pid == os.getpid() or _pid_alive(pid)}
+        else:
+            values = {}
+            for state in processes.values():
+                for key, value in state.get(metric.name, {}).items():
+                    metric.merge(values, key, value)
+        lines.extend(metric.collect(values))
+    return "\n".join(lines) + "\n"
+
+
+# === Recording ===
+class _Span:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(elapsed, stage=self.stage)
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace["spans"].append({
+                "stage": self.stage,
+                "start_ms": round((self.started - trace["started"]) * 1000, 3),
+                "ms": round(elapsed * 1000, 3),
+            })
+        return False
+
+
+def span(stage):
+    """Context manager timing one stage of the current request."""
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Span(stage)
+
+
+def record_match(user):
+    """Counts a match attempt; `user` is the result of FaceGallery.match (None for no match)."""
+    if not METRICS_ENABLED:
+        return
+    if user is None:
+        MATCHES.inc(result="no_match")
+    else:
+        MATCHES.inc(result="match")
+        MATCH_DISTANCE.observe(user["distance"])
+
+
+def record_payment(status):
+    if METRICS_ENABLED:
+        PAYMENTS.inc(status=status)
+
+
+# === Request traces ===
+def start_request():
+    """Marks the start of a request and decides whether to trace it."""
+    if not METRICS_ENABLED:
+        return
+    _local.started = time.perf_counter()
+    if TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE:
+        _local.trace = {"started": _local.started, "spans": []}
+    else:
+        _local.trace = None
+
+
+def finish_request(endpoint, method, status):
+    """Records the request's latency and writes its trace if it was sampled."""
+    started = getattr(_local, "started", None)
+    if not METRICS_ENABLED or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    _local.started = None
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=method, status=status)
+
+    trace, _local.trace = getattr(_local, "trace", None), None
+    if trace is None:
+        return
+    line = json.dumps({
+        "time": datetime.now().isoformat(timespec="milliseconds"),
+        "worker": os.getpid(),
+        "endpoint": endpoint,
+        "method": method,
+        "status": status,
+        "ms": round(elapsed * 1000, 3),
+        "spans": trace["spans"],
+    }, separators=(",", ":"))
+    try:
+        with _trace_lock:
+            os.makedirs(os.path.dirname(TRACE_LOG) or ".", exist_ok=True)
+            with open(TRACE_LOG, "a") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        print("[METRICS] Could not write trace:", e)
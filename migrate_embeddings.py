@@ -0,0 +1,110 @@
+"""
+One-off migration of users.face_embedding from JSON TEXT to the binary float32
+format in embedding_format.py.
+
+Run it before deploying code that writes the binary format:
+
+    python migrate_embeddings.py [--batch-size 1000]
+
+Rows are converted in batches into a side column, so the table stays readable
+while it runs. The final swap (drop the TEXT column, rename the side column)
+takes a short exclusive lock and first converts any rows added in the meantime.
+The script is safe to re-run; it does nothing once the column is BYTEA.
+"""
+import argparse
+import os
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+from embedding_format import encode_embedding, decode_embedding, encoded_size
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+
+def column_type(cur, column):
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'users' AND column_name = %s
+    """, (column,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def convert_batch(cur, rows):
+    values = []
+    for user_id, text in rows:
+        try:
+            values.append((user_id, psycopg2.Binary(encode_embedding(decode_embedding(text)))))
+        except Exception as e:
+            print(f"[MIGRATE] Skipping user {user_id}: {e}")
+    if values:
+        execute_values(cur, """
+            UPDATE users AS u SET face_embedding_bin = v.bin
+            FROM (VALUES %s) AS v(user_id, bin)
+            WHERE u.user_id = v.user_id
+        """, values)
+    return len(values)
+
+
+def migrate(batch_size):
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            if column_type(cur, "face_embedding") == "bytea":
+                print("✅ users.face_embedding is already BYTEA, nothing to do.")
+                return
+
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS face_embedding_bin BYTEA")
+            conn.commit()
+
+            # Keyset pagination so each batch is an index range scan, not an OFFSET
+            last_id, converted = "", 0
+            while True:
+                cur.execute("""
+                    SELECT user_id, face_embedding FROM users
+                    WHERE user_id > %s AND face_embedding_bin IS NULL
+                    ORDER BY user_id LIMIT %s
+                """, (last_id, batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                converted += convert_batch(cur, rows)
+                conn.commit()
+                last_id = rows[-1][0]
+                print(f"[MIGRATE] {converted} rows converted (up to {last_id})")
+
+            # Swap columns under a lock, picking up rows written since the batches ran
+            cur.execute("LOCK TABLE users IN EXCLUSIVE MODE")
+            cur.execute("SELECT user_id, face_embedding FROM users WHERE face_embedding_bin IS NULL")
+            convert_batch(cur, cur.fetchall())
+            cur.execute("SELECT count(*) FROM users WHERE face_embedding_bin IS NULL")
+            remaining = cur.fetchone()[0]
+            if remaining:
+                conn.rollback()
+                raise RuntimeError(f"{remaining} rows could not be converted; fix them and re-run")
+
+            cur.execute("ALTER TABLE users DROP COLUMN face_embedding")
+            cur.execute("ALTER TABLE users RENAME COLUMN face_embedding_bin TO face_embedding")
+            cur.execute("ALTER TABLE users ALTER COLUMN face_embedding SET NOT NULL")
+            cur.execute(f"""
+                ALTER TABLE users ADD CONSTRAINT users_face_embedding_size
+                CHECK (octet_length(face_embedding) = {encoded_size()})
+            """)
+            conn.commit()
+            print(f"✅ Migrated {converted} embeddings to BYTEA.")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert users.face_embedding from JSON text to float32 BYTEA")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        raise Exception("DATABASE_URL is not set in your environment!")
+    migrate(args.batch_size)
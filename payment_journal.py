@@ -0,0 +1,240 @@
+"""
+Append-only payment journal.
+
+Records are written as JSON lines by a background thread. Everything queued
+while the previous write was in progress goes out in one write (group commit),
+followed by an fsync according to PAYMENT_LOG_FSYNC:
+
+    always   - callers wait until their record is on disk (one fsync per group)
+    interval - fsync at most every PAYMENT_LOG_FSYNC_INTERVAL seconds (default)
+    never    - leave flushing to the OS
+
+Each process writes its own segment files, named
+payments-<start time>-<pid>-<seq>.jsonl, so gunicorn workers never contend
+for a file. A segment is closed and a new one started once it reaches
+PAYMENT_LOG_SEGMENT_BYTES.
+
+The old data/payment_log.json array is imported once into a "legacy" segment:
+
+    python payment_journal.py --import data/payment_log.json
+"""
+import argparse
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOURNAL_DIR = os.getenv("PAYMENT_LOG_DIR", "data/payment_log")
+LEGACY_LOG_FILE = "data/payment_log.json"
+FSYNC_POLICY = os.getenv("PAYMENT_LOG_FSYNC", "interval").lower()
+FSYNC_INTERVAL = float(os.getenv("PAYMENT_LOG_FSYNC_INTERVAL", "1.0"))
+SEGMENT_BYTES = int(os.getenv("PAYMENT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+
+SEGMENT_PREFIX = "payments-"
+SEGMENT_SUFFIX = ".jsonl"
+LEGACY_SEGMENT = f"{SEGMENT_PREFIX}00000000000000-legacy-0{SEGMENT_SUFFIX}"
+
+_STOP = object()
+
+
+def list_segments(directory=JOURNAL_DIR):
+    """Returns segment paths oldest first (names sort by start time)."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [
+        os.path.join(directory, name) for name in sorted(names)
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+    ]
+
+
+class PaymentJournal:
+    def __init__(self, directory=JOURNAL_DIR, fsync=FSYNC_POLICY,
+                 fsync_interval=FSYNC_INTERVAL, segment_bytes=SEGMENT_BYTES):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"unknown fsync policy {fsync!r}")
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._queue = None
+        self._fd = None
+        self._seq = 0
+
+    # === Public API ===
+    def append(self, record):
+        """
+        Queues one record. Returns immediately unless the fsync policy is
+        "always", in which case it waits for the record's group commit.
+        """
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        self._ensure_writer()
+        if self.fsync == "always":
+            done = threading.Event()
+            self._queue.put((line, done))
+            done.wait()
+        else:
+            self._queue.put((line, None))
+
+    def close(self):
+        """Flushes everything queued so far and stops the writer thread."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put((_STOP, None))
+        self._thread.join()
+        self._thread = None
+
+    # === Writer thread ===
+    def _ensure_writer(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                # Fresh state per process: the parent's fd and thread are not ours
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._fd = None
+                self._seq = 0
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="payment-journal", daemon=True)
+                self._thread.start()
+
+    def _open_segment(self):
+        self._seq += 1
+        name = f"{SEGMENT_PREFIX}{datetime.now():%Y%m%d%H%M%S}-{self._pid}-{self._seq:06d}{SEGMENT_SUFFIX}"
+        self._fd = os.open(os.path.join(self.directory, name), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._written = 0
+
+    def _run(self):
+        last_sync = time.monotonic()
+        dirty = False
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self.fsync_interval if dirty else None)
+            except queue.Empty:
+                first = None
+
+            group = [first] if first is not None else []
+            while True:
+                try:
+                    group.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines, waiters = [], []
+            for line, done in group:
+                if line is _STOP:
+                    stopping = True
+                    continue
+                lines.append(line)
+                if done is not None:
+                    waiters.append(done)
+
+            try:
+                if lines:
+                    if self._fd is None or self._written >= self.segment_bytes:
+                        self._rotate()
+                    data = b"".join(lines)
+                    os.write(self._fd, data)
+                    self._written += len(data)
+                    dirty = True
+
+                now = time.monotonic()
+                if dirty and (
+                    waiters or stopping or
+                    (self.fsync == "interval" and now - last_sync >= self.fsync_interval)
+                ):
+                    if self.fsync != "never":
+                        os.fsync(self._fd)
+                    dirty = False
+                    last_sync = now
+            except OSError as e:
+                print("[ERROR] Payment journal write failed:", e)
+            finally:
+                for done in waiters:
+                    done.set()
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _rotate(self):
+        if self._fd is not None:
+            if self.fsync != "never":
+                os.fsync(self._fd)
+            os.close(self._fd)
+        self._open_segment()
+
+
+# === Legacy JSON import ===
+def import_legacy_log(json_path=LEGACY_LOG_FILE, directory=JOURNAL_DIR):
+    """
+    Copies the records of the old JSON-array log into the journal's legacy
+    segment and renames the old file to *.imported. Returns the number of
+    records imported (0 if there was nothing to do).
+    Safe to call from several processes at once.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".import.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(json_path):
+            return 0  # another process got here first
+        with open(json_path, "r") as f:
+            records = json.load(f)
+
+        target = os.path.join(directory, LEGACY_SEGMENT)
+        tmp_path = target + ".tmp"
+        with open(tmp_path, "w") as out:
+            for record in records:
+                out.write(json.dumps(record, separators=(",", ":")) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, target)
+        os.replace(json_path, json_path + ".imported")
+    return len(records)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Returns the process-wide journal, importing the legacy JSON log on first use."""
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                try:
+                    imported = import_legacy_log()
+                    if imported:
+                        print(f"[JOURNAL] Imported {imported} records from {LEGACY_LOG_FILE}")
+                except (OSError, ValueError) as e:
+                    print("[ERROR] Could not import legacy payment log:", e)
+                _journal = PaymentJournal()
+                atexit.register(_journal.close)
+    return _journal
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Payment journal maintenance")
+    parser.add_argument("--import", dest="import_path", metavar="JSON_FILE",
+                        help="import an old JSON-array payment log")
+    args = parser.parse_args()
+    if args.import_path:
+        count = import_legacy_log(args.import_path)
+        print(f"✅ Imported {count} records into {JOURNAL_DIR}")
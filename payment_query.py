@@ -0,0 +1,257 @@
+"""
+Read-only queries over the payment journal (see payment_journal.py).
+
+Each segment gets a sidecar index under <journal dir>/.index/ holding byte
+offsets of its records by recipient, charge_id and day, plus per-day and
+per-day-per-recipient rollups (count, completed sum, counts by status).
+Sidecars are extended incrementally: refresh() only scans the bytes appended
+since the last refresh, through an mmap of the segment, so queries never load
+the whole history into memory. Only the PAYMENT_INDEX_CACHE_SEGMENTS most
+recently used sidecars are kept in memory; others are re-read from disk.
+
+    python payment_query.py --recipient acct_123 --day 2025-01-31
+    python payment_query.py --rollups --day 2025-01-31
+"""
+import argparse
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from payment_journal import JOURNAL_DIR, list_segments
+
+INDEX_VERSION = 1
+# Sidecars held in memory between queries (least recently used are dropped)
+CACHE_SEGMENTS = int(os.getenv("PAYMENT_INDEX_CACHE_SEGMENTS", "16"))
+COMPLETED = "Completed"
+
+
+def _new_bucket():
+    return {"count": 0, "sum": 0.0, "by_status": {}}
+
+
+def _add_to_bucket(bucket, record):
+    status = record.get("status") or "Unknown"
+    bucket["count"] += 1
+    bucket["by_status"][status] = bucket["by_status"].get(status, 0) + 1
+    if status == COMPLETED:
+        bucket["sum"] = round(bucket["sum"] + float(record.get("amount") or 0), 2)
+
+
+def _merge_bucket(into, bucket):
+    into["count"] += bucket["count"]
+    into["sum"] = round(into["sum"] + bucket["sum"], 2)
+    for status, n in bucket["by_status"].items():
+        into["by_status"][status] = into["by_status"].get(status, 0) + n
+
+
+def _empty_sidecar():
+    return {
+        "version": INDEX_VERSION,
+        "indexed_bytes": 0,
+        "recipient": {},
+        "charge_id": {},
+        "day": {},
+        "rollups": {},  # day -> {"total": bucket, "recipients": {recipient: bucket}}
+    }
+
+
+class PaymentIndex:
+    def __init__(self, directory=JOURNAL_DIR, cache_segments=CACHE_SEGMENTS):
+        self.directory = directory
+        self.index_dir = os.path.join(directory, ".index")
+        self.cache_segments = max(cache_segments, 1)
+        self._sidecars = OrderedDict()  # segment path -> sidecar dict, least recently used first
+        self._lock = threading.Lock()
+
+    # === Index maintenance ===
+    def _sidecar_path(self, segment):
+        return os.path.join(self.index_dir, os.path.basename(segment) + ".idx.json")
+
+    def _load_sidecar(self, segment):
+        sidecar = self._sidecars.get(segment)
+        if sidecar is not None:
+            self._sidecars.move_to_end(segment)
+            return sidecar
+        try:
+            with open(self._sidecar_path(segment), "r") as f:
+                sidecar = json.load(f)
+            if sidecar.get("version") != INDEX_VERSION:
+                sidecar = _empty_sidecar()
+        except (FileNotFoundError, ValueError):
+            sidecar = _empty_sidecar()
+        self._sidecars[segment] = sidecar
+        while len(self._sidecars) > self.cache_segments:
+            self._sidecars.popitem(last=False)
+        return sidecar
+
+    def _save_sidecar(self, segment, sidecar):
+        os.makedirs(self.index_dir, exist_ok=True)
+        path = self._sidecar_path(segment)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sidecar, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def _index_segment(self, segment, sidecar):
+        size = os.path.getsize(segment)
+        start = sidecar["indexed_bytes"]
+        if size <= start:
+            return False
+
+        with open(segment, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Only index complete lines; a partially written record is picked up next time
+            end = mm.rfind(b"\n", start, size) + 1
+            if end <= start:
+                return False
+            offset = start
+            while offset < end:
+                newline = mm.find(b"\n", offset, end)
+                line = mm[offset:newline]
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f"[INDEX] Skipping unreadable record at {segment}:{offset}")
+                else:
+                    self._index_record(sidecar, record, offset)
+                offset = newline + 1
+
+        sidecar["indexed_bytes"] = end
+        return True
+
+    @staticmethod
+    def _index_record(sidecar, record, offset):
+        day = str(record.get("date", ""))[:10]
+        recipient = record.get("to")
+        sidecar["day"].setdefault(day, []).append(offset)
+        if recipient:
+            sidecar["recipient"].setdefault(recipient, []).append(offset)
+        if record.get("charge_id"):
+            sidecar["charge_id"][record["charge_id"]] = offset
+
+        rollup = sidecar["rollups"].setdefault(day, {"total": _new_bucket(), "recipients": {}})
+        _add_to_bucket(rollup["total"], record)
+        if recipient:
+            _add_to_bucket(rollup["recipients"].setdefault(recipient, _new_bucket()), record)
+
+    def refresh(self):
+        """
+        Indexes whatever has been appended to any segment since the last refresh,
+        yielding (segment, sidecar) one segment at a time so that a query only
+        holds the sidecars the cache keeps.
+        """
+        for segment in list_segments(self.directory):
+            with self._lock:
+                sidecar = self._load_sidecar(segment)
+                if self._index_segment(segment, sidecar):
+                    try:
+                        self._save_sidecar(segment, sidecar)
+                    except OSError as e:
+                        print("[INDEX] Could not save sidecar:", e)
+            yield segment, sidecar
+
+    # === Record access ===
+    @staticmethod
+    def _read_records(segment, offsets):
+        if not offsets:
+            return []
+        records = []
+        with open(segment, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset in offsets:
+                records.append(json.loads(mm[offset:mm.find(b"\n", offset)]))
+        return records
+
+    def find(self, recipient=None, day=None, charge_id=None, limit=None):
+        """
+        Returns records matching every given filter, oldest first.
+        At least one filter is required.
+        """
+        if not (recipient or day or charge_id):
+            raise ValueError("recipient, day or charge_id is required")
+
+        results = []
+        for segment, sidecar in self.refresh():
+            postings = []
+            if charge_id:
+                offset = sidecar["charge_id"].get(charge_id)
+                postings.append({offset} if offset is not None else set())
+            if recipient:
+                postings.append(set(sidecar["recipient"].get(recipient, ())))
+            if day:
+                postings.append(set(sidecar["day"].get(day, ())))
+            offsets = sorted(set.intersection(*postings))
+            results.extend(self._read_records(segment, offsets))
+            if limit is not None and len(results) >= limit:
+                return results[:limit]
+        return results
+
+    # === Aggregates ===
+    def rollups(self, day=None, recipient=None):
+        """
+        Returns {day: bucket} from the precomputed rollups, optionally limited to one
+        day and/or one recipient. A bucket is {"count", "sum", "by_status"}, where
+        sum only counts completed payments.
+        """
+        merged = {}
+        for _, sidecar in self.refresh():
+            for d, rollup in sidecar["rollups"].items():
+                if day and d != day:
+                    continue
+                bucket = rollup["recipients"].get(recipient) if recipient else rollup["total"]
+                if bucket:
+                    _merge_bucket(merged.setdefault(d, _new_bucket()), bucket)
+        return dict(sorted(merged.items()))
+
+    def failure_rate(self, since):
+        """
+        Share of payments logged at or after `since` (a datetime) whose status
+        is not Completed. Whole days after the first come from the rollups; only
+        the first, partial day's records are read. The window runs to now, so
+        the last day's rollup holds nothing later than the window.
+        """
+        cutoff = since.strftime("%Y-%m-%d %H:%M:%S")
+        first_day = since.date().isoformat()
+        total = failed = 0
+        for segment, sidecar in self.refresh():
+            for day, rollup in sidecar["rollups"].items():
+                if day > first_day:
+                    bucket = rollup["total"]
+                    total += bucket["count"]
+                    failed += bucket["count"] - bucket["by_status"].get(COMPLETED, 0)
+                elif day == first_day:
+                    for record in self._read_records(segment, sidecar["day"].get(day)):
+                        if str(record.get("date", "")) >= cutoff:
+                            total += 1
+                            failed += record.get("status") != COMPLETED
+        return {"total": total, "failed": failed, "rate": failed / total if total else 0.0}
+
+
+_index = None
+
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = PaymentIndex()
+    return _index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the payment journal")
+    parser.add_argument("--recipient")
+    parser.add_argument("--day", help="YYYY-MM-DD")
+    parser.add_argument("--charge-id")
+    parser.add_argument("--rollups", action="store_true", help="print rollups instead of records")
+    parser.add_argument("--failure-minutes", type=int, help="failure rate over the last N minutes")
+    args = parser.parse_args()
+
+    index = get_index()
+    if args.failure_minutes:
+        result = index.failure_rate(datetime.now() - timedelta(minutes=args.failure_minutes))
+    elif args.rollups:
+        result = index.rollups(day=args.day, recipient=args.recipient)
+    else:
+        result = index.find(recipient=args.recipient, day=args.day, charge_id=args.charge_id)
+    print(json.dumps(result, indent=4))
@@ -2,6 +2,8 @@ import os
 import psycopg2
 from dotenv import load_dotenv
 
+from embedding_format import encoded_size
+
 # Load .env file where your DATABASE_URL is stored
 load_dotenv()
 
@@ -16,13 +18,70 @@ try:
     conn = psycopg2.connect(DATABASE_URL)
     cur = conn.cursor()
 
-    # Create the users table if it doesn't exist
-    cur.execute("""
+    # Create the users table if it doesn't exist.
+    # face_embedding is a fixed-size float32 blob (see embedding_format.py);
+    # databases created with the old TEXT column are converted by migrate_embeddings.py
+    cur.execute(f"""
         CREATE TABLE IF NOT EXISTS users (
             user_id TEXT PRIMARY KEY,
             name TEXT NOT NULL,
             stripe_customer_id TEXT NOT NULL,
-            face_embedding TEXT NOT NULL
+            face_embedding BYTEA NOT NULL
+                CHECK (octet_length(face_embedding) = {encoded_size()})
+        );
+    """)
+
+    # Tell every process holding an in-memory gallery about changed users (see gallery_sync.py)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.user_id <> NEW.user_id THEN
+                PERFORM pg_notify('users_changed', json_build_object('op', 'DELETE', 'user_id', OLD.user_id)::text);
+            END IF;
+            PERFORM pg_notify('users_changed', json_build_object(
+                'op', TG_OP,
+                'user_id', CASE WHEN TG_OP = 'DELETE' THEN OLD.user_id ELSE NEW.user_id END
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS users_changed ON users")
+    cur.execute("""
+        CREATE TRIGGER users_changed AFTER INSERT OR UPDATE OR DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION notify_users_changed();
+    """)
+
+    # Status of charges running in the background (see charge_queue.py)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS payment_jobs (
+            payment_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            result JSONB NOT NULL,
+            idempotency_key TEXT UNIQUE,
+            fingerprint TEXT,
+            payload JSONB,
+            claimed_at TIMESTAMPTZ,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    # Columns added after payment_jobs was first introduced
+    cur.execute("ALTER TABLE payment_jobs ADD COLUMN IF NOT EXISTS idempotency_key TEXT UNIQUE")
+    cur.execute("ALTER TABLE payment_jobs ADD COLUMN IF NOT EXISTS fingerprint TEXT")
+    cur.execute("ALTER TABLE payment_jobs ADD COLUMN IF NOT EXISTS payload JSONB")
+    cur.execute("ALTER TABLE payment_jobs ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ")
+    cur.execute("ALTER TABLE payment_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS payment_jobs_pending ON payment_jobs (claimed_at) WHERE status = 'pending'
+    """)
+
+    # Single-use bookkeeping for /api/verify tokens (see verify_tokens.py)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS used_verify_tokens (
+            jti TEXT PRIMARY KEY,
+            expires_at TIMESTAMPTZ NOT NULL
         );
     """)
 
@@ -30,7 +89,7 @@ try:
     cur.close()
     conn.close()
 
-    print("✅ Table 'users' created successfully!")
+    print("✅ Tables 'users', 'payment_jobs' and 'used_verify_tokens' created successfully!")
 
 except Exception as e:
     print("❌ Error creating table:", e)
@@ -0,0 +1,277 @@
+"""
+Spreads the gallery distance scan over several processes so one match can use
+every core of a large matching host.
+
+The gallery's float32 matrix is saved once as an .npy file that every shard
+process memory-maps read-only, so the vectors live once in the page cache
+rather than once per process. Shard i scans rows [lo_i, hi_i) and returns its
+top-k; the caller merges those and re-ranks them exactly against the live
+gallery.
+
+Users added, changed or removed after the file was written (the "delta", see
+FaceGallery.export) are handled in the calling process: their stale snapshot
+rows are ignored and their current rows are added to the finalists. Once the
+delta grows past max_delta the file is rewritten in the background. A
+reloaded gallery (a new object) with the same content as the snapshot keeps
+using it; the file is only rewritten when the content differs.
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Number of shard processes per web worker (0 disables sharded matching). Each
+# worker exports its own snapshot and runs its own shards, so a host runs
+# workers x MATCH_SHARDS shard processes and keeps one float32 copy of the
+# gallery per worker in MATCH_SHARDS_DIR (and the page cache); size both for that
+MATCH_SHARDS = int(os.getenv("MATCH_SHARDS", "0"))
+# Galleries smaller than this are matched in-process; fan-out costs more than it saves
+MATCH_SHARDS_MIN_USERS = int(os.getenv("MATCH_SHARDS_MIN_USERS", "200000"))
+MATCH_SHARDS_DIR = os.getenv("MATCH_SHARDS_DIR", "data/gallery_shards")
+MATCH_SHARDS_MAX_DELTA = int(os.getenv("MATCH_SHARDS_MAX_DELTA", "10000"))
+# Seconds to wait for a shard's reply before treating it as dead
+MATCH_SHARDS_TIMEOUT = float(os.getenv("MATCH_SHARDS_TIMEOUT", "5"))
+SHARD_TOP_K = 8
+
+# One BLAS thread per shard: parallelism comes from the shards themselves
+_SHARD_ENV = {"OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "MKL_NUM_THREADS": "1"}
+
+
+class ShardError(Exception):
+    """A shard process died or stopped answering; the caller should match in-process."""
+
+
+def _shard_main(conn):
+    """Shard process loop: ("load", vectors, norms, lo, hi) and ("match", query, k) messages."""
+    matrix = sq_norms = None
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] == "load":
+            _, vectors_path, norms_path, lo, hi = message
+            matrix = np.load(vectors_path, mmap_mode="r")[lo:hi]
+            sq_norms = np.load(norms_path, mmap_mode="r")[lo:hi]
+            offset = lo
+            conn.send(True)
+        elif message[0] == "match":
+            _, query, k = message
+            if matrix is None or matrix.shape[0] == 0:
+                conn.send((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+                continue
+            sq_dists = sq_norms - 2.0 * (matrix @ query) + np.dot(query, query)
+            k = min(k, sq_dists.shape[0])
+            top = np.argpartition(sq_dists, k - 1)[:k]
+            conn.send((top + offset, sq_dists[top]))
+
+
+class ShardedMatcher:
+    def __init__(self, shards=MATCH_SHARDS, directory=MATCH_SHARDS_DIR, max_delta=MATCH_SHARDS_MAX_DELTA,
+                 timeout=MATCH_SHARDS_TIMEOUT):
+        self.shards = shards
+        self.directory = directory
+        self.max_delta = max_delta
+        self.timeout = timeout
+        self.gallery = None  # the gallery the current files are matched against
+        self._user_ids = []
+        self._version = None  # FaceGallery.version() the delta is counted from
+        self._export_checksum = None  # content of the files
+        self._files = None
+        self._generation = 0
+        self._conns = []
+        self._procs = []
+        self._pid = None
+        self._query_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._rebuilding = False
+        self._closing_registered = False
+
+    # === Shard processes ===
+    def _start(self):
+        # forkserver: children are forked from a clean helper, not from this
+        # threaded process with TensorFlow loaded
+        context = multiprocessing.get_context("forkserver")
+        saved = {name: os.environ.get(name) for name in _SHARD_ENV}
+        os.environ.update(_SHARD_ENV)
+        try:
+            for i in range(self.shards):
+                parent_conn, child_conn = context.Pipe()
+                proc = context.Process(target=_shard_main, args=(child_conn,), name=f"match-shard-{i}", daemon=True)
+                proc.start()
+                child_conn.close()
+                self._conns.append(parent_conn)
+                self._procs.append(proc)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        self._pid = os.getpid()
+        if not self._closing_registered:
+            atexit.register(self.close)
+            self._closing_registered = True
+
+    def _exchange(self, messages):
+        """Sends one message to each shard and returns their replies, raising ShardError on a dead or stuck shard."""
+        try:
+            for conn, message in zip(self._conns, messages):
+                conn.send(message)
+            replies = []
+            for conn in self._conns:
+                if not conn.poll(self.timeout):
+                    raise ShardError(f"no reply from a shard within {self.timeout}s")
+                replies.append(conn.recv())
+            return replies
+        except (EOFError, OSError) as e:
+            raise ShardError(f"shard connection lost: {e!r}") from e
+
+    def _stop_shards(self):
+        """Kills every shard (a stuck one may still owe a reply) so the next rebuild starts fresh ones."""
+        for conn in self._conns:
+            conn.close()
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.kill()
+            proc.join(timeout=1)
+        self._conns, self._procs = [], []
+        self.gallery = self._export_checksum = None
+
+    def close(self):
+        for conn in self._conns:
+            conn.close()
+        for proc in self._procs:
+            proc.join(timeout=1)
+        self._conns, self._procs = [], []
+        self._remove_files(self._files)
+
+    # === Snapshot ===
+    def rebuild(self, gallery):
+        """Exports the gallery to a fresh pair of .npy files and points every shard at them."""
+        with self._rebuild_lock:
+            with self._state_lock:
+                self._rebuilding = True
+            try:
+                self._rebuild(gallery)
+            finally:
+                with self._state_lock:
+                    self._rebuilding = False
+
+    def _rebuild(self, gallery):
+        if self._pid != os.getpid():
+            # Forked (e.g. a gunicorn worker): the parent's shard processes are not ours
+            self._conns, self._procs, self._files = [], [], None
+            self._start()
+        elif not self._conns:
+            # Stopped after a failure: respawn
+            self._start()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._generation += 1
+        base = os.path.join(self.directory, f"gallery-{os.getpid()}-{self._generation}")
+        files = (f"{base}-vectors.npy", f"{base}-norms.npy")
+        user_ids, version = gallery.export(*files)
+
+        n = len(user_ids)
+        bounds = np.linspace(0, n, self.shards + 1).astype(int)
+        with self._query_lock:
+            try:
+                self._exchange([("load", files[0], files[1], int(lo), int(hi))
+                                for lo, hi in zip(bounds[:-1], bounds[1:])])
+            except ShardError:
+                self._stop_shards()
+                self._remove_files(files)
+                raise
+            old_files, self._files = self._files, files
+            old_gallery, old_version = self.gallery, self._version
+            self.gallery, self._user_ids, self._version = gallery, user_ids, version
+            self._export_checksum = version[0]
+        if old_gallery is gallery:
+            gallery.forget_changes(old_version)
+        # Shards have re-mapped; the old files can go (existing mappings stay valid)
+        self._remove_files(old_files)
+
+    def _rebuild_in_background(self, gallery):
+        with self._state_lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def run():
+            try:
+                self.rebuild(gallery)
+            except Exception as e:
+                print("[SHARDS] Rebuild failed:", e)
+
+        threading.Thread(target=run, name="match-shards-rebuild", daemon=True).start()
+
+    def _adopt(self, gallery):
+        """
+        True if the shards can serve `gallery`. A different gallery object (after
+        a reload) is taken over without a new export when its content is exactly
+        what the files hold. Called with _query_lock held.
+        """
+        if self.gallery is gallery:
+            return True
+        if self._export_checksum is None or not self._conns:
+            return False
+        version = gallery.version()
+        if version[0] != self._export_checksum:
+            return False
+        self.gallery, self._version = gallery, version
+        return True
+
+    @staticmethod
+    def _remove_files(files):
+        for path in files or ():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # === Matching ===
+    def match(self, gallery, embedding, threshold=10):
+        """
+        Same result as gallery.match(embedding, threshold), computed across the shards.
+        Until shards hold a snapshot of this gallery's content it falls back to
+        gallery.match (and has one exported in the background). Raises ShardError
+        if a shard has died or timed out; the shards are then respawned in the background.
+        """
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._query_lock:
+            # Replies, snapshot user_ids and the version the delta is counted from
+            # are read together, so a rebuild finishing meanwhile cannot mix them
+            if self._pid != os.getpid() or not self._adopt(gallery):
+                ready = False
+            else:
+                ready = True
+                try:
+                    replies = self._exchange([("match", query, SHARD_TOP_K)] * len(self._conns))
+                except ShardError:
+                    self._stop_shards()
+                    self._rebuild_in_background(gallery)
+                    raise
+                user_ids, version = self._user_ids, self._version
+        if not ready:
+            self._rebuild_in_background(gallery)
+            return gallery.match(embedding, threshold=threshold)
+
+        snapshot_rows = np.concatenate([rows for rows, _ in replies])
+        sq_dists = np.concatenate([dists for _, dists in replies])
+        finalists = snapshot_rows[np.argsort(sq_dists)[:SHARD_TOP_K]]
+
+        # The delta: users changed since the export are matched from their live rows
+        changed = gallery.changed_since(version)
+        candidates = [user_ids[r] for r in finalists if user_ids[r] not in changed]
+        candidates.extend(changed)
+        if len(changed) > self.max_delta:
+            self._rebuild_in_background(gallery)
+
+        return gallery.match_rows(query, gallery.rows_of(candidates), threshold=threshold)
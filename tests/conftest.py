@@ -0,0 +1,89 @@
+"""
+Shared fixtures. Tests that need Postgres run against TEST_DATABASE_URL (a
+throwaway database: tables are created and emptied) and are skipped without it:
+
+    TEST_DATABASE_URL=postgresql://localhost/facepay_test python -m pytest
+"""
+import os
+import runpy
+
+import pytest
+
+# Set before any module reads them at import time; an empty DATABASE_URL keeps
+# a developer's .env from pointing the tests at a real database
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("VERIFY_TOKEN_SECRET", "test-secret")
+
+_schema_ready = False
+
+
+@pytest.fixture
+def db():
+    """A connection to the test database with the schema in place and the payment tables empty."""
+    global _schema_ready
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import psycopg2
+
+    if not _schema_ready:
+        runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "setup_db.py"))
+        _schema_ready = True
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE payment_jobs, used_verify_tokens")
+    yield conn
+    conn.close()
+
+
+class FakeCharges:
+    """Stands in for app.CHARGES: payment_jobs as a dict, charges via app.charge_and_transfer_internal."""
+
+    def __init__(self, charge):
+        self.charge = charge
+        self.jobs = {}  # idempotency_key -> (payment_id, fingerprint)
+
+    def find_by_key(self, idempotency_key):
+        return self.jobs.get(idempotency_key)
+
+    def run(self, payload, idempotency_key=None, fingerprint=None):
+        from idempotency import IdempotencyConflict
+        if idempotency_key in self.jobs:
+            payment_id, existing = self.jobs[idempotency_key]
+            if existing != fingerprint:
+                raise IdempotencyConflict("Idempotency key was used with different parameters")
+            return payment_id, None
+        payment_id = f"pay_{len(self.jobs) + 1}"
+        self.jobs[idempotency_key] = (payment_id, fingerprint)
+        return payment_id, self.charge(payload)
+
+
+@pytest.fixture
+def pay_app(monkeypatch):
+    """
+    app.py's Flask test client with Stripe, the model and the database faked out.
+    Every face matches "cus_face"; charges are recorded in pay_app.charges.
+    """
+    import app
+    from idempotency import IdempotencyCache
+
+    charges = []
+
+    def charge(payload):
+        charges.append(payload)
+        return {"status": "success", "charge_id": f"pi_{len(charges)}"}
+
+    monkeypatch.setattr(app, "PAY_ASYNC", False)
+    monkeypatch.setattr(app, "charge_and_transfer_internal", charge)
+    monkeypatch.setattr(app, "CHARGES", FakeCharges(charge))
+    monkeypatch.setattr(app, "PAY_REQUESTS", IdempotencyCache())
+    monkeypatch.setattr(app, "embed_request_face", lambda *args: [0.0] * 128)
+    monkeypatch.setattr(app, "find_matching_user_by_embedding", lambda embedding: {"user_id": "cus_face"})
+    client = app.app.test_client()
+    client.charges = charges
+    client.module = app
+    return client
+
+
+FACE_DATA = "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2w=="
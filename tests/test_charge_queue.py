@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from charge_queue import ChargeQueue
+from idempotency import IdempotencyConflict
+
+PAYLOAD = {"sender_customer_id": "cus_1", "recipient_account_id": "acct_1", "amount_cents": 500}
+
+
+class Stripe:
+    """Counts charges per Stripe idempotency key, as MockStripe in benchmark.py does."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.charges = []
+
+    def __call__(self, payload):
+        with self.lock:
+            self.charges.append(payload["idempotency_key"])
+        return {"status": "success", "charge_id": f"pi_{payload['idempotency_key']}"}
+
+
+def crashed_job(queue, key="key-1", fingerprint="fp"):
+    """A pending job as left behind by a worker that died before charging it."""
+    payment_id = f"job-{key}"
+    payload = {**PAYLOAD, "idempotency_key": payment_id}
+    assert queue._create(payment_id, key, fingerprint, payload)
+    return payment_id
+
+
+def test_run_records_result(db):
+    stripe = Stripe()
+    queue = ChargeQueue(stripe)
+    payment_id, result = queue.run(PAYLOAD, idempotency_key="key-1", fingerprint="fp")
+    assert result["status"] == "success"
+    assert queue.status(payment_id) == result
+    # The job's payment_id is the Stripe key when the client's payload carried none
+    assert stripe.charges == [payment_id]
+
+
+def test_existing_key_is_not_charged_again(db):
+    stripe = Stripe()
+    queue = ChargeQueue(stripe)
+    payment_id, _ = queue.run(PAYLOAD, idempotency_key="key-1", fingerprint="fp")
+    assert queue.run(PAYLOAD, idempotency_key="key-1", fingerprint="fp") == (payment_id, None)
+    assert queue.submit(PAYLOAD, idempotency_key="key-1", fingerprint="fp") == payment_id
+    assert len(stripe.charges) == 1
+
+
+def test_lost_insert_race_with_other_fingerprint_conflicts(db):
+    queue = ChargeQueue(Stripe())
+    queue.run(PAYLOAD, idempotency_key="key-1", fingerprint="fp")
+    with pytest.raises(IdempotencyConflict):
+        queue.submit(PAYLOAD, idempotency_key="key-1", fingerprint="other")
+    with pytest.raises(IdempotencyConflict):
+        queue.run(PAYLOAD, idempotency_key="key-1", fingerprint="other")
+
+
+def test_live_lease_is_not_reclaimed(db):
+    stripe = Stripe()
+    crashed_job(ChargeQueue(stripe))
+    assert ChargeQueue(stripe, lease=60).reclaim() == 0
+    assert stripe.charges == []
+
+
+def test_reclaimed_job_is_charged_exactly_once(db):
+    stripe = Stripe()
+    payment_id = crashed_job(ChargeQueue(stripe))
+    time.sleep(0.2)
+
+    # Every worker sweeps at once; SKIP LOCKED hands the job to only one of them
+    workers = [ChargeQueue(stripe, lease=0.1) for _ in range(4)]
+    reclaimed = []
+    threads = [threading.Thread(target=lambda w=w: reclaimed.append(w.reclaim())) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(reclaimed) == [0, 0, 0, 1]
+
+    assert workers[0].status(payment_id, wait=5)["status"] == "success"
+    assert stripe.charges == [payment_id]
+    # Finished jobs are not picked up again
+    time.sleep(0.2)
+    assert workers[0].reclaim() == 0
+    assert stripe.charges == [payment_id]
+
+
+def test_job_that_keeps_losing_its_worker_fails(db):
+    stripe = Stripe()
+    payment_id = crashed_job(ChargeQueue(stripe))
+    time.sleep(0.2)
+    assert ChargeQueue(stripe, lease=0.1, max_attempts=1).reclaim() == 0
+    assert ChargeQueue(stripe).status(payment_id)["status"] == "error"
+    assert stripe.charges == []
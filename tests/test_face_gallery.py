@@ -0,0 +1,150 @@
+"""FaceGallery, IVFIndex and int8 quantization against a brute-force float64 search."""
+import numpy as np
+import pytest
+
+from ann_index import IVFIndex
+from face_gallery import EMBEDDING_DIM, FaceGallery, quantize
+
+THRESHOLD = 10
+
+
+def make_users(count, seed=0, clusters=None):
+    """Facenet-scale vectors (strangers ~16 apart); `clusters` groups them around shared centres."""
+    rng = np.random.default_rng(seed)
+    if clusters:
+        centres = rng.standard_normal((clusters, EMBEDDING_DIM)) * 0.8
+        matrix = centres[rng.integers(clusters, size=count)] + rng.standard_normal((count, EMBEDDING_DIM)) * 0.6
+    else:
+        matrix = rng.standard_normal((count, EMBEDDING_DIM))
+    return [f"cus_{i}" for i in range(count)], matrix.astype(np.float32)
+
+
+def probes_near(matrix, distances, per_distance, seed=1):
+    """Probes at the given distances from randomly chosen enrolled vectors, plus as many strangers."""
+    rng = np.random.default_rng(seed)
+    probes = []
+    for distance in distances:
+        for row in rng.integers(len(matrix), size=per_distance):
+            direction = rng.standard_normal(EMBEDDING_DIM)
+            probes.append(matrix[row] + direction / np.linalg.norm(direction) * distance)
+    probes.extend(rng.standard_normal((per_distance * 2, EMBEDDING_DIM)))
+    return np.asarray(probes, dtype=np.float32)
+
+
+def brute_force(user_ids, matrix, query, threshold=THRESHOLD):
+    """(user_id, distance, margin) of the exact float64 nearest user, user_id None if not under threshold."""
+    dists = np.sqrt(((np.asarray(matrix, dtype=np.float64) - query.astype(np.float64)) ** 2).sum(axis=1))
+    order = np.argsort(dists)
+    best = dists[order[0]]
+    margin = dists[order[1]] - best if len(dists) > 1 else float("inf")
+    return (user_ids[order[0]] if best < threshold else None), best, margin
+
+
+def check(gallery, user_ids, matrix, probes, **options):
+    for query in probes:
+        expected, distance, margin = brute_force(user_ids, matrix, query)
+        user = gallery.match(query, threshold=THRESHOLD, **options)
+        if expected is None:
+            assert user is None
+        else:
+            assert user["user_id"] == expected
+            assert user["distance"] == pytest.approx(distance, abs=1e-4)
+            assert user["margin"] == pytest.approx(margin, abs=1e-4)
+
+
+def live(gallery):
+    matrix, user_ids = gallery.snapshot()
+    return list(user_ids), np.array(matrix)
+
+
+def test_match_is_exact():
+    user_ids, matrix = make_users(3000)
+    gallery = FaceGallery.from_arrays(user_ids, user_ids, user_ids, matrix)
+    check(gallery, user_ids, matrix, probes_near(matrix, [0.5, 4, 8, 9.9, 10.1, 12], 10))
+
+
+def test_match_returns_user_fields():
+    user_ids, matrix = make_users(10)
+    gallery = FaceGallery.from_arrays(user_ids, [f"name {u}" for u in user_ids], [f"stripe {u}" for u in user_ids], matrix)
+    user = gallery.match(matrix[3])
+    assert (user["user_id"], user["name"], user["stripe_customer_id"]) == ("cus_3", "name cus_3", "stripe cus_3")
+
+
+def test_empty_gallery_matches_nobody():
+    assert FaceGallery().match(np.zeros(EMBEDDING_DIM)) is None
+
+
+def test_remove_readd_and_grow():
+    user_ids, matrix = make_users(500)
+    gallery = FaceGallery(capacity=16)
+    for user_id, vec in zip(user_ids[:300], matrix[:300]):
+        gallery.add(user_id, user_id, user_id, vec)  # grows from capacity 16
+
+    for user_id in user_ids[:300:3]:
+        gallery.remove(user_id)
+    gallery.remove("cus_unknown")
+    for user_id, vec in zip(user_ids[:300:6], matrix[:300:6]):
+        gallery.add(user_id, user_id, user_id, vec)  # half of the removed come back
+    gallery.add("cus_5", "cus_5", "cus_5", matrix[400])  # replaced embedding
+    for user_id, vec in zip(user_ids[300:], matrix[300:]):
+        gallery.add(user_id, user_id, user_id, vec)
+
+    live_ids, live_matrix = live(gallery)
+    assert len(gallery) == len(live_ids) == len(set(live_ids))
+    assert "cus_3" not in live_ids and "cus_0" in live_ids
+    check(gallery, live_ids, live_matrix, probes_near(live_matrix, [0.5, 5, 9.5], 20))
+    # A removed user is never matched, even by their own face
+    user = gallery.match(matrix[3])
+    assert user is None or user["user_id"] != "cus_3"
+
+
+def test_ivf_recall_at_default_nprobe():
+    user_ids, matrix = make_users(20000, clusters=200)
+    index = IVFIndex.train(matrix, nlist=int(4 * np.sqrt(len(matrix))))
+    index.build(matrix, len(matrix))
+    gallery = FaceGallery.from_arrays(user_ids, user_ids, user_ids, matrix)
+    gallery.attach_index(index)
+
+    probes = probes_near(matrix, [1, 3, 5], 100)[:300]
+    m64, p64 = matrix.astype(np.float64), probes.astype(np.float64)
+    nearest = ((m64 ** 2).sum(axis=1) - 2 * p64 @ m64.T).argmin(axis=1)
+    found = sum(
+        (user := gallery.match(query)) is not None and user["user_id"] == user_ids[row]
+        for query, row in zip(probes, nearest)
+    )
+    assert found / len(probes) >= 0.95
+
+
+def test_ivf_follows_gallery_changes():
+    user_ids, matrix = make_users(2000, clusters=40)
+    index = IVFIndex.train(matrix, nlist=64)
+    index.build(matrix, len(matrix))
+    gallery = FaceGallery.from_arrays(user_ids, user_ids, user_ids, matrix)
+    gallery.attach_index(index)
+
+    gallery.remove("cus_7")
+    gallery.add("cus_new", "cus_new", "cus_new", matrix[7] + 0.01)
+    assert gallery.match(matrix[7])["user_id"] == "cus_new"
+    # Every row is still reachable with every cell probed
+    live_ids, live_matrix = live(gallery)
+    check(gallery, live_ids, live_matrix, probes_near(live_matrix, [0.5, 4], 20), nprobe=index.nlist)
+
+
+def test_int8_quantize_round_trip():
+    _, matrix = make_users(100)
+    codes, scales = quantize(matrix, "int8")
+    assert codes.dtype == np.int8
+    error = np.abs(codes * scales[:, None] - matrix).max(axis=1)
+    assert np.all(error <= scales / 2 + 1e-6)
+
+
+def test_int8_decisions_at_threshold():
+    user_ids, matrix = make_users(5000)
+    gallery = FaceGallery.from_arrays(user_ids, user_ids, user_ids, matrix, precision="int8")
+    # Genuine probes around the threshold, where a quantization error would flip the decision
+    check(gallery, user_ids, matrix, probes_near(matrix, [2, 8, 9.5, 9.9, 10.1, 10.5, 12], 30))
+
+
+def test_float16_is_rejected():
+    with pytest.raises(ValueError):
+        FaceGallery(precision="float16")
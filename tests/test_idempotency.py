@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from conftest import FACE_DATA
+from idempotency import IdempotencyCache, IdempotencyConflict, payment_fingerprint
+
+
+def test_replay_returns_first_response():
+    cache = IdempotencyCache()
+    calls = []
+
+    def handler():
+        calls.append(1)
+        return {"charge_id": f"pi_{len(calls)}"}, 200
+
+    assert cache.run("k", "fp", handler) == ({"charge_id": "pi_1"}, 200)
+    assert cache.run("k", "fp", handler) == ({"charge_id": "pi_1"}, 200)
+    assert len(calls) == 1
+
+
+def test_different_fingerprint_conflicts():
+    cache = IdempotencyCache()
+    cache.run("k", "fp", lambda: ({}, 200))
+    with pytest.raises(IdempotencyConflict):
+        cache.run("k", "other", lambda: ({}, 200))
+
+
+def test_rejected_response_is_not_kept():
+    cache = IdempotencyCache()
+    assert cache.run("k", "fp", lambda: ({"status": "error"}, 503))[1] == 503
+    assert cache.run("k", "fp", lambda: ({"status": "success"}, 200))[1] == 200
+
+
+def test_concurrent_replay_waits_for_first_call():
+    cache = IdempotencyCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {"charge_id": "pi_1"}, 200
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.run("k", "fp", slow)))
+    first.start()
+    started.wait()
+    second = threading.Thread(target=lambda: results.append(cache.run("k", "fp", slow)))
+    second.start()
+    release.set()
+    first.join()
+    second.join()
+    assert results == [({"charge_id": "pi_1"}, 200)] * 2
+    assert len(calls) == 1
+
+
+def test_fingerprint_binds_payer_credentials():
+    base = payment_fingerprint("acct_1", "5.00", "gbp", None, b"frame", None)
+    assert base == payment_fingerprint("acct_1", "5.00", "gbp", None, b"frame", None)
+    assert base != payment_fingerprint("acct_1", "5.00", "gbp", None, b"other frame", None)
+    assert base != payment_fingerprint("acct_1", "6.00", "gbp", None, b"frame", None)
+    # The same bytes as a frame or as a crop are different requests
+    assert base != payment_fingerprint("acct_1", "5.00", "gbp", None, None, b"frame")
+
+
+# === /api/pay ===
+def pay(client, key, **fields):
+    body = {"recipient_id": "acct_1", "amount": "5.00", "image_data": FACE_DATA, **fields}
+    return client.post("/api/pay", json=body, headers={"Idempotency-Key": key})
+
+
+def test_api_replayed_key_returns_first_response(pay_app):
+    first = pay(pay_app, "key-1")
+    again = pay(pay_app, "key-1")
+    assert first.status_code == again.status_code == 200
+    assert again.get_json() == first.get_json()
+    assert len(pay_app.charges) == 1
+
+
+def test_api_same_key_different_request_is_422(pay_app):
+    assert pay(pay_app, "key-1").status_code == 200
+    response = pay(pay_app, "key-1", amount="50.00")
+    assert response.status_code == 422
+    assert len(pay_app.charges) == 1
+
+
+def test_api_key_held_by_another_worker(pay_app, monkeypatch):
+    assert pay(pay_app, "key-1").status_code == 200
+    # Another worker has no cached response, only the payment_jobs row
+    monkeypatch.setattr(pay_app.module, "PAY_REQUESTS", IdempotencyCache())
+    replay = pay(pay_app, "key-1")
+    assert replay.status_code == 202 and replay.get_json()["status"] == "pending"
+    monkeypatch.setattr(pay_app.module, "PAY_REQUESTS", IdempotencyCache())
+    assert pay(pay_app, "key-1", recipient_id="acct_2").status_code == 422
+    assert len(pay_app.charges) == 1
@@ -0,0 +1,71 @@
+import hashlib
+import hmac
+import json
+
+import pytest
+
+from conftest import FACE_DATA
+from verify_tokens import TokenError, _b64encode, issue_token, read_token, redeem_token
+
+USER = {"user_id": "cus_token"}
+
+
+def foreign_token(user_id="cus_token"):
+    """A well-formed token signed with another deployment's secret."""
+    body = _b64encode(json.dumps({"uid": user_id, "exp": 2 ** 40, "jti": "x"}).encode())
+    signature = hmac.new(b"someone-else", body.encode(), hashlib.sha256).digest()
+    return f"{body}.{_b64encode(signature)}"
+
+
+def test_read_token_returns_claims():
+    assert read_token(issue_token(USER))["uid"] == "cus_token"
+
+
+@pytest.mark.parametrize("token, error", [
+    (issue_token(USER, ttl=-1), "expired"),
+    (foreign_token(), "Invalid"),
+    ("not-a-token", "Malformed"),
+])
+def test_read_token_rejects(token, error):
+    with pytest.raises(TokenError, match=error):
+        read_token(token)
+
+
+def test_token_redeems_once(db):
+    token = issue_token(USER)
+    assert redeem_token(token) == {"user_id": "cus_token"}
+    with pytest.raises(TokenError, match="already used"):
+        redeem_token(token)
+
+
+# === /api/pay ===
+def pay(client, token, **fields):
+    return client.post("/api/pay", json={"recipient_id": "acct_1", "amount": "5.00", "verify_token": token, **fields})
+
+
+@pytest.mark.parametrize("token", [issue_token(USER, ttl=-1), foreign_token()])
+def test_rejected_token_falls_back_to_face(pay_app, token):
+    response = pay(pay_app, token, image_data=FACE_DATA)
+    assert response.status_code == 200
+    assert [c["sender_customer_id"] for c in pay_app.charges] == ["cus_face"]
+
+
+@pytest.mark.parametrize("token", [issue_token(USER, ttl=-1), foreign_token()])
+def test_rejected_token_without_face_is_401(pay_app, token):
+    assert pay(pay_app, token).status_code == 401
+    assert pay_app.charges == []
+
+
+def test_valid_token_skips_face(pay_app, monkeypatch):
+    monkeypatch.setattr(pay_app.module, "redeem_token", read_token_user)
+    monkeypatch.setattr(pay_app.module, "embed_request_face", fail)
+    assert pay(pay_app, issue_token(USER), image_data=FACE_DATA).status_code == 200
+    assert [c["sender_customer_id"] for c in pay_app.charges] == ["cus_token"]
+
+
+def read_token_user(token):
+    return {"user_id": read_token(token)["uid"]}
+
+
+def fail(*args):
+    raise AssertionError("the face should not be embedded when the token is valid")
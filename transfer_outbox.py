@@ -0,0 +1,191 @@
+"""
+Durable local outbox for kiosk transfers (see backend_api.queue_transfer).
+
+A transfer is committed to a SQLite file before anything is sent, so it is not
+lost if the backend is down or the kiosk restarts. A background drainer
+delivers transfers one at a time in the order they were queued, re-sending the
+same idempotency key until the backend gives a final answer; while the oldest
+transfer is being retried, later ones wait behind it.
+
+A transfer still queued OUTBOX_MAX_AGE seconds after it was put is failed
+instead of sent: Stripe keeps idempotency keys for 24 hours, after which a
+re-sent key would no longer protect against charging twice, and a payment that
+old is not one the payer expects to go through.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "data/outbox.sqlite3")
+OUTBOX_RETRY_BASE_DELAY = 1.0
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv("OUTBOX_RETRY_MAX_DELAY", "60"))
+OUTBOX_MAX_AGE = float(os.getenv("OUTBOX_MAX_AGE", str(23 * 3600)))
+
+QUEUED = "queued"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class TransferOutbox:
+    """
+    deliver(transfer) sends one transfer and returns (result, retryable): a
+    retryable outcome (backend unreachable, 5xx) keeps the transfer queued and
+    it is tried again after a backoff; anything else is final.
+    Listeners are called from the drainer thread with the transfer dict after
+    every attempt.
+    """
+
+    def __init__(self, deliver, path=OUTBOX_PATH, max_age=OUTBOX_MAX_AGE):
+        self.deliver = deliver
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._db = None
+        self._thread = None
+        self._pid = None
+        self._listeners = []
+
+    # === Storage ===
+    def _connect(self):
+        if self._db is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=FULL")  # a queued transfer must survive power loss
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS transfers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    sender_customer_id TEXT NOT NULL,
+                    recipient_account_id TEXT NOT NULL,
+                    amount_cents INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS transfers_status ON transfers (status, id)")
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        transfer = dict(row)
+        transfer["result"] = json.loads(transfer["result"]) if transfer["result"] else None
+        return transfer
+
+    # === Public API ===
+    def put(self, sender_customer_id, recipient_account_id, amount_cents, idempotency_key):
+        """Durably queues a transfer and returns it; a repeated idempotency_key returns the existing one."""
+        now = time.time()
+        with self._cond:
+            db = self._connect()
+            db.execute("""
+                INSERT INTO transfers (idempotency_key, sender_customer_id, recipient_account_id,
+                                       amount_cents, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO NOTHING
+            """, (idempotency_key, sender_customer_id, recipient_account_id, amount_cents, QUEUED, now, now))
+            row = db.execute("SELECT * FROM transfers WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            self._cond.notify_all()
+        self.start()
+        return self._to_dict(row)
+
+    def get(self, transfer_id):
+        with self._lock:
+            return self._to_dict(self._connect().execute(
+                "SELECT * FROM transfers WHERE id = ?", (transfer_id,)).fetchone())
+
+    def wait(self, transfer_id, timeout):
+        """Waits up to timeout seconds for a final outcome; returns the transfer either way."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                row = self._connect().execute("SELECT * FROM transfers WHERE id = ?", (transfer_id,)).fetchone()
+                remaining = deadline - time.monotonic()
+                if row is None or row["status"] != QUEUED or remaining <= 0:
+                    return self._to_dict(row)
+                self._cond.wait(remaining)
+
+    def pending(self):
+        with self._lock:
+            return self._connect().execute("SELECT count(*) FROM transfers WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        """Starts the drainer in this process (a no-op if it is already running here)."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            self._connect()
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="transfer-outbox", daemon=True)
+                self._thread.start()
+
+    # === Drainer ===
+    def _run(self):
+        retry_at = 0.0
+        while True:
+            with self._cond:
+                row = self._connect().execute(
+                    "SELECT * FROM transfers WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+                delay = retry_at - time.monotonic()
+                if row is None or delay > 0:
+                    self._cond.wait(delay if row is not None else None)
+                    continue
+            transfer = self._to_dict(row)
+
+            expired = time.time() - transfer["created_at"] > self.max_age
+            if expired:
+                error = f"Not delivered within {self.max_age:.0f}s, given up"
+                if transfer["attempts"]:
+                    error += f" after {transfer['attempts']} attempts (last error: {transfer['last_error']})"
+                print(f"[OUTBOX] Transfer {transfer['id']} expired:", error)
+                result, retryable = {"status": "error", "error": error}, False
+            else:
+                try:
+                    result, retryable = self.deliver(transfer)
+                except Exception as e:
+                    result, retryable = {"status": "error", "error": str(e)}, True
+
+            attempts = transfer["attempts"] + (0 if expired else 1)
+            status = QUEUED if retryable else (COMPLETED if result.get("status") == "success" else FAILED)
+            if retryable:
+                backoff = min(OUTBOX_RETRY_BASE_DELAY * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_DELAY)
+                retry_at = time.monotonic() + backoff
+                print(f"[OUTBOX] Transfer {transfer['id']} attempt {attempts} failed, retrying in {backoff:.0f}s:",
+                      result.get("error"))
+            else:
+                retry_at = 0.0
+
+            with self._cond:
+                self._connect().execute("""
+                    UPDATE transfers SET status = ?, attempts = ?, last_error = ?, result = ?, updated_at = ?
+                    WHERE id = ?
+                """, (status, attempts, result.get("error"), None if retryable else json.dumps(result),
+                      time.time(), transfer["id"]))
+                self._cond.notify_all()
+
+            transfer.update(status=status, attempts=attempts, last_error=result.get("error"),
+                            result=None if retryable else result)
+            for callback in list(self._listeners):
+                try:
+                    callback(transfer)
+                except Exception as e:
+                    print("[OUTBOX] Listener failed:", e)
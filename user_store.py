@@ -1,61 +1,55 @@
-import os
-import json
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 
-load_dotenv()
-
-DATABASE_URL = os.getenv("DATABASE_URL")
+from db_pool import connection
+from embedding_format import encode_embedding, decode_embedding
+from metrics import span
 
-def get_connection():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+load_dotenv()
 
 def register_user(name, stripe_customer_id, face_embedding):
     """
     Registers a new user by inserting into the PostgreSQL database.
-    Face embedding is stored as a JSON string.
+    Face embedding is stored as a versioned float32 blob (see embedding_format).
+    "created" is False when the user_id was already registered (the row is left untouched).
     """
     user_id = stripe_customer_id  # Use Stripe customer ID as user ID
-
-    try:
-        conn = get_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO users (user_id, name, stripe_customer_id, face_embedding)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (user_id) DO NOTHING
-                """, (
-                    user_id,
-                    name,
-                    stripe_customer_id,
-                    json.dumps(face_embedding)
-                ))
-    finally:
-        conn.close()
+    created = False
+
+    with span("db_register"), connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (user_id, name, stripe_customer_id, face_embedding)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id
+            """, (
+                user_id,
+                name,
+                stripe_customer_id,
+                psycopg2.Binary(encode_embedding(face_embedding))
+            ))
+            created = cur.fetchone() is not None
 
     return {
         "user_id": user_id,
         "name": name,
         "stripe_customer_id": stripe_customer_id,
-        "face_embedding": face_embedding
+        "face_embedding": face_embedding,
+        "created": created
     }
 
 def load_users():
     """
     Loads all users from the PostgreSQL database.
     """
-    try:
-        conn = get_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT user_id, name, stripe_customer_id, face_embedding FROM users
-                """)
-                rows = cur.fetchall()
-    finally:
-        conn.close()
+    with span("db_load_users"), connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT user_id, name, stripe_customer_id, face_embedding FROM users
+            """)
+            rows = cur.fetchall()
 
     users = []
     for row in rows:
@@ -63,7 +57,7 @@ def load_users():
             "user_id": row["user_id"],
             "name": row["name"],
             "stripe_customer_id": row["stripe_customer_id"],
-            "face_embedding": json.loads(row["face_embedding"])  # Convert string to list
+            "face_embedding": decode_embedding(row["face_embedding"])  # float32 view, no parsing
         })
 
     return users
@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+from dotenv import load_dotenv
+
+from db_pool import connection
+
+load_dotenv()
+
+VERIFY_TOKEN_TTL = int(os.getenv("VERIFY_TOKEN_TTL", "120"))
+VERIFY_TOKEN_SECRET = os.getenv("VERIFY_TOKEN_SECRET")
+if not VERIFY_TOKEN_SECRET:
+    # Tokens signed with a per-process secret only verify in the worker that issued them.
+    # gunicorn.conf.py sets one shared secret for all workers before they fork; any
+    # other multi-worker setup must configure it.
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        raise RuntimeError("VERIFY_TOKEN_SECRET must be set when running more than one worker")
+    print("[WARNING] VERIFY_TOKEN_SECRET is not set; using a random per-process secret")
+    VERIFY_TOKEN_SECRET = secrets.token_hex(32)
+_KEY = VERIFY_TOKEN_SECRET.encode()
+
+
+class TokenError(Exception):
+    pass
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(body):
+    return hmac.new(_KEY, body.encode(), hashlib.sha256).digest()
+
+
+def issue_token(user, ttl=VERIFY_TOKEN_TTL):
+    """
+    Returns a signed token for a user matched by /api/verify.
+    It carries the user and an expiry, and can be redeemed once (see redeem_token).
+    """
+    claims = {
+        "uid": user["user_id"],
+        "exp": int(time.time()) + ttl,
+        "jti": secrets.token_hex(16),
+    }
+    body = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{body}.{_b64encode(_sign(body))}"
+
+
+def read_token(token):
+    """Checks signature and expiry and returns the token's claims, or raises TokenError."""
+    try:
+        body, signature = token.split(".")
+        valid = hmac.compare_digest(_b64decode(signature), _sign(body))
+        claims = json.loads(_b64decode(body)) if valid else None
+    except (ValueError, AttributeError):
+        raise TokenError("Malformed verification token")
+    if not valid:
+        raise TokenError("Invalid verification token")
+    if claims["exp"] < time.time():
+        raise TokenError("Verification token expired")
+    return claims
+
+
+def redeem_token(token):
+    """
+    Checks signature and expiry, then marks the token used so it cannot be
+    replayed from any worker. Returns {"user_id"} or raises TokenError.
+    """
+    claims = read_token(token)
+    with connection() as conn:
+        with conn.cursor() as cur:
+            # Clear out old entries now and then; expired tokens are rejected above anyway
+            if secrets.randbelow(100) == 0:
+                cur.execute("DELETE FROM used_verify_tokens WHERE expires_at < now()")
+            cur.execute("""
+                INSERT INTO used_verify_tokens (jti, expires_at)
+                VALUES (%s, to_timestamp(%s))
+                ON CONFLICT (jti) DO NOTHING
+                RETURNING jti
+            """, (claims["jti"], claims["exp"]))
+            if cur.fetchone() is None:
+                raise TokenError("Verification token already used")
+
+    return {"user_id": claims["uid"]}